@@ -1,43 +1,16 @@
-import cv2
-import os
-import csv
+import time
+import queue
+import argparse
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import Tk, Canvas, Button, Label, filedialog, Toplevel, Text, Scrollbar, Frame, font
 from PIL import Image, ImageTk, ImageDraw
-import face_recognition
-import time
-
-# Function to search for CSV files
-def find_csv_files(directory):
-    non_criminal_file = None
-    criminal_file = None
-    for root, dirs, files in os.walk(directory):
-        for filename in files:
-            if filename.lower().endswith('.csv'):
-                if 'non-criminal' in filename.lower():
-                    non_criminal_file = os.path.join(root, filename)
-                elif 'criminal' in filename.lower():
-                    criminal_file = os.path.join(root, filename)
-    return non_criminal_file, criminal_file
-
-# Load face encodings from CSV
-def load_encodings_from_csv(file_path):
-    encodings = []
-    names = []
-    data = []
-    try:
-        with open(file_path, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader)  # Skip header
-            for row in reader:
-                name = row[0]
-                encoding = np.array([float(val) for val in row[1].split(',')])
-                encodings.append(encoding)
-                names.append(name)
-                data.append(row)
-    except Exception as e:
-        print(f"Error loading encodings: {e}")
-    return encodings, names, data
+from face_cache import DEFAULT_RADIUS, IdentityCache
+from face_config import add_gallery_arguments, resolve_from_args, resolve_gallery_paths
+from face_enroll import GalleryReloader
+from face_matcher import CRIMINAL, NON_CRIMINAL
+from face_metrics import METRICS, add_metrics_arguments, start_from_args
+from face_pipeline import detect_and_encode, fit_image, read_image_rgb
 
 # User Guide Window
 def show_user_guide():
@@ -54,7 +27,9 @@ def show_user_guide():
                      "2. The system will detect faces and match them.\n"
                      "3. Criminal details will be displayed if matched.\n"
                      "4. Click 'Clear' to reset the interface.\n\n"
-                     "Note: Ensure CSV files are available on your Desktop.")
+                     "Note: Face data is located from --gallery-dir / --criminal / --non-criminal,\n"
+                     "the FACE_GALLERY_DIR environment variable, ~/.face_recognition.json\n"
+                     "or the application directory.")
     guide_text.config(state="disabled")
     
     scrollbar = Scrollbar(guide_window, command=guide_text.yview)
@@ -63,8 +38,11 @@ def show_user_guide():
     guide_text.pack(padx=20, pady=20)
 
 class FaceRecognitionApp:
-    def __init__(self, root):
+    def __init__(self, root, args=None):
         self.root = root
+        self.args = args
+        self.started_at = time.perf_counter()
+        self.startup_times = {}
         self.root.title("Face Recognition System")
         self.root.geometry("1200x700")
         
@@ -79,20 +57,45 @@ class FaceRecognitionApp:
         self.root.config(bg=self.bg_color)
         self.root.resizable(False, False)
 
+        # How long each face stays on screen when an image has several
+        self.face_dwell_ms = 2500
+
         # Custom fonts
         self.title_font = font.Font(family="Arial", size=18, weight="bold")
         self.label_font = font.Font(family="Arial", size=12)
         self.button_font = font.Font(family="Arial", size=12, weight="bold")
+        self.status_font = font.Font(family="Arial", size=9)
 
         # Main container
         self.main_frame = Frame(root, bg=self.bg_color)
         self.main_frame.pack(fill='both', expand=True, padx=20, pady=20)
         
+        # Recognition runs on a background thread; results come back through
+        # a queue that the Tk loop polls, and every pending root.after
+        # animation is tracked by key so it can be cancelled
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.results = queue.Queue()
+        self.job_id = 0
+        self.job_future = None
+        self.after_ids = {}
+        self.gallery = None
+        self.reloader = None
+        # Replaced by the exporters' stop function when metrics are enabled
+        self.stop_metrics = lambda: None
+        # With --cache-size, re-uploads and repeated faces reuse recent match
+        # results (approximate: any face within the cache radius is a hit)
+        cache_size = getattr(args, 'cache_size', 0)
+        self.identity_cache = IdentityCache(cache_size) if cache_size else None
+
         # Setup UI components
         self.setup_ui()
+        self.startup_times['ui'] = time.perf_counter() - self.started_at
         
-        # Load face data
+        # Load face data in the background, the window is usable meanwhile
         self.load_face_data()
+
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.poll_results()
     
     def setup_ui(self):
         # Left panel (image display)
@@ -173,6 +176,12 @@ class FaceRecognitionApp:
             # Add click animation
             button.bind("<Button-1>", lambda e, b=button: self.animate_button_click(b))
 
+        # Startup / gallery status
+        self.status_label = Label(self.right_frame, text="Loading face data...", font=self.status_font,
+                                  bg=self.panel_color, fg=self.text_color, anchor='w', justify='left',
+                                  wraplength=360)
+        self.status_label.pack(side='bottom', fill='x', padx=20, pady=10)
+
     def animate_button_click(self, button):
         # Button click animation
         orig_color = button.cget("bg")
@@ -181,23 +190,167 @@ class FaceRecognitionApp:
         self.root.after(100, lambda: button.config(bg=orig_color))
 
     def load_face_data(self):
-        # Load face encodings
-        non_criminal_file, criminal_file = find_csv_files(os.path.expanduser("~"))
-        if non_criminal_file and criminal_file:
-            self.known_face_encodings, self.known_face_names, self.known_data = load_encodings_from_csv(non_criminal_file)
-            self.criminal_face_encodings, self.criminal_face_names, self.criminal_data = load_encodings_from_csv(criminal_file)
-        else:
-            print("CSV files not found. Please ensure both files exist.")
+        # Queued first on the executor, so recognition jobs run after it
+        self.executor.submit(self.gallery_job)
+
+    def gallery_job(self):
+        # Runs on the executor thread: resolve the gallery location (no home
+        # directory walk unless nothing else is configured) and load it
+        try:
+            start = time.perf_counter()
+            location = resolve_from_args(self.args) if self.args else resolve_gallery_paths()
+            resolve_time = time.perf_counter() - start
+            if location is None:
+                self.post(None, 'gallery', None)
+                return
+
+            start = time.perf_counter()
+            # Compiled galleries (see face_gallery.py) are memory-mapped, CSVs are parsed.
+            # Faces enrolled later (face_enroll.py) are swapped in by the reloader.
+            self.reloader = GalleryReloader(location.criminal, location.non_criminal, interval=5.0)
+            self.reloader.subscribe(self.set_gallery)
+            self.gallery = self.reloader.gallery
+            self.reloader.start()
+            self.post(None, 'gallery', (location, resolve_time, time.perf_counter() - start))
+        except Exception as e:
+            self.post(None, 'error', f"Error loading face data: {e}")
+
+    def set_gallery(self, gallery):
+        # Called on the reloader thread; the next recognition job picks it up
+        self.gallery = gallery
 
     def upload_image(self):
         # File dialog to select image
         image_path = filedialog.askopenfilename(title="Select an image", 
                                               filetypes=[("Image files", "*.jpg;*.jpeg;*.png")])
         if image_path:
-            # Show loading animation
-            self.show_loading_animation()
-            # Process after a short delay to allow animation to show
-            self.root.after(100, lambda: self.process_and_display_image(image_path))
+            self.process_and_display_image(image_path)
+
+    def cancel_job(self):
+        self.job_id += 1
+        if self.job_future is not None:
+            self.job_future.cancel()
+        self.cancel_animations()
+
+    def recognition_job(self, job_id, image_path, display_size):
+        # Runs on the executor thread: no Tk calls here, only self.post
+        try:
+            timings = {}
+            img_rgb = read_image_rgb(image_path, timings)
+            if img_rgb is None:
+                METRICS.count('errors')
+                self.post(job_id, 'error', f"Error processing image: unable to read {image_path}")
+                return
+            # Only a display-sized thumbnail goes to the UI; detection and
+            # encoding below read the full-resolution array itself
+            start = time.perf_counter()
+            self.post(job_id, 'image', Image.fromarray(fit_image(img_rgb, *display_size)))
+            timings['thumbnail'] = time.perf_counter() - start
+
+            if self.gallery is None:
+                self.post(job_id, 'error', "Error processing image: face data is not loaded")
+                return
+            if job_id != self.job_id:
+                return
+            # Detection runs on a downscaled copy, encoding at full resolution
+            face_locations, face_encodings = detect_and_encode(img_rgb, timings=timings)
+            if job_id != self.job_id:
+                return
+            # Match every face of the image in a single pass over the gallery
+            start = time.perf_counter()
+            if not face_encodings:
+                matches = []
+            elif self.identity_cache is not None:
+                matches = self.identity_cache.match_batch(self.gallery, face_encodings)
+            else:
+                matches = self.gallery.match_batch(face_encodings)
+            timings['match'] = time.perf_counter() - start
+            METRICS.observe_timings(timings)
+            METRICS.record_image(len(matches))
+            METRICS.record_matches(matches)
+            self.post(job_id, 'matches', matches)
+        except Exception as e:
+            self.post(job_id, 'error', f"Error processing image: {e}")
+
+    def post(self, job_id, kind, payload):
+        self.results.put((job_id, kind, payload))
+
+    def poll_results(self):
+        # Deliver background results on the Tk thread, dropping stale jobs
+        try:
+            while True:
+                job_id, kind, payload = self.results.get_nowait()
+                # job_id None: not tied to an upload (gallery loading)
+                if job_id is None or job_id == self.job_id:
+                    self.handle_result(kind, payload)
+        except queue.Empty:
+            pass
+        self.after_ids['poll'] = self.root.after(30, self.poll_results)
+
+    def handle_result(self, kind, payload):
+        if kind == 'gallery':
+            self.show_startup_times(payload)
+        elif kind == 'image':
+            self.remove_loading_animation()
+            self.fade_in_image(payload)
+        elif kind == 'matches':
+            if not payload:
+                self.animate_text_change(self.info_labels[0], "Name : No faces detected")
+                # Clear other fields
+                for label in self.info_labels[1:]:
+                    label.config(text=label.cget("text").split(':')[0] + " :")
+                return
+            self.show_matches(payload)
+        else:
+            self.remove_loading_animation()
+            print(payload)
+
+    def show_startup_times(self, loaded):
+        if loaded is None:
+            message = "Face data not found. Use --gallery-dir or FACE_GALLERY_DIR."
+        else:
+            location, resolve_time, load_time = loaded
+            self.startup_times['resolve'] = resolve_time
+            self.startup_times['gallery'] = load_time
+            self.startup_times['ready'] = time.perf_counter() - self.started_at
+            phases = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.startup_times.items())
+            message = (f"{len(self.gallery)} faces from {location.source}\n"
+                       f"Startup: {phases}")
+        print(message)
+        self.status_label.config(text=message)
+
+    def show_matches(self, matches, index=0):
+        # Show each face in turn, the last one stays on screen
+        self.display_match(matches[index])
+        if index + 1 < len(matches):
+            self.schedule('faces', self.face_dwell_ms, lambda: self.show_matches(matches, index + 1))
+
+    def schedule(self, key, delay, callback):
+        # root.after that replaces (and so cancels) the previous callback for key
+        self.cancel_animation(key)
+
+        def run():
+            self.after_ids.pop(key, None)
+            callback()
+        self.after_ids[key] = self.root.after(delay, run)
+
+    def cancel_animation(self, key):
+        after_id = self.after_ids.pop(key, None)
+        if after_id is not None:
+            self.root.after_cancel(after_id)
+
+    def cancel_animations(self):
+        for key in list(self.after_ids):
+            if key != 'poll':
+                self.cancel_animation(key)
+
+    def on_close(self):
+        self.cancel_job()
+        self.stop_metrics()
+        if self.reloader is not None:
+            self.reloader.stop()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
 
     def show_loading_animation(self):
         # Create loading animation
@@ -212,6 +365,13 @@ class FaceRecognitionApp:
         self.loading_angle = 0
         self.animate_loading()
 
+    def remove_loading_animation(self):
+        # Remove loading animation if it exists
+        self.cancel_animation('loading')
+        if hasattr(self, 'loading_id'):
+            self.canvas.delete(self.loading_id)
+            del self.loading_id
+
     def animate_loading(self):
         # Animate loading spinner
         if hasattr(self, 'loading_id'):
@@ -223,100 +383,86 @@ class FaceRecognitionApp:
             self.canvas.itemconfig(self.loading_id, image=self.loading_tk)
             self.canvas.image = self.loading_tk
             self.loading_angle = (self.loading_angle + 20) % 360
-            self.root.after(50, self.animate_loading)
+            self.schedule('loading', 50, self.animate_loading)
 
     def process_and_display_image(self, image_path):
-        try:
-            # Process the selected image
-            img = cv2.imread(image_path)
-            if img is None:
-                return
-
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            img_pil = Image.fromarray(img_rgb)
-            img_width, img_height = img_pil.size
-
-            # Remove loading animation if it exists
-            if hasattr(self, 'loading_id'):
-                self.canvas.delete(self.loading_id)
-                del self.loading_id
-
-            # Fade in the image
-            self.fade_in_image(img_pil)
-
-            # Face recognition
-            face_locations = face_recognition.face_locations(img_rgb)
-            face_encodings = face_recognition.face_encodings(img_rgb, face_locations)
-
-            if not face_encodings:
-                self.animate_text_change(self.info_labels[0], "Name : No faces detected")
-                # Clear other fields
-                for label in self.info_labels[1:]:
-                    label.config(text=label.cget("text").split(':')[0] + " :")
-                return
-
-            for face_encoding in face_encodings:
-                self.process_face(face_encoding)
-        except Exception as e:
-            print(f"Error processing image: {e}")
-
-    def fade_in_image(self, img_pil):
-        # Fade in image animation
-        for alpha in np.linspace(0, 1, 10):
-            blended = Image.blend(Image.new('RGB', img_pil.size, (60, 60, 60)), img_pil, alpha)  # Dark blend
-            img_tk = ImageTk.PhotoImage(blended)
-            self.canvas.create_image(0, 0, anchor="nw", image=img_tk)
-            self.canvas.image = img_tk
-            self.root.update()
-            time.sleep(0.03)
-
-        # Set final image
-        img_tk = ImageTk.PhotoImage(img_pil)
-        self.canvas.create_image(0, 0, anchor="nw", image=img_tk)
+        # A new image pre-empts whatever is still running or animating
+        self.cancel_job()
+        # Show loading animation while the executor decodes and matches
+        self.show_loading_animation()
+        self.job_future = self.executor.submit(self.recognition_job, self.job_id, image_path, self.display_size())
+
+    def display_size(self):
+        # Room for the image on the canvas, read here on the Tk thread; before
+        # the window is laid out, fall back to a share of the screen
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if width > 1 and height > 1:
+            return width, height
+        return int(self.root.winfo_screenwidth() * 0.6), int(self.root.winfo_screenheight() * 0.7)
+
+    def fade_in_image(self, img_pil, steps=10, delay=30):
+        # Fade in image animation, one blended frame per root.after tick.
+        # img_pil is the display thumbnail; every frame is pasted into the
+        # same PhotoImage instead of creating a new Tk image each time
+        background = Image.new('RGB', img_pil.size, (60, 60, 60))  # Dark blend
+        alphas = np.linspace(0, 1, steps)
+        img_tk = ImageTk.PhotoImage(background)
+        self.canvas.delete('photo')
+        self.canvas.create_image(0, 0, anchor="nw", image=img_tk, tags='photo')
         self.canvas.image = img_tk
-        self.canvas.config(width=img_pil.width, height=img_pil.height)
+
+        def step(i=0):
+            # Time spent on the Tk thread per frame
+            with METRICS.span('ui_fade_frame'):
+                if i < len(alphas):
+                    img_tk.paste(Image.blend(background, img_pil, alphas[i]))
+                else:
+                    img_tk.paste(img_pil)
+            if i < len(alphas):
+                self.schedule('fade', delay, lambda: step(i + 1))
+            else:
+                # Set final image
+                self.canvas.config(width=img_pil.width, height=img_pil.height)
+
+        step()
 
     def clear_image(self):
         # Clear the canvas and reset labels
+        self.cancel_job()
+        if hasattr(self, 'loading_id'):
+            del self.loading_id
         self.canvas.delete("all")
         for label in self.info_labels:
             label.config(text=label.cget("text").split(':')[0] + " :")
 
-    def animate_text_change(self, label, new_text):
-        try:
-            # Animate text change
-            current_text = label.cget("text")
-            # Erase current text
-            for i in range(len(current_text), -1, -1):
-                if not label.winfo_exists():  # Check if label still exists
-                    return
-                label.config(text=current_text[:i])
-                self.root.update()
-                time.sleep(0.02)
-            # Type new text
-            for i in range(1, len(new_text)+1):
-                if not label.winfo_exists():  # Check if label still exists
-                    return
-                label.config(text=new_text[:i])
-                self.root.update()
-                time.sleep(0.02)
-        except Exception as e:
-            print(f"Error animating text: {e}")
+    def animate_text_change(self, label, new_text, delay=20):
+        # Animate text change without blocking: erase the current text, then
+        # type the new one, one character per root.after tick. Starting a new
+        # animation on the same label cancels the previous one.
+        current_text = label.cget("text")
+        frames = [current_text[:i] for i in range(len(current_text), -1, -1)]
+        frames += [new_text[:i] for i in range(1, len(new_text)+1)]
+
+        def step(i=0):
+            if not label.winfo_exists():  # Check if label still exists
+                return
+            label.config(text=frames[i])
+            if i + 1 < len(frames):
+                self.schedule(str(label), delay, lambda: step(i + 1))
+
+        step()
 
     def process_face(self, face_encoding):
-        threshold = 0.55
-        
-        # First check criminal matches
-        criminal_distances = face_recognition.face_distance(self.criminal_face_encodings, face_encoding)
-        best_criminal_idx = np.argmin(criminal_distances)
-        best_criminal_dist = criminal_distances[best_criminal_idx]
+        # One pass over the stacked gallery, criminals take precedence
+        self.display_match(self.gallery.match(face_encoding))
 
-        if best_criminal_dist < threshold:
+    def display_match(self, match):
+        if match.category == CRIMINAL:
             # Criminal match found - show all details
-            name = f"{self.criminal_face_names[best_criminal_idx]} (Criminal)"
+            name = f"{match.name} (Criminal)"
             self.animate_text_change(self.info_labels[0], f"Name : {name}")
             
-            data = self.criminal_data[best_criminal_idx]
+            data = match.data
             self.animate_text_change(self.info_labels[1], f"Status : {data[2]}")
             self.animate_text_change(self.info_labels[2], f"Age : {data[3]}")
             self.animate_text_change(self.info_labels[3], f"Crime : {data[4]}")
@@ -326,15 +472,10 @@ class FaceRecognitionApp:
             self.animate_text_change(self.info_labels[6], f"Case Number : {data[8]}")
             return
 
-        # If not criminal, check non-criminal matches
-        known_distances = face_recognition.face_distance(self.known_face_encodings, face_encoding)
-        best_known_idx = np.argmin(known_distances)
-        best_known_dist = known_distances[best_known_idx]
-
-        if best_known_dist < threshold:
-            name = f"{self.known_face_names[best_known_idx]} (Not Criminal)"
+        if match.category == NON_CRIMINAL:
+            name = f"{match.name} (Not Criminal)"
             self.animate_text_change(self.info_labels[0], f"Name : {name}")
-            self.animate_text_change(self.info_labels[1], f"Status : {self.known_data[best_known_idx][2]}")
+            self.animate_text_change(self.info_labels[1], f"Status : {match.data[2]}")
             
             # For non-criminals, show empty fields but keep labels visible
             self.animate_text_change(self.info_labels[2], "Age : ")
@@ -354,6 +495,15 @@ class FaceRecognitionApp:
             self.animate_text_change(self.info_labels[6], "Case Number : ")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Face Recognition System")
+    add_gallery_arguments(parser)
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help="Identity cache entries (default: 0 = off). A face within "
+                             f"{DEFAULT_RADIUS} of a cached one reuses its decision, so results are approximate")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    stop_metrics = start_from_args(args)
     root = Tk()
-    app = FaceRecognitionApp(root)
+    app = FaceRecognitionApp(root, args)
+    app.stop_metrics = stop_metrics
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,559 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import cv2
+import numpy as np
+
+# Keypoints and descriptors of every template image, extracted once and kept
+# in memory and in a cache file. An entry is reused while the template's
+# path, size and mtime and the detector parameters are unchanged.
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "currency_detection", "templates.npz")
+# How often each template was checked and missed, to try the templates that
+# reject counterfeits most often first
+STATS_PATH = os.path.join(os.path.expanduser("~"), ".cache", "currency_detection", "template_stats.json")
+
+# Same rule as match_features: a template is found when more than this many
+# probe descriptors pass Lowe's ratio test against it
+MIN_GOOD_MATCHES = 5
+RATIO = 0.7
+SIDES = ('front', 'back')
+
+# keypoints: N x 7 float32 (x, y, size, angle, response, octave, class_id);
+# descriptors is None for a template that cannot be read or has no features
+TemplateFeatures = namedtuple('TemplateFeatures', ['path', 'keypoints', 'descriptors'])
+
+# Result of matching one side of a note: templates found out of those
+# checked and out of all, and seconds spent per stage ('extract', 'match',
+# 'total'). checked < total when the verdict was reached early.
+SideMatch = namedtuple('SideMatch', ['matched', 'checked', 'total', 'timings'])
+Verification = namedtuple('Verification', ['real', 'sides'])
+
+
+def detector_params():
+    # SIFT where OpenCV has it, ORB as backup, as match_features always did
+    if hasattr(cv2, 'SIFT_create'):
+        return {'detector': 'sift', 'opencv': cv2.__version__}
+    return {'detector': 'orb', 'nfeatures': 1500, 'opencv': cv2.__version__}
+
+
+def create_detector(params=None):
+    params = params or detector_params()
+    if params['detector'] == 'sift':
+        return cv2.SIFT_create()
+    return cv2.ORB_create(nfeatures=params['nfeatures'])
+
+
+def keypoints_to_array(keypoints):
+    return np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave, k.class_id) for k in keypoints],
+                    dtype=np.float32).reshape(-1, 7)
+
+
+def array_to_keypoints(array):
+    return [cv2.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave), int(class_id))
+            for x, y, size, angle, response, octave, class_id in array]
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TemplateStore:
+    """Template features by path, extracted at most once per template version."""
+
+    def __init__(self, cache_path=CACHE_PATH, params=None):
+        self.cache_path = cache_path
+        self.params = params or detector_params()
+        self.entries = {}   # absolute path -> (file key, TemplateFeatures)
+        self.extracted = 0
+        self.dirty = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if cache_path:
+            self.load()
+
+    def extract(self, image):
+        # (keypoints, descriptors) of a grayscale image with this store's
+        # detector settings. Detectors are not safe to share between threads,
+        # so each thread creates its own once.
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            detector = self._local.detector = create_detector(self.params)
+        return detector.detectAndCompute(image, None)
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        try:
+            key = _file_key(path)
+        except OSError:
+            return TemplateFeatures(path, np.empty((0, 7), np.float32), None)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        keypoints, descriptors = self.extract(image) if image is not None else ((), None)
+        features = TemplateFeatures(path, keypoints_to_array(keypoints), descriptors)
+        with self._lock:
+            self.entries[path] = (key, features)
+            self.extracted += 1
+            self.dirty = True
+        return features
+
+    def cached(self, path):
+        # Features of a template if they are current in memory, else None;
+        # never extracts
+        path = os.path.abspath(path)
+        entry = self.entries.get(path)
+        try:
+            if entry is not None and entry[0] == _file_key(path):
+                return entry[1]
+        except OSError:
+            pass
+        return None
+
+    def folder(self, folder, names=None):
+        # Features of the templates in folder (names default to its listing)
+        if names is None:
+            names = sorted(os.listdir(folder))
+        return [self.get(os.path.join(folder, name)) for name in names]
+
+    def preload(self, root):
+        # Extract every template under a currency_data/<CUR>/<DENOM>/<side> tree
+        count = 0
+        for dirpath, dirs, files in os.walk(root):
+            dirs.sort()
+            for filename in sorted(files):
+                self.get(os.path.join(dirpath, filename))
+                count += 1
+        return count
+
+    def load(self):
+        # Entries of a cache written with the same detector parameters
+        try:
+            with np.load(self.cache_path, allow_pickle=False) as cache:
+                index = json.loads(str(cache['index']))
+                if index['params'] != self.params:
+                    return
+                for i, (path, key, has_descriptors) in enumerate(index['entries']):
+                    descriptors = cache[f'des_{i}'] if has_descriptors else None
+                    self.entries[path] = (key, TemplateFeatures(path, cache[f'kp_{i}'], descriptors))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Error loading template cache {self.cache_path}: {e}")
+
+    def save(self):
+        # Write the cache if anything was extracted since it was read
+        if not self.cache_path or not self.dirty:
+            return
+        with self._lock:
+            entries = list(self.entries.items())
+            self.dirty = False
+        arrays, index = {}, []
+        entries = [(path, entry) for path, entry in entries if os.path.exists(path)]
+        for i, (path, (key, features)) in enumerate(entries):
+            index.append([path, key, features.descriptors is not None])
+            arrays[f'kp_{i}'] = features.keypoints
+            if features.descriptors is not None:
+                arrays[f'des_{i}'] = features.descriptors
+        arrays['index'] = np.array(json.dumps({'params': self.params, 'entries': index}))
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = self.cache_path + ".tmp.npz"
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Error saving template cache {self.cache_path}: {e}")
+
+
+def count_good_matches(matcher, probe, template, ratio=RATIO):
+    # Probe descriptors passing Lowe's ratio test against one template
+    if probe is None or template is None or len(template) < 2:
+        return 0
+    return sum(1 for pair in matcher.knnMatch(probe, template, k=2)
+               if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance)
+
+
+class VerificationPolicy:
+    """When to stop matching templates, and in which order to match them.
+
+    A side passes when min_found of its templates are found (all of them by
+    default). The verdict is known as soon as one side has missed too many
+    templates to pass, or every side has passed, so a counterfeit is usually
+    rejected after a template or two. Templates are tried by their
+    historical miss rate per descriptor: a template with few descriptors is
+    cheap to match, one that often misses decides early.
+    """
+
+    def __init__(self, min_found=None, early_exit=True, stats_path=STATS_PATH):
+        self.min_found = min_found
+        self.early_exit = early_exit
+        self.stats_path = stats_path
+        self.stats = {}     # absolute path -> [checks, misses]
+        self.dirty = False
+        self._lock = threading.Lock()
+        if stats_path:
+            self.load()
+
+    def required(self, total):
+        # Templates of a side that must be found for it to pass
+        return total if self.min_found is None else min(self.min_found, total)
+
+    def miss_rate(self, path):
+        # Smoothed, so untried templates start at one half
+        checks, misses = self.stats.get(os.path.abspath(path), (0, 0))
+        return (misses + 1) / (checks + 2)
+
+    def order(self, paths, store):
+        # Only descriptor counts already in the store are used, templates not
+        # extracted yet are costed at the average and extracted by the
+        # matching tasks themselves, on the pool
+        counts = {}
+        for path in paths:
+            features = store.cached(path)
+            if features is not None:
+                counts[path] = len(features.descriptors) if features.descriptors is not None else 0
+        average = sum(counts.values()) / len(counts) if counts else 1
+
+        def key(path):
+            return -self.miss_rate(path) / max(counts.get(path, average), 1)
+        return sorted(paths, key=key)
+
+    def record(self, path, found):
+        with self._lock:
+            checks, misses = self.stats.get(os.path.abspath(path), (0, 0))
+            self.stats[os.path.abspath(path)] = [checks + 1, misses + (not found)]
+            self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.stats_path, 'r') as file:
+                self.stats = json.load(file)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"Error loading template stats {self.stats_path}: {e}")
+
+    def save(self):
+        if not self.stats_path or not self.dirty:
+            return
+        with self._lock:
+            stats = dict(self.stats)
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.stats_path), exist_ok=True)
+            tmp_path = self.stats_path + ".tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(stats, file)
+            os.replace(tmp_path, self.stats_path)
+        except OSError as e:
+            print(f"Error saving template stats {self.stats_path}: {e}")
+
+
+class MatchEngine:
+    """Matches probe images against template folders on a thread pool.
+
+    OpenCV releases the GIL while it detects and matches, so the front and
+    the back are extracted at the same time and every template is matched
+    as a separate task. Each worker thread keeps its own detector and
+    BFMatcher.
+    """
+
+    def __init__(self, store, workers=None):
+        self.store = store
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='currency-match')
+        self._local = threading.local()
+
+    def matcher(self):
+        matcher = getattr(self._local, 'matcher', None)
+        if matcher is None:
+            matcher = self._local.matcher = cv2.BFMatcher()
+        return matcher
+
+    def _extract(self, image):
+        start = time.perf_counter()
+        _, descriptors = self.store.extract(image)
+        return descriptors, time.perf_counter() - start
+
+    def _match(self, probe, path):
+        # (template found, time it was done)
+        found = count_good_matches(self.matcher(), probe, self.store.get(path).descriptors) > MIN_GOOD_MATCHES
+        return found, time.perf_counter()
+
+    def verify(self, sides, policy=None):
+        # sides: [(image, template paths, probe descriptors or None)]. Templates
+        # of a side are matched as soon as its probe descriptors are ready, in
+        # the policy's order. Workers count their own results, so once the
+        # policy has a verdict no further template is started and the queued
+        # ones are cancelled. Without a policy every template is matched and
+        # the note is real when all are found.
+        start = time.perf_counter()
+        totals = [len(paths) for _, paths, _ in sides]
+        required = [policy.required(total) if policy else total for total in totals]
+        early_exit = bool(policy and policy.early_exit)
+        matched, checked = [0] * len(sides), [0] * len(sides)
+        extract_seconds, submitted = [0.0] * len(sides), [None] * len(sides)
+        done = [None] * len(sides)
+        decided = threading.Event()
+        lock = threading.Lock()
+        pending = {}
+
+        def verdict():
+            if any(checked[side] - matched[side] > totals[side] - required[side] for side in range(len(sides))):
+                return False
+            if early_exit or all(checked[side] == totals[side] for side in range(len(sides))):
+                if all(matched[side] >= required[side] for side in range(len(sides))):
+                    return True
+            return None
+
+        def settle():
+            # Called with the lock held after every result
+            if early_exit and verdict() is not None:
+                decided.set()
+
+        def match(side, descriptors, path):
+            if decided.is_set():
+                return
+            found, finished = self._match(descriptors, path)
+            with lock:
+                checked[side] += 1
+                matched[side] += found
+                done[side] = finished
+                if policy:
+                    policy.record(path, found)
+                settle()
+
+        def fan_out(side, descriptors):
+            paths = sides[side][1]
+            submitted[side] = done[side] = time.perf_counter()
+            if descriptors is None:
+                # No features in the probe: none of its templates can be found
+                with lock:
+                    checked[side] = len(paths)
+                    settle()
+                return
+            for path in policy.order(paths, self.store) if policy else paths:
+                pending[self.pool.submit(match, side, descriptors, path)] = None
+
+        for side, (image, _, descriptors) in enumerate(sides):
+            if descriptors is None:
+                pending[self.pool.submit(self._extract, image)] = side
+            else:
+                fan_out(side, descriptors)
+        with lock:
+            settle()
+        while pending and not decided.is_set():
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                side = pending.pop(future)
+                result = future.result()
+                if side is not None and not decided.is_set():
+                    descriptors, extract_seconds[side] = result
+                    fan_out(side, descriptors)
+
+        decided.set()
+        for future in pending:
+            future.cancel()
+        with lock:
+            real = verdict()
+        return Verification(bool(real), [
+            SideMatch(matched[side], checked[side], totals[side],
+                      {'extract': extract_seconds[side],
+                       'match': done[side] - submitted[side] if submitted[side] is not None else 0.0,
+                       'total': (done[side] if done[side] is not None else time.perf_counter()) - start})
+            for side in range(len(sides))])
+
+    def match_sides(self, sides):
+        # One SideMatch per side with every template matched
+        return self.verify(sides).sides
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _subdirs(path):
+    try:
+        return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+    except OSError:
+        return []
+
+
+def iter_templates(root):
+    # (currency, denomination, side, path) for every template under root
+    for currency in _subdirs(root):
+        for denomination in _subdirs(os.path.join(root, currency)):
+            for side in SIDES:
+                folder = os.path.join(root, currency, denomination, side)
+                if os.path.isdir(folder):
+                    for name in sorted(os.listdir(folder)):
+                        yield currency, denomination, side, os.path.join(folder, name)
+
+
+def flann_matcher(params):
+    # KD-trees for SIFT's float descriptors, LSH for ORB's binary ones
+    if params['detector'] == 'sift':
+        index_params = {'algorithm': 1, 'trees': 5}
+    else:
+        index_params = {'algorithm': 6, 'table_number': 6, 'key_size': 12, 'multi_probe_level': 1}
+    return cv2.FlannBasedMatcher(index_params, {'checks': 50})
+
+
+class TemplateIndex:
+    """One FLANN index over the descriptors of many templates.
+
+    A probe is searched once, whatever the number of templates; each of its
+    descriptors votes for the template of its nearest neighbour.
+    """
+
+    def __init__(self, store, templates):
+        # templates: [(label, path)], label e.g. (currency, denomination)
+        self.labels, self.paths, descriptors = [], [], []
+        for label, path in templates:
+            features = store.get(path)
+            if features.descriptors is None or len(features.descriptors) < 2:
+                continue
+            self.labels.append(label)
+            self.paths.append(path)
+            descriptors.append(features.descriptors)
+        self.matcher = flann_matcher(store.params)
+        self._lock = threading.Lock()
+        if descriptors:
+            self.matcher.add(descriptors)
+            self.matcher.train()
+
+    def votes(self, descriptors, ratio=RATIO):
+        # Good matches per template: the ratio test runs against the two
+        # nearest neighbours over all templates, so a probe feature counts
+        # for at most one template
+        votes = np.zeros(len(self.paths), dtype=np.int64)
+        if descriptors is None or not self.paths or len(descriptors) < 2:
+            return votes
+        with self._lock:
+            neighbours = self.matcher.knnMatch(descriptors, k=2)
+        for pair in neighbours:
+            if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance:
+                votes[pair[0].imgIdx] += 1
+        return votes
+
+
+# Most likely (currency, denomination) for a pair of probes. candidates are
+# (currency, denomination, templates found, templates, votes), best first;
+# descriptors are the probes' (front, back) descriptors for the verification
+Identification = namedtuple('Identification', ['currency', 'denomination', 'candidates', 'descriptors'])
+
+
+class CurrencyIdentifier:
+    """Front and back template indexes over a whole currency_data tree."""
+
+    def __init__(self, store, root):
+        self.store = store
+        self.root = root
+        self.signature = None
+        self.indexes = {}
+        self.totals = {}    # (currency, denomination) -> number of templates
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        # Rebuild the indexes when templates were added, removed or changed
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        templates = list(iter_templates(self.root))
+        signature = []
+        for _, _, _, path in templates:
+            try:
+                signature.append((path, tuple(_file_key(path))))
+            except OSError:
+                signature.append((path, None))
+        if signature == self.signature:
+            return
+        self.indexes = {side: TemplateIndex(self.store, [((currency, denomination), path)
+                                                         for currency, denomination, s, path in templates if s == side])
+                        for side in SIDES}
+        self.totals = {}
+        for currency, denomination, _, _ in templates:
+            self.totals[(currency, denomination)] = self.totals.get((currency, denomination), 0) + 1
+        self.signature = signature
+        self.store.save()
+
+    def identify(self, front_img, back_img):
+        self.refresh()
+        indexes, totals = self.indexes, self.totals
+        found = dict.fromkeys(totals, 0)
+        votes = dict.fromkeys(totals, 0)
+        descriptors = []
+        for side, image in zip(SIDES, (front_img, back_img)):
+            _, probe = self.store.extract(image)
+            descriptors.append(probe)
+            index = indexes[side]
+            for label, count in zip(index.labels, index.votes(probe)):
+                found[label] += count > MIN_GOOD_MATCHES
+                votes[label] += int(count)
+        # Share of the denomination's templates found, then the raw votes
+        candidates = sorted(((currency, denomination, found[(currency, denomination)], total,
+                              votes[(currency, denomination)])
+                             for (currency, denomination), total in totals.items()),
+                            key=lambda c: (-c[2] / c[3], -c[4]))
+        if not candidates or not candidates[0][4]:
+            return Identification(None, None, candidates, tuple(descriptors))
+        return Identification(candidates[0][0], candidates[0][1], candidates, tuple(descriptors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract and cache the features of every currency template")
+    parser.add_argument('dataset', help="currency_data folder (<CUR>/<DENOM>/front|back/*.jpg)")
+    parser.add_argument('--cache', default=CACHE_PATH, help="Cache file")
+    parser.add_argument('--identify', nargs=2, metavar=('FRONT', 'BACK'),
+                        help="Also identify and verify the denomination of this front/back image pair")
+    parser.add_argument('--workers', type=int, help="Matching threads (default: one per core)")
+    parser.add_argument('--min-found', type=int, help="Templates per side that make a note real (default: all)")
+    args = parser.parse_args()
+
+    store = TemplateStore(args.cache)
+    cached = len(store.entries)
+    count = store.preload(args.dataset)
+    store.save()
+    print(f"{count} templates, {store.extracted} extracted, {cached} were cached -> {args.cache}", file=sys.stderr)
+
+    if args.identify:
+        images = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in args.identify]
+        if any(image is None for image in images):
+            parser.error("Unable to read the --identify images")
+        identification = CurrencyIdentifier(store, args.dataset).identify(*images)
+        for currency, denomination, found, total, votes in identification.candidates[:5]:
+            print(f"{currency} {denomination}: {found}/{total} templates, {votes} votes")
+        print(f"Identified: {identification.currency} {identification.denomination}")
+        if identification.currency is None:
+            return
+        folder = os.path.join(args.dataset, identification.currency, identification.denomination)
+        sides = []
+        for side, image, descriptors in zip(SIDES, images, identification.descriptors):
+            side_folder = os.path.join(folder, side)
+            sides.append((image, [os.path.join(side_folder, name) for name in sorted(os.listdir(side_folder))],
+                          descriptors))
+        policy = VerificationPolicy(args.min_found)
+        with MatchEngine(store, args.workers) as engine:
+            verification = engine.verify(sides, policy)
+        policy.save()
+        for side, result in zip(SIDES, verification.sides):
+            print(f"{side}: {result.matched}/{result.checked} templates found ({result.total} in all), " +
+                  ", ".join(f"{stage} {seconds * 1000:.1f} ms" for stage, seconds in result.timings.items()))
+        print("REAL" if verification.real else "FAKE")
+
+
+if __name__ == "__main__":
+    main()
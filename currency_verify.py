@@ -0,0 +1,238 @@
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+from currency_templates import (CACHE_PATH, SIDES, CurrencyIdentifier, MatchEngine, TemplateStore,
+                                VerificationPolicy)
+
+AUTO = "Auto"  # identify the currency and denomination from the images
+
+# Verdict for one front/back pair. real is None when the pair could not be
+# checked at all; sides holds one SideMatch per side (empty if not matched)
+# and timings the seconds spent per stage.
+CurrencyVerdict = namedtuple('CurrencyVerdict', ['real', 'currency', 'denomination', 'message', 'sides', 'timings'])
+
+
+class CurrencyVerifier:
+    """Checks notes against the templates of one currency_data tree.
+
+    Holds everything a check needs: the dataset root, the template store,
+    the matching thread pool, the verification policy and, once a note had
+    to be identified, the template indexes. Safe to share between threads.
+    """
+
+    def __init__(self, dataset_root, store=None, workers=None, policy=None):
+        self.dataset_root = dataset_root
+        self.store = store if store is not None else TemplateStore()
+        self.engine = MatchEngine(self.store, workers)
+        self.policy = policy if policy is not None else VerificationPolicy()
+        self._identifier = None
+        self._lock = threading.Lock()
+
+    def identifier(self):
+        with self._lock:
+            if self._identifier is None:
+                self._identifier = CurrencyIdentifier(self.store, self.dataset_root)
+            return self._identifier
+
+    def match_features(self, image, feature_folder, feature_list, des1=None):
+        # (templates found, templates) for one side, every template matched
+        paths = [os.path.join(feature_folder, name) for name in feature_list]
+        side = self.engine.match_sides([(image, paths, des1)])[0]
+        return side.matched, side.total
+
+    def verify_images(self, front_img, back_img, currency, denomination, probe_descriptors=(None, None)):
+        start = time.perf_counter()
+        front_folder = os.path.join(self.dataset_root, currency, denomination, "front")
+        back_folder = os.path.join(self.dataset_root, currency, denomination, "back")
+
+        if not os.path.exists(front_folder) or not os.path.exists(back_folder):
+            return CurrencyVerdict(False, currency, denomination,
+                                   f"❌ FAKE Currency ({currency} {denomination}) - Feature folders missing!", [], {})
+
+        front_features = sorted(os.listdir(front_folder))
+        back_features = sorted(os.listdir(back_folder))
+
+        if not front_features or not back_features:
+            return CurrencyVerdict(False, currency, denomination,
+                                   f"❌ FAKE Currency ({currency} {denomination}) - Features missing!", [], {})
+
+        # Front and back are extracted and matched at the same time, until the
+        # verdict is known
+        verification = self.engine.verify([
+            (front_img, [os.path.join(front_folder, name) for name in front_features], probe_descriptors[0]),
+            (back_img, [os.path.join(back_folder, name) for name in back_features], probe_descriptors[1])],
+            self.policy)
+        front, back = verification.sides
+        counts = ", ".join(_side_counts(side, result) for side, result in zip(SIDES, verification.sides))
+
+        if not verification.real:
+            message = f"❌ FAKE Currency ({currency} {denomination}) - {counts}."
+        elif front.matched < front.total or back.matched < back.total:
+            message = f"✅ REAL Currency ({currency} {denomination}) - {counts}."
+        else:
+            message = f"✅ REAL Currency ({currency} {denomination}) - All features detected."
+        return CurrencyVerdict(verification.real, currency, denomination, message, verification.sides,
+                               {'verify': time.perf_counter() - start})
+
+    def verify(self, front_image_path, back_image_path, currency=AUTO, denomination=None):
+        # Check a pair of image files, identifying the note first when the
+        # currency is AUTO (or not given)
+        start = time.perf_counter()
+        if currency and currency != AUTO and not denomination:
+            return CurrencyVerdict(None, currency, denomination,
+                                   f"❌ Error: No denomination given for {currency}, give one or use {AUTO}.", [], {})
+        front_img = cv2.imread(front_image_path, cv2.IMREAD_GRAYSCALE)
+        back_img = cv2.imread(back_image_path, cv2.IMREAD_GRAYSCALE)
+        timings = {'read': time.perf_counter() - start}
+
+        if front_img is None or back_img is None:
+            return CurrencyVerdict(None, currency, denomination, "❌ Error: Unable to read images.", [], timings)
+
+        descriptors = (None, None)
+        if not currency or currency == AUTO:
+            identify_start = time.perf_counter()
+            identification = self.identifier().identify(front_img, back_img)
+            timings['identify'] = time.perf_counter() - identify_start
+            if identification.currency is None:
+                timings['total'] = time.perf_counter() - start
+                return CurrencyVerdict(False, None, None, "❌ FAKE Currency - No denomination recognized!", [],
+                                       timings)
+            currency, denomination = identification.currency, identification.denomination
+            descriptors = identification.descriptors
+
+        verdict = self.verify_images(front_img, back_img, currency, denomination, descriptors)
+        timings.update(verdict.timings)
+        timings['total'] = time.perf_counter() - start
+        return verdict._replace(timings=timings)
+
+    def save(self):
+        # Persist extracted template features and the templates' history
+        self.store.save()
+        self.policy.save()
+
+    def close(self):
+        self.save()
+        self.engine.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _side_counts(side, result):
+    # Only templates actually checked are counted; after an early exit the
+    # others are neither found nor missed
+    if result.checked == 0:
+        return f"{side} not checked"
+    if result.checked < result.total:
+        return f"{result.matched}/{result.checked} {side} ({result.total - result.checked} not checked)"
+    return f"{result.matched}/{result.total} {side}"
+
+
+def read_manifest(path):
+    # CSV with front and back image columns and optional currency and
+    # denomination; a pair without a currency is identified
+    with open(path, mode='r', newline='') as file:
+        for record in csv.DictReader(file):
+            record = {key.strip().lower(): (value or "").strip() for key, value in record.items() if key}
+            yield record['front'], record['back'], record.get('currency') or AUTO, record.get('denomination') or None
+
+
+def _result(pair, future):
+    # A pair that fails unexpectedly is reported, the others still run
+    try:
+        return future.result()
+    except Exception as e:
+        return CurrencyVerdict(None, pair[2], pair[3], f"❌ Error: {e}", [], {})
+
+
+def verify_pairs(verifier, pairs, jobs, prefetch=None):
+    # (pair, CurrencyVerdict) in input order. Up to `jobs` pairs are checked
+    # at once and at most `prefetch` are in flight, so memory stays flat
+    # however long the manifest is.
+    prefetch = max(prefetch or 2 * jobs, jobs)
+    pending = deque()
+    with ThreadPoolExecutor(jobs, thread_name_prefix='currency-verify') as pool:
+        for pair in pairs:
+            pending.append((pair, pool.submit(verifier.verify, *pair)))
+            if len(pending) >= prefetch:
+                pair, future = pending.popleft()
+                yield pair, _result(pair, future)
+        while pending:
+            pair, future = pending.popleft()
+            yield pair, _result(pair, future)
+
+
+def verdict_to_dict(pair, verdict):
+    front_path, back_path, expected_currency, expected_denomination = pair
+    record = {
+        'front_image': front_path,
+        'back_image': back_path,
+        'expected_currency': None if expected_currency == AUTO else expected_currency,
+        'expected_denomination': expected_denomination,
+        'currency': verdict.currency,
+        'denomination': verdict.denomination,
+        'real': verdict.real,
+        'message': verdict.message,
+    }
+    timings = dict(verdict.timings)
+    for side, result in zip(SIDES, verdict.sides):
+        record[side] = {'matched': result.matched, 'checked': result.checked, 'total': result.total}
+        timings.update({f"{side}_{stage}": seconds for stage, seconds in result.timings.items()})
+    record['timings_ms'] = {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify scanned notes without the GUI")
+    parser.add_argument('manifest', help="CSV with front, back and optional currency, denomination columns")
+    parser.add_argument('--dataset', required=True, help="currency_data folder (<CUR>/<DENOM>/front|back/*.jpg)")
+    parser.add_argument('-o', '--output', default='-', help="Output .jsonl file (default: stdout)")
+    parser.add_argument('--jobs', type=int, default=4, help="Pairs verified at the same time")
+    parser.add_argument('--workers', type=int, help="Matching threads shared by all pairs (default: one per core)")
+    parser.add_argument('--min-found', type=int, help="Templates per side that make a note real (default: all)")
+    parser.add_argument('--no-early-exit', action='store_true', help="Match every template even once decided")
+    parser.add_argument('--cache', default=CACHE_PATH, help="Template feature cache file")
+    parser.add_argument('--progress', type=int, default=100, help="Report throughput every N pairs (0 = off)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dataset):
+        parser.error(f"Dataset folder not found: {args.dataset}")
+
+    policy = VerificationPolicy(args.min_found, early_exit=not args.no_early_exit)
+    output = sys.stdout if args.output == '-' else open(args.output, mode='w')
+    pairs = real = fake = errors = 0   # errors: unreadable images, invalid rows, failures
+    start = time.perf_counter()
+    try:
+        with CurrencyVerifier(args.dataset, TemplateStore(args.cache), args.workers, policy) as verifier:
+            print(f"Templates: {verifier.store.preload(args.dataset)} ({verifier.store.extracted} extracted), "
+                  f"workers: {verifier.engine.workers}, jobs: {args.jobs}", file=sys.stderr)
+            for pair, verdict in verify_pairs(verifier, read_manifest(args.manifest), args.jobs):
+                output.write(json.dumps(verdict_to_dict(pair, verdict), ensure_ascii=False) + "\n")
+                pairs += 1
+                real += verdict.real is True
+                fake += verdict.real is False
+                errors += verdict.real is None
+                if args.progress and pairs % args.progress == 0:
+                    elapsed = time.perf_counter() - start
+                    print(f"{pairs} pairs, {pairs / elapsed:.2f} pairs/sec", file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print(f"{pairs} pairs ({real} real, {fake} fake, {errors} errors) in {elapsed:.2f}s, "
+          f"{pairs / elapsed if elapsed else 0:.2f} pairs/sec", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
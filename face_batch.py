@@ -0,0 +1,175 @@
+import sys
+import csv
+import json
+import time
+import argparse
+from functools import partial
+from itertools import chain
+from face_cache import DEFAULT_RADIUS, IdentityCache
+from face_config import add_gallery_arguments, resolve_from_args
+from face_index import INDEX_TYPES
+from face_matcher import FaceGallery
+from face_metrics import METRICS, add_metrics_arguments, start_from_args
+from face_pipeline import DETECTION_MAX_SIDE, iter_image_paths, match_to_dict
+from face_shard import LocalShards, ShardedGallery, add_shard_arguments, parse_address
+from face_workers import ENGINES, EncodingPool, analyze_in_worker
+
+CSV_COLUMNS = ['path', 'face', 'top', 'right', 'bottom', 'left', 'name', 'category', 'distance',
+               'status', 'age', 'crime', 'last_crime_date', 'possibility_of_committing_crime',
+               'case_number', 'decode_ms', 'convert_ms', 'resize_ms', 'detect_ms', 'encode_ms', 'match_ms', 'total_ms', 'error']
+
+
+class ResultWriter:
+    """Writes one JSON object per image (.jsonl) or one CSV row per face (.csv)."""
+
+    def __init__(self, file, fmt):
+        self.file = file
+        self.fmt = fmt
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS, extrasaction='ignore')
+            self.writer.writeheader()
+
+    def write(self, record):
+        if self.fmt == 'jsonl':
+            self.file.write(json.dumps(record) + "\n")
+            return
+        timings = {f"{stage}_ms": value for stage, value in record['timings_ms'].items()}
+        base = {'path': record['path'], 'error': record['error'], **timings}
+        if not record['faces']:
+            self.writer.writerow(base)
+        for number, face in enumerate(record['faces']):
+            top, right, bottom, left = face['box']
+            self.writer.writerow({**base, 'face': number, 'top': top, 'right': right,
+                                  'bottom': bottom, 'left': left, **face['match']})
+
+
+def read_file_list(path):
+    with open(path, mode='r') as file:
+        for line in file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def recognize(gallery, paths, pool, max_side=DETECTION_MAX_SIDE, retry=True, cache=None):
+    # Workers decode/detect/encode, this process only matches; the pool keeps
+    # a bounded number of images in flight so memory stays flat
+    for faces in pool.map(paths, partial(analyze_in_worker, max_side=max_side, retry=retry)):
+        start = time.perf_counter()
+        if not len(faces.encodings):
+            matches = []
+        elif cache is not None:
+            # The same people tend to recur across a dump, skip their gallery scans
+            matches = cache.match_batch(gallery, faces.encodings)
+        else:
+            matches = gallery.match_batch(faces.encodings)
+        timings = dict(faces.timings, match=time.perf_counter() - start)
+        timings['total'] = sum(timings.values())
+        METRICS.observe_timings(timings)
+        METRICS.record_image(len(matches))
+        METRICS.record_matches(matches)
+        if faces.error:
+            METRICS.count('errors')
+        yield {
+            'path': faces.path,
+            'faces': [{'box': list(location), 'match': match_to_dict(match)}
+                      for location, match in zip(faces.locations, matches)],
+            'timings_ms': {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+            'error': faces.error,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recognize faces in a directory of images without the GUI")
+    parser.add_argument('inputs', nargs='*', help="Image files or directories")
+    parser.add_argument('--file-list', help="Text file with one image path per line")
+    add_gallery_arguments(parser)
+    parser.add_argument('--index', choices=sorted(INDEX_TYPES), help="Search the gallery through an index")
+    parser.add_argument('--on-disk', action='store_true',
+                        help="Leave compiled gallery encodings on disk, only the index is kept in memory "
+                             "(use with --index int8/float16)")
+    add_shard_arguments(parser)
+    parser.add_argument('-o', '--output', default='-', help="Output .jsonl or .csv file (default: JSONL on stdout)")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help="Output format (default: from --output extension)")
+    parser.add_argument('--detect-max-side', type=int, default=DETECTION_MAX_SIDE,
+                        help="Detect on a copy no larger than this (0 = full resolution)")
+    parser.add_argument('--no-retry', action='store_true',
+                        help="Do not retry at higher resolution when no face is found")
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help="Identity cache entries (default: 0 = off). A face within "
+                             f"{DEFAULT_RADIUS} of a cached one reuses its decision, so results are approximate")
+    parser.add_argument('--workers', type=int, help="Detection/encoding workers (default: one per core)")
+    parser.add_argument('--engine', choices=ENGINES, default='process', help="Run workers as processes or threads")
+    parser.add_argument('--prefetch', type=int, help="Images in flight ahead of the matcher (default: 2 per worker)")
+    parser.add_argument('--progress', type=int, default=100, help="Report throughput every N images (0 = off)")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.inputs and not args.file_list:
+        parser.error("Give image files/directories or --file-list")
+    if args.on_disk and not args.index:
+        parser.error("--on-disk needs an --index")
+
+    fmt = args.format or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+    paths = iter_image_paths(args.inputs)
+    if args.file_list:
+        paths = chain(paths, iter_image_paths(read_file_list(args.file_list)))
+
+    start = time.perf_counter()
+    local_shards = None
+    if args.shard_addr:
+        gallery = ShardedGallery([parse_address(address) for address in args.shard_addr])
+        source = f"{len(args.shard_addr)} shards"
+    else:
+        location = resolve_from_args(args, scan_home=False)
+        if location is None:
+            parser.error("Gallery files not found, use --gallery-dir or --criminal/--non-criminal")
+        source = location.source
+        if args.local_shards:
+            local_shards = LocalShards(location.criminal, location.non_criminal, args.local_shards,
+                                       index_kind=args.index, resident=not args.on_disk)
+            gallery = ShardedGallery(local_shards.addresses)
+            source += f", {args.local_shards} local shards"
+        else:
+            gallery = FaceGallery.from_files(location.criminal, location.non_criminal, index_kind=args.index,
+                                             resident=not args.on_disk)
+    print(f"Gallery: {len(gallery)} faces from {source} loaded in {time.perf_counter() - start:.2f}s",
+          file=sys.stderr)
+
+    cache = IdentityCache(args.cache_size) if args.cache_size else None
+    if cache is not None:
+        print(f"Identity cache on: faces within {cache.radius} of a cached face reuse its decision, "
+              f"results may differ from an uncached run", file=sys.stderr)
+    stop_metrics = start_from_args(args)
+    METRICS.gauge('gallery_size', len(gallery))
+    output = sys.stdout if args.output == '-' else open(args.output, mode='w', newline='')
+    images = faces = errors = 0
+    start = time.perf_counter()
+    try:
+        writer = ResultWriter(output, fmt)
+        with EncodingPool(args.workers, args.prefetch, args.engine) as pool:
+            print(f"Workers: {pool.workers} ({args.engine})", file=sys.stderr)
+            for record in recognize(gallery, paths, pool, args.detect_max_side, not args.no_retry, cache):
+                writer.write(record)
+                images += 1
+                faces += len(record['faces'])
+                errors += record['error'] is not None
+                if args.progress and images % args.progress == 0:
+                    elapsed = time.perf_counter() - start
+                    print(f"{images} images, {images / elapsed:.2f} images/sec", file=sys.stderr)
+    finally:
+        stop_metrics()
+        if local_shards is not None:
+            local_shards.close()
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{images} images ({faces} faces, {errors} errors) in {elapsed:.2f}s", file=sys.stderr)
+    if cache is not None:
+        print(f"Identity cache: {json.dumps(cache.stats())}", file=sys.stderr)
+    print(f"Throughput: {images / elapsed if elapsed else 0.0:.2f} images/sec", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import os
+import sys
+import csv
+import json
+import time
+import platform
+import argparse
+import tempfile
+import functools
+import numpy as np
+import face_recognition
+from face_gallery import ENCODING_SIZE, compile_gallery, load_encodings, load_encodings_from_csv
+from face_matcher import MATCH_THRESHOLD, CRIMINAL, NON_CRIMINAL, FaceGallery
+from face_pipeline import DETECTION_MAX_SIDE, iter_image_paths, read_image_rgb, detect_faces
+from face_workers import EncodingPool, analyze_in_worker
+
+# Results are {name: {'value', 'unit', 'higher_is_better'}}; names encode the
+# benchmark and the gallery size so runs with other --sizes still compare
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+DEFAULT_CSV_SIZES = [100, 1000, 10000]
+DEFAULT_TOLERANCE = 0.2
+
+
+def measure(fn, min_time=0.2, min_runs=3, max_runs=1000):
+    # Median seconds per call, repeating until min_time has passed
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_runs or (time.perf_counter() - start < min_time and len(times) < max_runs):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def synthetic_encodings(size, seed=0):
+    # Random 128-d vectors spread like dlib encodings; random probes are
+    # unknown faces, the worst case for the criminal-first search
+    rng = np.random.default_rng(seed)
+    return rng.normal(0.0, 0.1, (size, ENCODING_SIZE)).astype(np.float32)
+
+
+def synthetic_sources(size, seed=0):
+    encodings = synthetic_encodings(size, seed)
+    half = size // 2
+    names = [f"person {i}" for i in range(size)]
+    data = [[name, "", "Unknown"] for name in names]
+    return [(CRIMINAL, encodings[:half], names[:half], data[:half]),
+            (NON_CRIMINAL, encodings[half:], names[half:], data[half:])]
+
+
+def write_synthetic_csv(path, size, seed=0):
+    with open(path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Name', 'encoding', 'Status'])
+        for i, encoding in enumerate(synthetic_encodings(size, seed)):
+            writer.writerow([f"person {i}", ",".join(repr(float(value)) for value in encoding), "Unknown"])
+
+
+def result(value, unit, higher_is_better=False):
+    return {'value': round(value, 6), 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def legacy_load_encodings_from_csv(file_path):
+    # The app's original loader, kept as the baseline: one float64 array per
+    # row, parsed value by value
+    encodings = []
+    names = []
+    data = []
+    with open(file_path, mode='r') as file:
+        reader = csv.reader(file)
+        next(reader)  # Skip header
+        for row in reader:
+            encodings.append(np.array([float(val) for val in row[1].split(',')]))
+            names.append(row[0])
+            data.append(row)
+    return encodings, names, data
+
+
+def bench_csv_load(sizes, workdir):
+    results = {}
+    for size in sizes:
+        csv_path = os.path.join(workdir, f"gallery_{size}.csv")
+        write_synthetic_csv(csv_path, size)
+        results[f"csv_load/legacy/{size}"] = result(
+            measure(lambda: legacy_load_encodings_from_csv(csv_path), 0) * 1000, 'ms')
+        results[f"csv_load/chunked/{size}"] = result(measure(lambda: load_encodings_from_csv(csv_path), 0) * 1000, 'ms')
+        compile_gallery(csv_path)
+        results[f"csv_load/compiled/{size}"] = result(measure(lambda: load_encodings(csv_path)) * 1000, 'ms')
+    return results
+
+
+def legacy_process_face(criminal, non_criminal, probe):
+    # What process_face did before FaceGallery: face_distance over Python
+    # lists of encodings, criminals first
+    distances = face_recognition.face_distance(criminal, probe)
+    if len(distances) and np.min(distances) < MATCH_THRESHOLD:
+        return int(np.argmin(distances))
+    distances = face_recognition.face_distance(non_criminal, probe)
+    if len(distances) and np.min(distances) < MATCH_THRESHOLD:
+        return int(np.argmin(distances))
+    return None
+
+
+def bench_matching(sizes, legacy_max, batch=16):
+    results = {}
+    probes = synthetic_encodings(batch, seed=1)
+    for size in sizes:
+        sources = synthetic_sources(size)
+        gallery = FaceGallery(sources)
+        results[f"match/gallery/{size}"] = result(measure(lambda: gallery.match(probes[0])) * 1000, 'ms')
+        per_probe = measure(lambda: gallery.match_batch(probes)) / batch
+        results[f"match/gallery_batch{batch}/{size}"] = result(per_probe * 1000, 'ms')
+        if size <= legacy_max:
+            # float64 arrays in lists, as the app originally loaded the CSVs
+            criminal = list(sources[0][1].astype(np.float64))
+            non_criminal = list(sources[1][1].astype(np.float64))
+            seconds = measure(lambda: legacy_process_face(criminal, non_criminal, probes[0].astype(np.float64)))
+            results[f"match/legacy/{size}"] = result(seconds * 1000, 'ms')
+        del gallery, sources
+    return results
+
+
+def bench_detection(images, max_side):
+    # Per-image detection and encoding on the sample images, in-process
+    detect, encode = [], []
+    for path in images:
+        img_rgb = read_image_rgb(path)
+        if img_rgb is None:
+            continue
+        detect.append(measure(lambda: detect_faces(img_rgb, max_side), 0, 1))
+        locations = detect_faces(img_rgb, max_side)
+        encode.append(measure(lambda: face_recognition.face_encodings(img_rgb, locations), 0, 1))
+    if not detect:
+        return {}
+    return {'detect/ms_per_image': result(float(np.mean(detect)) * 1000, 'ms'),
+            'encode/ms_per_image': result(float(np.mean(encode)) * 1000, 'ms')}
+
+
+def bench_end_to_end(images, max_side, workers, gallery_size, min_images=50):
+    # Decode, detect, encode in the worker pool and match in this process
+    gallery = FaceGallery(synthetic_sources(gallery_size))
+    paths = (images * (min_images // len(images) + 1))[:max(min_images, len(images))]
+    analyze = functools.partial(analyze_in_worker, max_side=max_side)
+    with EncodingPool(workers) as pool:
+        # Workers start lazily and load the dlib models on their first image;
+        # keep that out of the throughput by warming every worker first
+        list(pool.map(images[:1] * pool.workers, analyze))
+        start = time.perf_counter()
+        for faces in pool.map(paths, analyze):
+            if len(faces.encodings):
+                gallery.match_batch(faces.encodings)
+        elapsed = time.perf_counter() - start
+    return {f"end_to_end/images_per_sec/{pool.workers}_workers":
+            result(len(paths) / elapsed, 'images/s', higher_is_better=True)}
+
+
+def compare(results, baseline, tolerance):
+    # [(name, baseline value, value, relative change, status)]; status is
+    # 'regression' when a result is worse than the baseline by more than tolerance
+    rows = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            rows.append((name, None, current['value'], None, 'new'))
+            continue
+        change = (current['value'] - previous['value']) / previous['value'] if previous['value'] else 0.0
+        worse = -change if current['higher_is_better'] else change
+        status = 'regression' if worse > tolerance else 'improved' if worse < -tolerance else 'ok'
+        rows.append((name, previous['value'], current['value'], change, status))
+    return rows
+
+
+def print_comparison(rows, file=sys.stdout):
+    print(f"{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>8}  status", file=file)
+    for name, previous, value, change, status in rows:
+        previous = f"{previous:.4f}" if previous is not None else "-"
+        change = f"{change * 100:+.1f}%" if change is not None else "-"
+        print(f"{name:<40} {previous:>12} {value:>12.4f} {change:>8}  {status}", file=file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gallery loading, matching, detection and end-to-end")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Synthetic gallery sizes for matching (default: 100 to 100000, "
+                             "add 1000000 for the largest galleries)")
+    parser.add_argument('--csv-sizes', type=int, nargs='*', default=DEFAULT_CSV_SIZES,
+                        help="Synthetic gallery sizes for CSV loading")
+    parser.add_argument('--legacy-max', type=int, default=100000,
+                        help="Largest gallery the face_distance baseline is run on")
+    parser.add_argument('--images', nargs='*', default=[],
+                        help="Sample images/directories for detection and end-to-end (skipped without)")
+    parser.add_argument('--detect-max-side', type=int, default=DETECTION_MAX_SIDE)
+    parser.add_argument('--workers', type=int, help="End-to-end workers (default: one per core)")
+    parser.add_argument('-o', '--output', default='bench_results.json', help="Where to write the results")
+    parser.add_argument('--baseline', help="Baseline results to compare against")
+    parser.add_argument('--save-baseline', help="Also write the results as a new baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown relative to the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        results.update(bench_csv_load(args.csv_sizes, workdir))
+    results.update(bench_matching(args.sizes, args.legacy_max))
+    images = list(iter_image_paths(args.images))
+    if images:
+        results.update(bench_detection(images, args.detect_max_side))
+        results.update(bench_end_to_end(images, args.detect_max_side, args.workers, min(args.sizes)))
+    else:
+        print("No --images given, skipping detection and end-to-end", file=sys.stderr)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, mode='w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, mode='r', encoding='utf-8') as file:
+            baseline = json.load(file)['results']
+    rows = compare(results, baseline, args.tolerance)
+    print_comparison(rows)
+    regressions = [row[0] for row in rows if row[4] == 'regression']
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}: {', '.join(regressions)}",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
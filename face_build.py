@@ -0,0 +1,242 @@
+import os
+import csv
+import sys
+import json
+import time
+import hashlib
+import argparse
+from functools import partial
+import numpy as np
+from face_enroll import build_row, check_faces
+from face_gallery import DELTA_SUFFIX, ENCODING_SIZE, gallery_paths, gallery_prefix, read_header, save_gallery
+from face_pipeline import DETECTION_MAX_SIDE, IMAGE_EXTENSIONS
+from face_workers import ENGINES, EncodingPool, analyze_in_worker
+
+# Header of a gallery built without --like, the Non-Criminal_faces.csv layout
+DEFAULT_HEADER = ['Name', 'encoding', 'Status']
+CHECKPOINT_SUFFIX = ".build.jsonl"
+
+
+def walk_labeled_tree(root):
+    # (label, path) for every image under root/<label>/..., in sorted order
+    for label in sorted(os.listdir(root)):
+        directory = os.path.join(root, label)
+        if not os.path.isdir(directory):
+            continue
+        for dirpath, dirs, files in os.walk(directory):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield label, os.path.join(dirpath, filename)
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, mode='rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildCheckpoint:
+    """Append-only log of every image encoded so far, keyed by content hash.
+
+    A crashed or interrupted build resumes from it, a rebuild only encodes
+    images it has not seen. Path, size and mtime are logged with the hash
+    so unchanged files are not even re-read.
+    """
+
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.results = {}   # sha1 -> (encoding or None, error)
+        self.hashes = {}    # (path, size, mtime_ns) -> sha1
+        if fresh and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            with open(path, mode='r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # last line of a crashed run
+                    self.results[entry['sha1']] = (entry['encoding'], entry['error'])
+                    self.hashes[(entry['path'], entry['size'], entry['mtime_ns'])] = entry['sha1']
+        self.file = open(path, mode='a', encoding='utf-8')
+        if self.file.tell() and not self._ends_with_newline():
+            self.file.write("\n")
+
+    def _ends_with_newline(self):
+        with open(self.path, mode='rb') as file:
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b"\n"
+
+    def __len__(self):
+        return len(self.results)
+
+    def digest(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            self.hashes[key] = file_digest(path)
+        return self.hashes[key]
+
+    def record(self, path, sha1, faces):
+        error = check_faces(faces)
+        encoding = None if error else [float(value) for value in faces.encodings[0]]
+        stat = os.stat(path)
+        self.file.write(json.dumps({'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                    'sha1': sha1, 'encoding': encoding, 'error': error}) + "\n")
+        self.results[sha1] = (encoding, error)
+        return error
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class BuildProgress:
+    def __init__(self, total, every):
+        self.total = total
+        self.every = every
+        self.start = time.perf_counter()
+        self.counts = dict.fromkeys(['encoded', 'cached', 'rejected', 'unreadable'], 0)
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def add(self, outcome):
+        self.counts[outcome] += 1
+        if self.every and self.done % self.every == 0:
+            print(self.line(), file=sys.stderr)
+
+    def line(self):
+        elapsed = time.perf_counter() - self.start
+        # Throughput of the pool, cached images cost next to nothing
+        rate = (self.counts['encoded'] + self.counts['rejected']) / elapsed if elapsed else 0.0
+        remaining = self.total - self.done
+        eta = f", ETA {remaining / rate:.0f}s" if rate and remaining else ""
+        counts = ", ".join(f"{value} {key}" for key, value in self.counts.items())
+        return f"{self.done}/{self.total} images ({counts}), {rate:.2f} images/sec{eta}"
+
+
+def read_metadata(path):
+    # Extra gallery columns per label, from a CSV whose first column is the name
+    with open(path, mode='r', newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader)
+        return {row[0]: dict(zip(header[1:], row[1:])) for row in reader if row}
+
+
+def encode_tree(images, pool, checkpoint, progress, max_side=DETECTION_MAX_SIDE, retry=True, flush_every=100):
+    # Encode every image the checkpoint does not know yet, returns path -> sha1
+    digests = {}
+
+    def pending():
+        submitted = set()
+        for _, path in images:
+            try:
+                digest = checkpoint.digest(path)
+            except OSError as e:
+                print(f"{path}: {e}", file=sys.stderr)
+                progress.add('unreadable')
+                continue
+            digests[path] = digest
+            if digest in checkpoint.results or digest in submitted:
+                # Already encoded, possibly under another path
+                progress.add('cached')
+                continue
+            submitted.add(digest)
+            yield path
+
+    analyze = partial(analyze_in_worker, max_side=max_side, retry=retry)
+    for number, faces in enumerate(pool.map(pending(), analyze), 1):
+        error = checkpoint.record(faces.path, digests[faces.path], faces)
+        progress.add('rejected' if error else 'encoded')
+        if number % flush_every == 0:
+            checkpoint.flush()
+    checkpoint.flush()
+    return digests
+
+
+def assemble_gallery(images, digests, checkpoint, header, encoding_column, metadata):
+    # (encodings, rows) in tree order, one row per distinct image of a label
+    encodings, rows, seen = [], [], set()
+    for label, path in images:
+        digest = digests.get(path)
+        encoding, _ = checkpoint.results.get(digest, (None, None))
+        if encoding is None or (label, digest) in seen:
+            continue
+        seen.add((label, digest))
+        encodings.append(encoding)
+        rows.append(build_row(header, encoding_column, label, (), metadata.get(label)))
+    matrix = np.array(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    return matrix, rows
+
+
+def write_csv(path, header, encoding_column, encodings, rows):
+    # Same layout as Criminal_faces.csv, readable by load_encodings_from_csv
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for encoding, row in zip(encodings, rows):
+            row = list(row)
+            row[encoding_column] = ",".join(repr(float(value)) for value in encoding)
+            writer.writerow(row)
+    os.replace(tmp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a gallery from a tree of <name>/<image> folders")
+    parser.add_argument('root', help="Directory with one sub-directory of images per person")
+    parser.add_argument('output', help="Gallery to write, e.g. Criminal_faces (compiled .npy/.meta.json)")
+    parser.add_argument('--csv', action='store_true', help="Also write <output>.csv")
+    parser.add_argument('--like', help="Existing gallery whose columns the new one should have")
+    parser.add_argument('--metadata', help="CSV of extra columns per person, first column is the name")
+    parser.add_argument('--checkpoint', help=f"Checkpoint file (default: <output>{CHECKPOINT_SUFFIX})")
+    parser.add_argument('--fresh', action='store_true', help="Ignore the checkpoint and encode everything")
+    parser.add_argument('--detect-max-side', type=int, default=DETECTION_MAX_SIDE,
+                        help="Detect on a copy no larger than this (0 = full resolution)")
+    parser.add_argument('--workers', type=int, help="Detection/encoding workers (default: one per core)")
+    parser.add_argument('--engine', choices=ENGINES, default='process', help="Run workers as processes or threads")
+    parser.add_argument('--progress', type=int, default=500, help="Report progress every N images (0 = off)")
+    args = parser.parse_args()
+
+    prefix = gallery_prefix(args.output)
+    header, encoding_column = read_header(args.like) if args.like else (DEFAULT_HEADER, 1)
+    metadata = read_metadata(args.metadata) if args.metadata else {}
+
+    images = list(walk_labeled_tree(args.root))
+    checkpoint = BuildCheckpoint(args.checkpoint or prefix + CHECKPOINT_SUFFIX, args.fresh)
+    print(f"{len(images)} images of {len({label for label, _ in images})} people, "
+          f"{len(checkpoint)} already in {checkpoint.path}", file=sys.stderr)
+
+    progress = BuildProgress(len(images), args.progress)
+    try:
+        with EncodingPool(args.workers, engine=args.engine) as pool:
+            print(f"Workers: {pool.workers} ({args.engine})", file=sys.stderr)
+            digests = encode_tree(images, pool, checkpoint, progress, args.detect_max_side)
+    except KeyboardInterrupt:
+        print(f"Interrupted, {progress.line()}; run again to resume", file=sys.stderr)
+        sys.exit(130)
+    finally:
+        checkpoint.close()
+    print(progress.line(), file=sys.stderr)
+
+    encodings, rows = assemble_gallery(images, digests, checkpoint, header, encoding_column, metadata)
+    columns = [[row[col] for row in rows] for col in range(len(header))]
+    if args.csv:
+        # CSV before the compiled files, a newer CSV would make them look stale
+        write_csv(prefix + '.csv', header, encoding_column, encodings, rows)
+    save_gallery(prefix, encodings, header, columns, encoding_column)
+    matrix_path, meta_path = gallery_paths(prefix)
+    print(f"{len(rows)} faces of {len({row[0] for row in rows})} people -> {matrix_path}, {meta_path}")
+    if os.path.exists(prefix + DELTA_SUFFIX):
+        print(f"Note: {prefix + DELTA_SUFFIX} still holds enrolled faces and is applied on top", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import time
+from collections import OrderedDict
+import numpy as np
+from face_gallery import ENCODING_SIZE
+
+DEFAULT_RADIUS = 0.05  # a probe this close to a cached one reuses its decision
+
+
+class IdentityCache:
+    """Bounded LRU/TTL cache of recent match results.
+
+    Results are keyed by track id (video) and by encoding. An encoding
+    hits when it lies within `radius` of a cached one: the one stored
+    under the same quantized key is tried first, otherwise one GEMV over
+    at most `max_size` rows finds the nearest instead of a scan of the
+    gallery.
+    Everything is dropped as soon as the gallery version changes. Keep
+    radius small next to the match threshold: a hit reuses the decision
+    made for a probe up to radius away.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, radius=DEFAULT_RADIUS, step=0.01):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.radius = radius
+        self.step = step
+        self.gallery_version = None
+
+        # Slot storage for the radius check, slots are reused on eviction
+        self._encodings = np.zeros((max_size, ENCODING_SIZE), dtype=np.float32)
+        self._valid = np.zeros(max_size, dtype=bool)
+        self._slots = [None] * max_size   # slot -> (key, match, stored_at)
+        self._by_key = OrderedDict()      # key -> slot, least recently used first
+        self._tracks = OrderedDict()      # track id -> (match, stored_at)
+
+        self.counts = dict.fromkeys(['exact_hits', 'radius_hits', 'misses', 'track_hits',
+                                     'track_misses', 'evictions', 'invalidations'], 0)
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def key(self, encoding):
+        return np.floor(np.asarray(encoding, dtype=np.float32) / self.step).astype(np.int32).tobytes()
+
+    def _fresh(self, stored_at):
+        return self.ttl is None or time.monotonic() - stored_at <= self.ttl
+
+    def bind(self, gallery):
+        # Invalidate when the gallery has been reloaded or modified
+        if gallery.version != self.gallery_version:
+            if self.gallery_version is not None:
+                self.invalidate()
+            self.gallery_version = gallery.version
+
+    def invalidate(self):
+        self._valid[:] = False
+        self._slots = [None] * self.max_size
+        self._by_key.clear()
+        self._tracks.clear()
+        self.counts['invalidations'] += 1
+
+    def _drop_slot(self, slot):
+        key = self._slots[slot][0]
+        self._by_key.pop(key, None)
+        self._slots[slot] = None
+        self._valid[slot] = False
+
+    def lookup(self, encoding):
+        # Cached Match for an encoding, or None
+        key = self.key(encoding)
+        probe = np.asarray(encoding, dtype=np.float32)
+        slot = self._by_key.get(key)
+        if slot is not None:
+            if not self._fresh(self._slots[slot][2]):
+                self._drop_slot(slot)
+            else:
+                # A cell is step * sqrt(128) wide, far more than radius, so
+                # the same key alone does not mean the same face
+                diff = self._encodings[slot] - probe
+                if np.dot(diff, diff) <= self.radius * self.radius:
+                    self._by_key.move_to_end(key)
+                    self.counts['exact_hits'] += 1
+                    return self._slots[slot][1]
+
+        if self._valid.any():
+            diff = self._encodings - probe
+            dists = np.einsum('ij,ij->i', diff, diff)
+            dists[~self._valid] = np.inf
+            slot = int(np.argmin(dists))
+            if dists[slot] <= self.radius * self.radius:
+                if self._fresh(self._slots[slot][2]):
+                    self._by_key.move_to_end(self._slots[slot][0])
+                    self.counts['radius_hits'] += 1
+                    return self._slots[slot][1]
+                self._drop_slot(slot)
+
+        self.counts['misses'] += 1
+        return None
+
+    def store(self, encoding, match):
+        key = self.key(encoding)
+        slot = self._by_key.pop(key, None)
+        if slot is None:
+            if len(self._by_key) >= self.max_size:
+                _, slot = self._by_key.popitem(last=False)
+                self.counts['evictions'] += 1
+            else:
+                slot = int(np.argmin(self._valid))
+        self._encodings[slot] = encoding
+        self._valid[slot] = True
+        self._slots[slot] = (key, match, time.monotonic())
+        self._by_key[key] = slot
+
+    def lookup_track(self, track_id):
+        entry = self._tracks.get(track_id)
+        if entry is not None and self._fresh(entry[1]):
+            self._tracks.move_to_end(track_id)
+            self.counts['track_hits'] += 1
+            return entry[0]
+        self._tracks.pop(track_id, None)
+        self.counts['track_misses'] += 1
+        return None
+
+    def store_track(self, track_id, match):
+        self._tracks[track_id] = (match, time.monotonic())
+        self._tracks.move_to_end(track_id)
+        while len(self._tracks) > self.max_size:
+            self._tracks.popitem(last=False)
+            self.counts['evictions'] += 1
+
+    def match_batch(self, gallery, encodings):
+        # gallery.match_batch, but only for the encodings not cached yet
+        self.bind(gallery)
+        matches = [self.lookup(encoding) for encoding in encodings]
+        missing = [i for i, match in enumerate(matches) if match is None]
+        if missing:
+            for i, match in zip(missing, gallery.match_batch([encodings[i] for i in missing])):
+                matches[i] = match
+                self.store(encodings[i], match)
+        return matches
+
+    def stats(self):
+        counts = dict(self.counts)
+        hits = counts['exact_hits'] + counts['radius_hits']
+        lookups = hits + counts['misses']
+        track_lookups = counts['track_hits'] + counts['track_misses']
+        counts['size'] = len(self)
+        counts['hit_rate'] = round(hits / lookups, 4) if lookups else 0.0
+        counts['track_hit_rate'] = round(counts['track_hits'] / track_lookups, 4) if track_lookups else 0.0
+        return counts
@@ -0,0 +1,134 @@
+import os
+import json
+from collections import namedtuple
+from face_gallery import MATRIX_SUFFIX, META_SUFFIX
+
+# Where the gallery files are looked up, first match wins:
+#   1. command line (--criminal/--non-criminal or --gallery-dir)
+#   2. environment (FACE_CRIMINAL_GALLERY/FACE_NON_CRIMINAL_GALLERY or FACE_GALLERY_DIR)
+#   3. config file (FACE_CONFIG or ~/.face_recognition.json)
+#   4. the location resolved by the previous run (cache)
+#   5. the application directory and the working directory
+#   6. a scan of the home directory, only if everything above failed
+ENV_CRIMINAL = "FACE_CRIMINAL_GALLERY"
+ENV_NON_CRIMINAL = "FACE_NON_CRIMINAL_GALLERY"
+ENV_GALLERY_DIR = "FACE_GALLERY_DIR"
+ENV_CONFIG = "FACE_CONFIG"
+CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".face_recognition.json")
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "face_recognition", "gallery_paths.json")
+
+GalleryLocation = namedtuple('GalleryLocation', ['criminal', 'non_criminal', 'source'])
+
+
+def _gallery_kind(filename):
+    # 'criminal', 'non_criminal' or None for a gallery file name
+    name = filename.lower()
+    if not name.endswith(('.csv', MATRIX_SUFFIX)) or name.endswith(META_SUFFIX):
+        return None
+    if 'non-criminal' in name:
+        return 'non_criminal'
+    if 'criminal' in name:
+        return 'criminal'
+    return None
+
+
+# Function to search for CSV files
+def find_csv_files(directory):
+    # Deterministic walk (sorted, first match wins) that stops as soon as
+    # both files are found
+    found = {}
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            kind = _gallery_kind(filename)
+            if filename.lower().endswith('.csv') and kind and kind not in found:
+                found[kind] = os.path.join(root, filename)
+        if len(found) == 2:
+            break
+    return found.get('non_criminal'), found.get('criminal')
+
+
+def find_gallery_files(directory):
+    # Non-recursive lookup, a CSV wins over a compiled-only gallery
+    found = {}
+    try:
+        filenames = sorted(os.listdir(directory), key=lambda f: (not f.lower().endswith('.csv'), f))
+    except OSError:
+        return None, None
+    for filename in filenames:
+        kind = _gallery_kind(filename)
+        if kind and kind not in found:
+            found[kind] = os.path.join(directory, filename)
+    return found.get('criminal'), found.get('non_criminal')
+
+
+def _complete(criminal, non_criminal):
+    return bool(criminal and non_criminal and os.path.exists(criminal) and os.path.exists(non_criminal))
+
+
+def _read_json(path):
+    try:
+        with open(path, mode='r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _candidates(criminal, non_criminal, gallery_dir, config_path):
+    yield 'command line', criminal, non_criminal, gallery_dir
+    yield 'environment', os.environ.get(ENV_CRIMINAL), os.environ.get(ENV_NON_CRIMINAL), os.environ.get(ENV_GALLERY_DIR)
+
+    config = _read_json(config_path or os.environ.get(ENV_CONFIG) or CONFIG_PATH)
+    yield 'config file', config.get('criminal'), config.get('non_criminal'), config.get('gallery_dir')
+
+    cache = _read_json(CACHE_PATH)
+    yield 'cache', cache.get('criminal'), cache.get('non_criminal'), None
+
+    yield 'application directory', None, None, os.path.dirname(os.path.abspath(__file__))
+    yield 'working directory', None, None, os.getcwd()
+
+
+def save_cached_location(location):
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp_path = CACHE_PATH + ".tmp"
+        with open(tmp_path, mode='w', encoding='utf-8') as file:
+            json.dump({'criminal': location.criminal, 'non_criminal': location.non_criminal}, file)
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError as e:
+        print(f"Error caching gallery location: {e}")
+
+
+def resolve_gallery_paths(criminal=None, non_criminal=None, gallery_dir=None, config_path=None, scan_home=True):
+    # GalleryLocation of the first complete criminal/non-criminal pair, or None
+    location = None
+    for source, criminal_path, non_criminal_path, directory in _candidates(criminal, non_criminal,
+                                                                           gallery_dir, config_path):
+        if _complete(criminal_path, non_criminal_path):
+            location = GalleryLocation(os.path.abspath(criminal_path), os.path.abspath(non_criminal_path), source)
+            break
+        if directory:
+            found = find_gallery_files(os.path.expanduser(directory))
+            if _complete(*found):
+                location = GalleryLocation(*[os.path.abspath(path) for path in found], source)
+                break
+
+    if location is None and scan_home:
+        non_criminal_file, criminal_file = find_csv_files(os.path.expanduser("~"))
+        if _complete(criminal_file, non_criminal_file):
+            location = GalleryLocation(criminal_file, non_criminal_file, 'home scan')
+
+    if location is not None and location.source != 'cache':
+        save_cached_location(location)
+    return location
+
+
+def add_gallery_arguments(parser):
+    parser.add_argument('--criminal', help="Criminal gallery (CSV or compiled)")
+    parser.add_argument('--non-criminal', help="Non-criminal gallery (CSV or compiled)")
+    parser.add_argument('--gallery-dir', help="Directory holding both gallery files")
+    parser.add_argument('--config', help=f"JSON config file (default: {CONFIG_PATH})")
+
+
+def resolve_from_args(args, scan_home=True):
+    return resolve_gallery_paths(args.criminal, args.non_criminal, args.gallery_dir, args.config, scan_home)
@@ -0,0 +1,210 @@
+import os
+import csv
+import sys
+import time
+import argparse
+import threading
+from collections import namedtuple
+from functools import partial
+from face_config import add_gallery_arguments, resolve_from_args
+from face_gallery import append_delta, compact_gallery, delta_path, gallery_paths, gallery_prefix, read_header
+from face_matcher import CRIMINAL, NON_CRIMINAL, FaceGallery
+from face_metrics import METRICS
+from face_pipeline import DETECTION_MAX_SIDE
+from face_workers import ENGINES, EncodingPool, analyze_in_worker
+
+# One enrolled (or rejected) image; row is the CSV-style row that was appended
+Enrollment = namedtuple('Enrollment', ['name', 'image', 'row', 'error'])
+
+CATEGORY_NAMES = {'criminal': CRIMINAL, 'non-criminal': NON_CRIMINAL}
+
+
+def build_row(header, encoding_column, name, encoding, fields=None):
+    # CSV-style row in the gallery's own column order, fields are matched to
+    # header names case-insensitively and missing ones are left empty
+    fields = {key.lower(): value for key, value in (fields or {}).items()}
+    row = [str(fields.get(column.lower(), "")) if column else "" for column in header]
+    row[0] = name
+    row[encoding_column] = ",".join(repr(float(value)) for value in encoding)
+    return row
+
+
+def check_faces(faces):
+    # Error message for an image that cannot be enrolled, or None
+    if faces.error:
+        return faces.error
+    if len(faces.encodings) != 1:
+        return f"Expected exactly one face, found {len(faces.encodings)}"
+    return None
+
+
+def enroll(gallery_file, people, pool, max_side=DETECTION_MAX_SIDE, retry=True, batch_size=64):
+    # people: iterable of (name, image path, fields). Images are encoded in the
+    # pool and appended to the gallery's delta in batches; yields Enrollment
+    header, encoding_column = read_header(gallery_file)
+    people = list(people)
+    analyze = partial(analyze_in_worker, max_side=max_side, retry=retry)
+    pending = []
+    for (name, image, fields), faces in zip(people, pool.map([image for _, image, _ in people], analyze)):
+        error = check_faces(faces)
+        row = None if error else build_row(header, encoding_column, name, faces.encodings[0], fields)
+        if row is not None:
+            pending.append(row)
+        if len(pending) >= batch_size:
+            append_delta(gallery_file, pending)
+            pending = []
+        yield Enrollment(name, image, row, error)
+    append_delta(gallery_file, pending)
+
+
+def read_manifest(path):
+    # CSV with a name and an image column, any other column is a gallery field
+    with open(path, mode='r', newline='') as file:
+        for record in csv.DictReader(file):
+            record = {key.strip().lower(): (value or "").strip() for key, value in record.items() if key}
+            yield record.pop('name'), record.pop('image'), record
+
+
+class GalleryReloader:
+    """Keeps a FaceGallery current while the files behind it change.
+
+    Rows appended to the delta files are added to a new snapshot without
+    re-reading the base files; a rewritten base (compaction, edited CSV)
+    is reloaded in full once its files have stopped changing. Either way
+    the new snapshot replaces `gallery` in one assignment and listeners are
+    told about it; matching already running on the old one is not paused.
+    """
+
+    def __init__(self, criminal_file, non_criminal_file, interval=1.0, **gallery_params):
+        self.files = {CRIMINAL: criminal_file, NON_CRIMINAL: non_criminal_file}
+        self.interval = interval
+        self.gallery_params = gallery_params
+        self.listeners = []
+        self.reloads = 0
+        self.appended = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._signature = self._pending_signature = self.base_signature()
+        self.gallery = FaceGallery.from_files(criminal_file, non_criminal_file, **gallery_params)
+        METRICS.gauge('gallery_size', len(self.gallery))
+
+    def base_signature(self):
+        # Modification times of every file the base rows can come from
+        signature = []
+        for path in self.files.values():
+            prefix = gallery_prefix(path)
+            for source in gallery_paths(prefix) + (prefix + '.csv',):
+                try:
+                    signature.append(os.stat(source).st_mtime_ns)
+                except OSError:
+                    signature.append(None)
+        return tuple(signature)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def poll(self):
+        # Pick up changes now, returns the current snapshot
+        with self._lock:
+            current = self.gallery
+            signature = self.base_signature()
+            if signature != self._signature:
+                # Reload only once the base looks the same on two polls, so a
+                # gallery that is being rewritten is never read half-way
+                if signature == self._pending_signature:
+                    try:
+                        gallery = FaceGallery.from_files(*self.files.values(), **self.gallery_params)
+                        self._signature = signature
+                        self.reloads += 1
+                    except Exception as e:
+                        print(f"Error reloading gallery: {e}")
+                        gallery = current
+                else:
+                    gallery = current
+                self._pending_signature = signature
+            else:
+                gallery = current.apply_deltas(self.files)
+                self.appended += len(gallery) - len(current)
+
+            if gallery is not current:
+                self.gallery = gallery
+                METRICS.gauge('gallery_size', len(gallery))
+                METRICS.count('gallery_updates')
+                for listener in self.listeners:
+                    listener(gallery)
+            return gallery
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="gallery-reloader", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enroll faces into a gallery without rewriting it")
+    parser.add_argument('category', choices=sorted(CATEGORY_NAMES), help="Gallery to enroll into")
+    parser.add_argument('images', nargs='*', help="Images of the person given by --name, one face each")
+    parser.add_argument('--name', help="Name of the person in the images")
+    parser.add_argument('--field', action='append', default=[], metavar='COLUMN=VALUE',
+                        help="Gallery column for the enrolled rows, e.g. --field Status=Wanted")
+    parser.add_argument('--manifest', help="CSV with name, image and optional gallery columns, one row per image")
+    parser.add_argument('--compact', action='store_true',
+                        help="Afterwards fold all enrolled faces into the compiled gallery")
+    add_gallery_arguments(parser)
+    parser.add_argument('--detect-max-side', type=int, default=DETECTION_MAX_SIDE,
+                        help="Detect on a copy no larger than this (0 = full resolution)")
+    parser.add_argument('--workers', type=int, help="Detection/encoding workers (default: one per core)")
+    parser.add_argument('--engine', choices=ENGINES, default='process', help="Run workers as processes or threads")
+    args = parser.parse_args()
+
+    if args.images and not args.name:
+        parser.error("--name is required with images")
+    if not args.images and not args.manifest and not args.compact:
+        parser.error("Give images with --name, a --manifest, or --compact")
+    fields = {}
+    for field in args.field:
+        column, sep, value = field.partition('=')
+        if not sep:
+            parser.error(f"--field expects COLUMN=VALUE, got {field!r}")
+        fields[column] = value
+
+    location = resolve_from_args(args, scan_home=False)
+    if location is None:
+        parser.error("Gallery files not found, use --gallery-dir or --criminal/--non-criminal")
+    gallery_file = location.criminal if CATEGORY_NAMES[args.category] == CRIMINAL else location.non_criminal
+
+    people = [(args.name, image, fields) for image in args.images]
+    if args.manifest:
+        people.extend(read_manifest(args.manifest))
+
+    enrolled = rejected = 0
+    start = time.perf_counter()
+    if people:
+        with EncodingPool(args.workers, engine=args.engine) as pool:
+            for result in enroll(gallery_file, people, pool, args.detect_max_side):
+                if result.error:
+                    rejected += 1
+                    print(f"{result.image}: {result.error}", file=sys.stderr)
+                else:
+                    enrolled += 1
+        print(f"Enrolled {enrolled} faces ({rejected} rejected) into {delta_path(gallery_file)} "
+              f"in {time.perf_counter() - start:.2f}s")
+
+    if args.compact:
+        moved = compact_gallery(gallery_file)
+        print(f"Compacted {moved} enrolled faces into {gallery_paths(gallery_prefix(gallery_file))[0]}")
+    sys.exit(1 if rejected else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+import os
+import csv
+import json
+import argparse
+import warnings
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Every stored face is a 128-d dlib encoding
+ENCODING_SIZE = 128
+
+# Compiled gallery layout: "<prefix>.npy" holds a contiguous float32 N x 128
+# matrix, "<prefix>.meta.json" holds the remaining CSV columns column by column
+MATRIX_SUFFIX = ".npy"
+META_SUFFIX = ".meta.json"
+
+# Faces enrolled since the gallery was written go to an append-only
+# "<prefix>.delta.jsonl", one CSV-style row (a JSON list) per line
+DELTA_SUFFIX = ".delta.jsonl"
+
+# CSV rows parsed per chunk, bounds the memory a load needs on top of its result
+CSV_CHUNK_ROWS = 8192
+# Malformed CSV rows printed individually, the rest are only counted
+MAX_REPORTED_ERRORS = 10
+
+
+def gallery_paths(prefix):
+    return prefix + MATRIX_SUFFIX, prefix + META_SUFFIX
+
+
+def gallery_prefix(path):
+    # "Criminal_faces.csv", "Criminal_faces.npy" and "Criminal_faces" all
+    # refer to the same gallery
+    root, ext = os.path.splitext(path)
+    if ext.lower() in ('.csv', MATRIX_SUFFIX):
+        return root
+    for suffix in (META_SUFFIX, DELTA_SUFFIX):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def delta_path(path):
+    return gallery_prefix(path) + DELTA_SUFFIX
+
+
+def _parse_encoding(text):
+    with warnings.catch_warnings():
+        # fromstring only warns when it stops at a bad value
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            encoding = np.fromstring(text, dtype=np.float32, sep=',')
+        except (DeprecationWarning, ValueError):
+            return None
+    return encoding if encoding.size == ENCODING_SIZE else None
+
+
+def _parse_encodings(texts):
+    # K x 128 float32 matrix and the positions of the texts that are not 128
+    # numbers. The whole chunk is parsed by one fromstring call; rows are only
+    # parsed one by one when that fails, to find the bad ones
+    bad = [i for i, text in enumerate(texts) if text.count(',') != ENCODING_SIZE - 1]
+    if not bad:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = np.fromstring(",".join(texts), dtype=np.float32, sep=',')
+                if values.size == len(texts) * ENCODING_SIZE:
+                    return values.reshape(-1, ENCODING_SIZE), []
+            except (DeprecationWarning, ValueError):
+                pass
+    encodings = [_parse_encoding(text) for text in texts]
+    bad = [i for i, encoding in enumerate(encodings) if encoding is None]
+    good = [encoding for encoding in encodings if encoding is not None]
+    matrix = np.vstack(good) if good else np.empty((0, ENCODING_SIZE), np.float32)
+    return matrix, bad
+
+
+def iter_csv_chunks(file, encoding_column, chunk_rows=CSV_CHUNK_ROWS, errors=None, lines_read=1):
+    # (K x 128 float32 encodings, K CSV rows without their encoding) for every
+    # chunk of a gallery CSV positioned after its header, which took
+    # lines_read lines. Malformed rows are skipped and appended to errors as
+    # (line number in the file, message).
+    reader = csv.reader(file)
+    rows, texts, lines = [], [], []
+
+    def flush():
+        encodings, bad = _parse_encodings(texts)
+        if errors is not None:
+            errors.extend((lines[i], f"expected {ENCODING_SIZE} comma-separated numbers") for i in bad)
+        for i in reversed(bad):
+            del rows[i]
+        return encodings, rows
+
+    for row in reader:
+        if not row:
+            continue
+        if encoding_column >= len(row):
+            if errors is not None:
+                errors.append((lines_read + reader.line_num, "missing encoding column"))
+            continue
+        texts.append(row[encoding_column])
+        row[encoding_column] = ""
+        rows.append(row)
+        lines.append(lines_read + reader.line_num)
+        if len(rows) >= chunk_rows:
+            yield flush()
+            rows, texts, lines = [], [], []
+    if rows:
+        yield flush()
+
+
+def _append_columns(columns, rows, encoding_column):
+    for col, values in enumerate(columns):
+        if col != encoding_column:
+            values.extend(row[col] if col < len(row) else "" for row in rows)
+
+
+def report_csv_errors(path, errors):
+    errors = sorted(errors)
+    for line, message in errors[:MAX_REPORTED_ERRORS]:
+        print(f"Error loading encodings: {path} line {line}: {message}")
+    if len(errors) > MAX_REPORTED_ERRORS:
+        print(f"Error loading encodings: {path}: {len(errors) - MAX_REPORTED_ERRORS} more malformed rows skipped")
+
+
+def read_csv_gallery(csv_path, chunk_rows=CSV_CHUNK_ROWS, errors=None):
+    # Gallery parsed from a CSV in chunks into a growing float32 matrix, the
+    # other columns kept column by column as in the compiled format
+    with open(csv_path, mode='r', newline='') as file:
+        header_reader = csv.reader(file)
+        header = next(header_reader, None) or ['Name', 'encoding']
+        encoding_column = header.index('encoding') if 'encoding' in header else 1
+        columns = [[] for _ in header]
+        matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        count = 0
+        for encodings, rows in iter_csv_chunks(file, encoding_column, chunk_rows, errors, header_reader.line_num):
+            if count + len(encodings) > len(matrix):
+                # In-place realloc, no second copy of the rows read so far
+                matrix.resize((max(count + len(encodings), 2 * len(matrix)), ENCODING_SIZE), refcheck=False)
+            matrix[count:count + len(encodings)] = encodings
+            count += len(encodings)
+            _append_columns(columns, rows, encoding_column)
+    matrix.resize((count, ENCODING_SIZE), refcheck=False)
+    return Gallery(matrix, header, columns, encoding_column)
+
+
+# Load face encodings from CSV
+def load_encodings_from_csv(file_path):
+    # (N x 128 float32 encodings, names, rows) like a compiled gallery; rows
+    # that cannot be parsed are reported and skipped, the rest still loads
+    errors = []
+    try:
+        gallery = read_csv_gallery(file_path, errors=errors)
+    except Exception as e:
+        print(f"Error loading encodings: {e}")
+        return np.empty((0, ENCODING_SIZE), np.float32), [], []
+    report_csv_errors(file_path, errors)
+    return gallery.as_legacy()
+
+
+class GalleryRows:
+    """Read-only view that turns the columnar metadata back into CSV-style rows."""
+
+    def __init__(self, columns, encoding_column):
+        self.columns = columns
+        self.encoding_column = encoding_column
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        # The encoding itself lives in the matrix, keep its slot so that
+        # positional access like row[2] still lines up with the CSV header
+        return ["" if col == self.encoding_column else values[index]
+                for col, values in enumerate(self.columns)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Gallery:
+    def __init__(self, encodings, header, columns, encoding_column=1):
+        self.encodings = encodings
+        self.header = header
+        self.columns = columns
+        self.encoding_column = encoding_column
+        self.rows = GalleryRows(columns, encoding_column)
+
+    def __len__(self):
+        return self.encodings.shape[0]
+
+    @property
+    def names(self):
+        return self.columns[0]
+
+    def as_legacy(self):
+        # Same (encodings, names, data) triple as load_encodings_from_csv
+        return self.encodings, self.names, self.rows
+
+
+def _write_atomic(path, write):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as file:
+        write(file)
+    os.replace(tmp_path, path)
+
+
+def save_gallery(prefix, encodings, header, columns, encoding_column=1):
+    matrix_path, meta_path = gallery_paths(prefix)
+    encodings = np.ascontiguousarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    meta = {
+        'version': 1,
+        'count': int(encodings.shape[0]),
+        'dim': ENCODING_SIZE,
+        'header': header,
+        'encoding_column': encoding_column,
+        # Encoding column is stored as an empty list, the matrix holds it
+        'columns': [[] if col == encoding_column else list(values)
+                    for col, values in enumerate(columns)],
+    }
+    # Matrix first, metadata last: a gallery only becomes visible to
+    # find_compiled_gallery once both files are complete
+    _write_atomic(matrix_path, lambda f: np.save(f, encodings))
+    _write_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+
+
+def compile_gallery(csv_path, prefix=None, chunk_rows=CSV_CHUNK_ROWS, errors=None):
+    # Convert a Criminal_faces.csv / Non-Criminal_faces.csv style file into
+    # the compiled format, returns the prefix that was written. Encodings
+    # are streamed chunk by chunk to a raw file and copied into the .npy
+    # once the row count is known, so memory stays flat whatever the size.
+    if prefix is None:
+        prefix = gallery_prefix(csv_path)
+    matrix_path, meta_path = gallery_paths(prefix)
+    raw_path = matrix_path + ".raw"
+
+    try:
+        count = 0
+        with open(csv_path, mode='r', newline='') as file, open(raw_path, 'wb') as raw:
+            header_reader = csv.reader(file)
+            header = next(header_reader, None) or ['Name', 'encoding']
+            encoding_column = header.index('encoding') if 'encoding' in header else 1
+            columns = [[] for _ in header]
+            for encodings, rows in iter_csv_chunks(file, encoding_column, chunk_rows, errors,
+                                                   header_reader.line_num):
+                raw.write(encodings.tobytes())
+                count += len(encodings)
+                _append_columns(columns, rows, encoding_column)
+
+        tmp_path = matrix_path + ".tmp"
+        matrix = open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(count, ENCODING_SIZE))
+        with open(raw_path, 'rb') as raw:
+            for start in range(0, count, chunk_rows):
+                chunk = np.fromfile(raw, dtype=np.float32, count=min(chunk_rows, count - start) * ENCODING_SIZE)
+                matrix[start:start + len(chunk) // ENCODING_SIZE] = chunk.reshape(-1, ENCODING_SIZE)
+        matrix.flush()
+        del matrix
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+    meta = {
+        'version': 1,
+        'count': count,
+        'dim': ENCODING_SIZE,
+        'header': header,
+        'encoding_column': encoding_column,
+        'columns': columns,
+    }
+    # Matrix first, metadata last, as in save_gallery
+    os.replace(tmp_path, matrix_path)
+    _write_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+    return prefix
+
+
+def load_gallery(prefix, mmap=True):
+    matrix_path, meta_path = gallery_paths(gallery_prefix(prefix))
+    with open(meta_path, mode='r', encoding='utf-8') as file:
+        meta = json.load(file)
+    # mmap_mode='r' maps the file read-only and shared, so every process that
+    # opens the same gallery is served from the same page cache pages
+    encodings = np.load(matrix_path, mmap_mode='r' if mmap else None)
+    if encodings.shape != (meta['count'], meta['dim']) or encodings.dtype != np.float32:
+        raise ValueError(f"Compiled gallery {matrix_path} does not match its metadata")
+    return Gallery(encodings, meta['header'], meta['columns'], meta['encoding_column'])
+
+
+def find_compiled_gallery(path):
+    # Return the compiled prefix for path if it exists and is not older than
+    # the CSV it was built from, otherwise None
+    prefix = gallery_prefix(path)
+    matrix_path, meta_path = gallery_paths(prefix)
+    if not (os.path.exists(matrix_path) and os.path.exists(meta_path)):
+        return None
+    csv_path = prefix + '.csv'
+    if os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(meta_path):
+        return None
+    return prefix
+
+
+def read_header(path):
+    # (header, encoding column) of a gallery without loading its rows
+    prefix = find_compiled_gallery(path)
+    if prefix is not None:
+        with open(gallery_paths(prefix)[1], mode='r', encoding='utf-8') as file:
+            meta = json.load(file)
+        return meta['header'], meta['encoding_column']
+    with open(gallery_prefix(path) + '.csv', mode='r', newline='') as file:
+        header = next(csv.reader(file))
+    return header, header.index('encoding') if 'encoding' in header else 1
+
+
+def append_delta(path, rows):
+    # Append CSV-style rows (encoding column as "v1,v2,...") in a single
+    # write; readers only ever consume complete lines
+    if not rows:
+        return
+    lines = "".join(json.dumps([str(value) for value in row]) + "\n" for row in rows)
+    with open(delta_path(path), mode='a', encoding='utf-8') as file:
+        file.write(lines)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _read_delta_file(filename, offset=0, encoding_column=1, file_id=None):
+    encodings, names, rows = [], [], []
+    try:
+        with open(filename, mode='rb') as file:
+            stat = os.fstat(file.fileno())
+            if file_id is not None and (stat.st_dev, stat.st_ino) != file_id:
+                # Replaced since the offset was taken (compaction renames
+                # the delta away), the new file is read from the start
+                offset = 0
+            file_id = (stat.st_dev, stat.st_ino)
+            file.seek(offset)
+            data = file.read()
+    except FileNotFoundError:
+        return np.empty((0, ENCODING_SIZE), np.float32), names, rows, 0, None
+
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        try:
+            row = json.loads(line)
+            encoding = np.array(row[encoding_column].split(','), dtype=np.float32)
+            if encoding.shape != (ENCODING_SIZE,):
+                raise ValueError(f"expected {ENCODING_SIZE} values, got {encoding.size}")
+        except (ValueError, IndexError, AttributeError) as e:
+            print(f"Error reading enrolled face in {filename}: {e}")
+            continue
+        encodings.append(encoding)
+        names.append(row[0])
+        rows.append(row)
+    matrix = np.vstack(encodings) if encodings else np.empty((0, ENCODING_SIZE), np.float32)
+    return matrix, names, rows, offset + end, file_id
+
+
+def read_delta(path, offset=0, encoding_column=1, file_id=None):
+    # Rows appended since byte `offset`: (encodings, names, rows, new offset,
+    # file id). The offset only applies to the file `file_id` identifies, a
+    # delta that was replaced meanwhile is read from the start. A trailing
+    # partial line is left for the next call, malformed lines are reported
+    # and skipped.
+    return _read_delta_file(delta_path(path), offset, encoding_column, file_id)
+
+
+def compact_gallery(path):
+    # Fold the enrolled faces into the compiled gallery and start an empty
+    # delta, returns the number of faces moved. The delta is renamed first
+    # so enrollments made meanwhile go to a fresh file.
+    prefix = gallery_prefix(path)
+    pending = delta_path(prefix) + ".compacting"
+    if os.path.exists(delta_path(prefix)):
+        os.replace(delta_path(prefix), pending)
+    if not os.path.exists(pending):
+        return 0
+
+    if find_compiled_gallery(prefix) is None:
+        compile_gallery(prefix + '.csv', prefix)
+    base = load_gallery(prefix, mmap=False)
+    encodings, _, rows, _, _ = _read_delta_file(pending, 0, base.encoding_column)
+    columns = [list(values) for values in base.columns]
+    for row in rows:
+        for col, values in enumerate(columns):
+            if col != base.encoding_column:
+                values.append(row[col] if col < len(row) else "")
+    save_gallery(prefix, np.vstack([base.encodings, encodings]), base.header, columns, base.encoding_column)
+    os.remove(pending)
+    return len(rows)
+
+
+def load_encodings(path):
+    # Prefer the compiled gallery, fall back to parsing the CSV
+    prefix = find_compiled_gallery(path)
+    if prefix is not None:
+        try:
+            return load_gallery(prefix).as_legacy()
+        except Exception as e:
+            print(f"Error loading compiled gallery {prefix}: {e}")
+    return load_encodings_from_csv(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile face CSV files into memory-mapped galleries")
+    parser.add_argument('csv_files', nargs='+', help="Criminal_faces.csv / Non-Criminal_faces.csv style files")
+    parser.add_argument('-o', '--output', help="Output prefix (only with a single input file)")
+    args = parser.parse_args()
+
+    if args.output and len(args.csv_files) > 1:
+        parser.error("--output can only be used with a single input file")
+
+    for csv_path in args.csv_files:
+        errors = []
+        prefix = compile_gallery(csv_path, args.output, errors=errors)
+        report_csv_errors(csv_path, errors)
+        matrix_path, meta_path = gallery_paths(prefix)
+        print(f"{csv_path}: {len(load_gallery(prefix))} faces -> {matrix_path}, {meta_path}"
+              + (f" ({len(errors)} malformed rows skipped)" if errors else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,535 @@
+import os
+import time
+import argparse
+from abc import ABC, abstractmethod
+import numpy as np
+from face_gallery import ENCODING_SIZE, gallery_paths, gallery_prefix, load_encodings
+
+
+def _sq_distances(queries, query_sq_norms, vectors, vector_sq_norms):
+    # Squared Euclidean distances via ||v||^2 - 2 q.v + ||q||^2
+    sq_dist = queries @ vectors.T
+    sq_dist *= -2.0
+    sq_dist += vector_sq_norms
+    sq_dist += query_sq_norms[:, None]
+    return np.maximum(sq_dist, 0.0, out=sq_dist)
+
+
+def merge_top_k(top_dists, top_ids, dists, ids, k):
+    # Merge new candidates into a running K x k result, smallest first
+    dists = np.concatenate([top_dists, dists], axis=1)
+    ids = np.concatenate([top_ids, ids], axis=1)
+    if dists.shape[1] > k:
+        keep = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        dists = np.take_along_axis(dists, keep, axis=1)
+        ids = np.take_along_axis(ids, keep, axis=1)
+    order = np.argsort(dists, axis=1, kind='stable')
+    return np.take_along_axis(dists, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def _empty_result(num_queries, k):
+    return (np.full((num_queries, k), np.inf, dtype=np.float32),
+            np.full((num_queries, k), -1, dtype=np.int64))
+
+
+def _as_matrix(vectors, dim):
+    return np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, dim)
+
+
+class _GrowingRows:
+    # Append-only float32 rows + int64 ids with amortised doubling
+
+    def __init__(self, dim, capacity=0):
+        self.vectors = np.empty((capacity, dim), dtype=np.float32)
+        self.sq_norms = np.empty(capacity, dtype=np.float32)
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.size = 0
+
+    def append(self, vectors, ids):
+        needed = self.size + len(vectors)
+        if needed > len(self.ids):
+            capacity = max(needed, 2 * len(self.ids), 16)
+            for name in ('vectors', 'sq_norms', 'ids'):
+                old = getattr(self, name)
+                new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+        self.vectors[self.size:needed] = vectors
+        self.sq_norms[self.size:needed] = np.einsum('ij,ij->i', vectors, vectors)
+        self.ids[self.size:needed] = ids
+        self.size = needed
+
+
+class FlatIndex:
+    """Exact brute-force search, the reference every other backend is measured against."""
+
+    kind = 'flat'
+
+    def __init__(self, dim=ENCODING_SIZE, chunk_size=65536):
+        self.dim = dim
+        self.chunk_size = chunk_size
+        self.rows = _GrowingRows(dim)
+
+    def __len__(self):
+        return self.rows.size
+
+    @property
+    def is_trained(self):
+        return True
+
+    def train(self, vectors):
+        pass
+
+    def add(self, vectors, ids=None):
+        vectors = _as_matrix(vectors, self.dim)
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(vectors))
+        self.rows.append(vectors, ids)
+
+    def search(self, queries, k=1):
+        # (distances, ids), both K x k, padded with inf / -1
+        queries = _as_matrix(queries, self.dim)
+        query_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        top_dists, top_ids = _empty_result(len(queries), 0)
+        for start in range(0, len(self), self.chunk_size):
+            stop = min(start + self.chunk_size, len(self))
+            sq_dist = _sq_distances(queries, query_sq_norms,
+                                    self.rows.vectors[start:stop], self.rows.sq_norms[start:stop])
+            ids = np.broadcast_to(self.rows.ids[start:stop], sq_dist.shape)
+            top_dists, top_ids = merge_top_k(top_dists, top_ids, sq_dist, ids, k)
+        return _finish(top_dists, top_ids, len(queries), k)
+
+    def state(self):
+        return {'vectors': self.rows.vectors[:len(self)], 'ids': self.rows.ids[:len(self)]}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls(dim=state['vectors'].shape[1])
+        index.add(state['vectors'], state['ids'])
+        return index
+
+
+class IVFIndex:
+    """Inverted-file index: k-means coarse cells, only nprobe cells are scanned per query."""
+
+    kind = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, dim=ENCODING_SIZE, iterations=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.dim = dim
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.lists = []
+
+    def __len__(self):
+        return sum(cell.size for cell in self.lists)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, vectors, max_samples=100000):
+        # Plain k-means (Lloyd) on a random sample of the vectors
+        vectors = _as_matrix(vectors, self.dim)
+        if not len(vectors):
+            raise ValueError("Cannot train an IVF index without vectors")
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > max_samples:
+            vectors = vectors[rng.choice(len(vectors), max_samples, replace=False)]
+        nlist = self.nlist or int(4 * np.sqrt(len(vectors)))
+        nlist = max(1, min(nlist, len(vectors)))
+
+        sq_norms = np.einsum('ij,ij->i', vectors, vectors)
+        centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            centroid_sq = np.einsum('ij,ij->i', centroids, centroids)
+            assign = np.argmin(_sq_distances(vectors, sq_norms, centroids, centroid_sq), axis=1)
+            counts = np.bincount(assign, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, vectors)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            # Re-seed empty cells with random points so no cell stays dead
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+
+        self.nlist = nlist
+        self.centroids = centroids
+        self.centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        self.lists = [_GrowingRows(self.dim) for _ in range(nlist)]
+
+    def _nearest_cells(self, vectors, count):
+        if count >= self.nlist:
+            return np.broadcast_to(np.arange(self.nlist), (len(vectors), self.nlist))
+        sq_norms = np.einsum('ij,ij->i', vectors, vectors)
+        sq_dist = _sq_distances(vectors, sq_norms, self.centroids, self.centroid_sq_norms)
+        return np.argpartition(sq_dist, count - 1, axis=1)[:, :count]
+
+    def add(self, vectors, ids=None):
+        # Incremental insert: vectors go to their nearest trained cell
+        vectors = _as_matrix(vectors, self.dim)
+        if not self.is_trained:
+            self.train(vectors)
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(vectors))
+        ids = np.asarray(ids, dtype=np.int64)
+        cells = self._nearest_cells(vectors, 1)[:, 0]
+        order = np.argsort(cells, kind='stable')
+        bounds = np.flatnonzero(np.diff(cells[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group):
+                self.lists[cells[group[0]]].append(vectors[group], ids[group])
+
+    def search(self, queries, k=1, nprobe=None):
+        queries = _as_matrix(queries, self.dim)
+        top_dists, top_ids = _empty_result(len(queries), k)
+        if not self.is_trained or not len(queries):
+            return _finish(top_dists, top_ids, len(queries), k)
+        query_sq_norms = np.einsum('ij,ij->i', queries, queries)
+        probes = self._nearest_cells(queries, nprobe or self.nprobe)
+
+        # Group queries by cell so each probed cell costs one matrix product
+        for cell_id in np.unique(probes):
+            cell = self.lists[cell_id]
+            if not cell.size:
+                continue
+            rows = np.flatnonzero((probes == cell_id).any(axis=1))
+            sq_dist = _sq_distances(queries[rows], query_sq_norms[rows],
+                                    cell.vectors[:cell.size], cell.sq_norms[:cell.size])
+            ids = np.broadcast_to(cell.ids[:cell.size], sq_dist.shape)
+            top_dists[rows], top_ids[rows] = merge_top_k(top_dists[rows], top_ids[rows], sq_dist, ids, k)
+        return _finish(top_dists, top_ids, len(queries), k)
+
+    def state(self):
+        sizes = np.array([cell.size for cell in self.lists], dtype=np.int64)
+        return {
+            'params': np.array([self.nlist, self.nprobe, self.iterations, self.seed], dtype=np.int64),
+            'centroids': self.centroids,
+            'list_sizes': sizes,
+            'vectors': np.concatenate([cell.vectors[:cell.size] for cell in self.lists]),
+            'ids': np.concatenate([cell.ids[:cell.size] for cell in self.lists]),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        nlist, nprobe, iterations, seed = (int(v) for v in state['params'])
+        index = cls(nlist, nprobe, state['centroids'].shape[1], iterations, seed)
+        index.centroids = state['centroids']
+        index.centroid_sq_norms = np.einsum('ij,ij->i', index.centroids, index.centroids)
+        index.lists = [_GrowingRows(index.dim) for _ in range(nlist)]
+        start = 0
+        for cell, size in zip(index.lists, state['list_sizes']):
+            cell.append(state['vectors'][start:start + size], state['ids'][start:start + size])
+            start += size
+        return index
+
+
+class QuantizedIndex(ABC):
+    """Scalar-quantized scan with exact re-ranking.
+
+    Rows are stored in a compact form y = offset + scale * code and a query
+    scans the codes; its `rerank` best candidates are then re-ranked with
+    exact distances. The exact float32 vectors are only referenced, never
+    copied, so they can stay on disk as a memory-mapped gallery: a search
+    reads just the candidate rows.
+    """
+
+    kind = None
+    code_dtype = None
+
+    def __init__(self, rerank=32, dim=ENCODING_SIZE, chunk_size=65536):
+        self.rerank = rerank
+        self.dim = dim
+        self.chunk_size = chunk_size
+        self.offset = None
+        self.scale = None
+        self.codes = np.empty((0, dim), dtype=self.code_dtype)
+        self.code_sq_norms = np.empty(0, dtype=np.float32)
+        self.ids = np.empty(0, dtype=np.int64)
+        self._size = 0
+        # Exact vectors for re-ranking, (first position, matrix) blocks
+        self._blocks = []
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def is_trained(self):
+        return self.offset is not None
+
+    @property
+    def needs_vectors(self):
+        # True when loaded from disk without the exact vectors (see attach_vectors)
+        return self._size > 0 and not self._blocks
+
+    def train(self, vectors):
+        self.offset = np.zeros(self.dim, dtype=np.float32)
+        self.scale = np.ones(self.dim, dtype=np.float32)
+
+    @abstractmethod
+    def encode(self, vectors):
+        # Codes for float32 rows, in code_dtype
+        pass
+
+    def _grow(self, needed):
+        if needed <= len(self.ids):
+            return
+        capacity = max(needed, 2 * len(self.ids), 16)
+        for name in ('codes', 'code_sq_norms', 'ids'):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _append_codes(self, codes, ids):
+        needed = self._size + len(codes)
+        self._grow(needed)
+        self.codes[self._size:needed] = codes
+        scaled = codes.astype(np.float32) * self.scale
+        self.code_sq_norms[self._size:needed] = np.einsum('ij,ij->i', scaled, scaled)
+        self.ids[self._size:needed] = ids
+        self._size = needed
+
+    def add(self, vectors, ids=None):
+        # vectors is kept by reference for re-ranking, pass the memory-mapped
+        # gallery to keep it out of RAM
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if not self.is_trained:
+            self.train(vectors)
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(vectors))
+        self._blocks.append((self._size, vectors))
+        self._grow(self._size + len(vectors))
+        for start in range(0, len(vectors), self.chunk_size):
+            chunk = np.asarray(vectors[start:start + self.chunk_size])
+            self._append_codes(self.encode(chunk), ids[start:start + self.chunk_size])
+
+    def attach_vectors(self, vectors):
+        # Exact vectors (in insertion order) for an index loaded from disk
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(vectors) != len(self):
+            raise ValueError(f"Expected {len(self)} vectors to re-rank against, got {len(vectors)}")
+        self._blocks = [(0, vectors)]
+
+    def _exact_rows(self, positions):
+        rows = np.empty((len(positions), self.dim), dtype=np.float32)
+        starts = np.array([first for first, _ in self._blocks])
+        which = np.searchsorted(starts, positions, side='right') - 1
+        for block in np.unique(which):
+            selected = which == block
+            first, vectors = self._blocks[block]
+            # Sorted positions keep reads from a memory-mapped file sequential
+            wanted = positions[selected] - first
+            order = np.argsort(wanted)
+            rows[np.flatnonzero(selected)[order]] = vectors[wanted[order]]
+        return rows
+
+    def _approximate(self, queries, k):
+        # (squared distances, positions) of the k best rows by code
+        shifted = queries - self.offset
+        weights = shifted * self.scale
+        shifted_sq_norms = np.einsum('ij,ij->i', shifted, shifted)
+        top_dists, top_positions = _empty_result(len(queries), 0)
+        for start in range(0, len(self), self.chunk_size):
+            stop = min(start + self.chunk_size, len(self))
+            sq_dist = weights @ self.codes[start:stop].astype(np.float32).T
+            sq_dist *= -2.0
+            sq_dist += self.code_sq_norms[start:stop]
+            sq_dist += shifted_sq_norms[:, None]
+            np.maximum(sq_dist, 0.0, out=sq_dist)
+            positions = np.broadcast_to(np.arange(start, stop), sq_dist.shape)
+            top_dists, top_positions = merge_top_k(top_dists, top_positions, sq_dist, positions, k)
+        return top_dists, top_positions
+
+    def search(self, queries, k=1, rerank=None):
+        queries = _as_matrix(queries, self.dim)
+        if not len(self) or not len(queries):
+            return _finish(*_empty_result(len(queries), 0), len(queries), k)
+        candidates = min(max(k, rerank or self.rerank), len(self))
+        sq_dist, positions = self._approximate(queries, candidates)
+        if self._blocks:
+            # Re-rank the candidates with exact distances
+            exact = self._exact_rows(positions.ravel()).reshape(positions.shape + (self.dim,))
+            diff = exact - queries[:, None, :]
+            sq_dist = np.einsum('ijk,ijk->ij', diff, diff)
+            top = np.argsort(sq_dist, axis=1, kind='stable')[:, :k]
+            sq_dist = np.take_along_axis(sq_dist, top, axis=1)
+            positions = np.take_along_axis(positions, top, axis=1)
+        else:
+            sq_dist, positions = sq_dist[:, :k], positions[:, :k]
+        return _finish(sq_dist, self.ids[positions], len(queries), k)
+
+    def memory_bytes(self):
+        # Resident size of the compact form, exact vectors excluded
+        return int(self.codes[:len(self)].nbytes + self.code_sq_norms[:len(self)].nbytes +
+                   self.ids[:len(self)].nbytes + 2 * self.dim * 4)
+
+    def state(self):
+        return {'params': np.array([self.rerank], dtype=np.int64), 'offset': self.offset,
+                'scale': self.scale, 'codes': self.codes[:len(self)], 'ids': self.ids[:len(self)]}
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls(int(state['params'][0]), dim=state['codes'].shape[1])
+        index.offset = state['offset']
+        index.scale = state['scale']
+        index._append_codes(state['codes'], state['ids'])
+        return index
+
+
+class Float16Index(QuantizedIndex):
+    """Half-precision copy of the gallery, 2 bytes per dimension."""
+
+    kind = 'float16'
+    code_dtype = np.float16
+
+    def encode(self, vectors):
+        return vectors.astype(np.float16)
+
+
+class Int8Index(QuantizedIndex):
+    """Per-dimension int8 codes: offset + scale * code, 1 byte per dimension."""
+
+    kind = 'int8'
+    code_dtype = np.int8
+
+    def train(self, vectors, max_samples=100000):
+        # Per-dimension range from a sample, codes span [-127, 127]
+        vectors = _as_matrix(vectors, self.dim)
+        if not len(vectors):
+            return super().train(vectors)
+        if len(vectors) > max_samples:
+            vectors = vectors[np.random.default_rng(0).choice(len(vectors), max_samples, replace=False)]
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        self.offset = ((high + low) / 2).astype(np.float32)
+        self.scale = ((high - low) / 254).astype(np.float32)
+        self.scale[self.scale == 0] = 1.0
+
+    def encode(self, vectors):
+        codes = np.rint((vectors - self.offset) / self.scale)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+
+def _finish(top_dists, top_ids, num_queries, k):
+    # Pad to exactly k columns and turn squared distances into distances
+    if top_dists.shape[1] < k:
+        pad_dists, pad_ids = _empty_result(num_queries, k - top_dists.shape[1])
+        top_dists = np.concatenate([top_dists, pad_dists], axis=1)
+        top_ids = np.concatenate([top_ids, pad_ids], axis=1)
+    return np.sqrt(top_dists), top_ids
+
+
+INDEX_TYPES = {index.kind: index for index in (FlatIndex, IVFIndex, Float16Index, Int8Index)}
+
+
+def create_index(kind, **params):
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {kind!r}, expected one of {sorted(INDEX_TYPES)}")
+    return INDEX_TYPES[kind](**params)
+
+
+def index_path(prefix, kind):
+    # Indexes live next to the compiled gallery: Criminal_faces.ivf.npz
+    return f"{gallery_prefix(prefix)}.{kind}.npz"
+
+
+def save_index(index, path):
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, kind=np.array(index.kind), **index.state())
+    os.replace(tmp_path, path)
+
+
+def load_index(path):
+    with np.load(path) as state:
+        state = dict(state)
+    return INDEX_TYPES[str(state.pop('kind'))].from_state(state)
+
+
+def load_or_build_index(prefix, kind, encodings, **params):
+    # Reuse the persisted index if it is at least as new as the gallery and
+    # covers the same rows, otherwise build it and write it back
+    if len(encodings) == 0:
+        # An empty gallery is valid but cannot train IVF cells or quantizers,
+        # and an exact index over no rows answers the same
+        return FlatIndex()
+    path = index_path(prefix, kind)
+    sources = [p for p in gallery_paths(gallery_prefix(prefix)) + (gallery_prefix(prefix) + '.csv',)
+               if os.path.exists(p)]
+    if os.path.exists(path) and all(os.path.getmtime(path) >= os.path.getmtime(p) for p in sources):
+        try:
+            index = load_index(path)
+            if len(index) == len(encodings) and params.get('nlist') in (None, getattr(index, 'nlist', None)):
+                for name in ('nprobe', 'rerank'):
+                    if name in params:
+                        setattr(index, name, params[name])
+                if getattr(index, 'needs_vectors', False):
+                    index.attach_vectors(encodings)
+                return index
+        except Exception as e:
+            print(f"Error loading index {path}: {e}")
+
+    index = create_index(kind, **params)
+    index.train(encodings)
+    index.add(encodings)
+    try:
+        save_index(index, path)
+    except OSError as e:
+        print(f"Error saving index {path}: {e}")
+    return index
+
+
+def recall_at_k(index, exact_index, queries, k=1):
+    # Fraction of the exact top-k ids that the index also returns
+    _, found = index.search(queries, k)
+    _, expected = exact_index.search(queries, k)
+    hits = sum(len(np.intersect1d(f[f >= 0], e[e >= 0])) for f, e in zip(found, expected))
+    return hits / max(1, int((expected >= 0).sum()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an ANN index for a face gallery and report its recall")
+    parser.add_argument('gallery', help="Gallery CSV or compiled gallery prefix")
+    parser.add_argument('--kind', default=IVFIndex.kind, choices=sorted(INDEX_TYPES))
+    parser.add_argument('--nlist', type=int, help="IVF cells (default 4 * sqrt(N))")
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8], help="IVF cells scanned per query")
+    parser.add_argument('-k', type=int, default=1)
+    parser.add_argument('--queries', type=int, default=1000, help="Noisy gallery faces used as probes")
+    parser.add_argument('--noise', type=float, default=0.03)
+    args = parser.parse_args()
+
+    encodings = _as_matrix(load_encodings(args.gallery)[0], ENCODING_SIZE)
+    if len(encodings) == 0:
+        parser.error(f"No faces in {args.gallery}, nothing to index")
+    params = {'nlist': args.nlist} if args.kind == IVFIndex.kind else {}
+    start = time.perf_counter()
+    index = load_or_build_index(args.gallery, args.kind, encodings, **params)
+    print(f"{args.kind} index over {len(index)} faces ready in {time.perf_counter() - start:.2f}s "
+          f"({index_path(args.gallery, args.kind)})")
+
+    rng = np.random.default_rng(0)
+    queries = encodings[rng.integers(len(encodings), size=args.queries)]
+    queries = queries + rng.normal(0, args.noise, queries.shape).astype(np.float32)
+
+    exact = FlatIndex()
+    exact.add(encodings)
+    start = time.perf_counter()
+    exact.search(queries, args.k)
+    exact_qps = len(queries) / (time.perf_counter() - start)
+    print(f"flat: {exact_qps:.0f} queries/s")
+
+    for nprobe in args.nprobe if args.kind == IVFIndex.kind else [None]:
+        if nprobe is not None:
+            index.nprobe = nprobe
+        start = time.perf_counter()
+        index.search(queries, args.k)
+        qps = len(queries) / (time.perf_counter() - start)
+        recall = recall_at_k(index, exact, queries, args.k)
+        label = f"{args.kind} nprobe={nprobe}" if nprobe is not None else args.kind
+        print(f"{label}: recall@{args.k}={recall:.4f}, {qps:.0f} queries/s")
+
+
+if __name__ == "__main__":
+    main()
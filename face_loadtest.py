@@ -0,0 +1,131 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+import numpy as np
+from face_gallery import ENCODING_SIZE
+
+# Load generator for face_service.py: `concurrency` keep-alive connections
+# send requests back to back; latency is measured per request on the client
+
+
+async def read_response(reader):
+    # (status, body) of one HTTP/1.1 response with a Content-Length
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed by the server")
+    status = int(line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+def build_request(host, path, body, content_type):
+    head = (f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n")
+    return head.encode('latin-1') + body
+
+
+async def client(host, port, requests, deadline, latencies, errors):
+    # Pops prebuilt requests until the list is empty or time is up
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while requests and time.perf_counter() < deadline:
+            request = requests.pop()
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, _ = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors[status] = errors.get(status, 0) + 1
+    finally:
+        writer.close()
+
+
+async def fetch_health(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET /health HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+        _, body = await read_response(reader)
+        return json.loads(body)
+    finally:
+        writer.close()
+
+
+def make_payloads(args):
+    # One body per request: an image file, or random encodings for /identify
+    if args.image:
+        with open(args.image, mode='rb') as file:
+            data = file.read()
+        return [data] * args.requests, 'application/octet-stream'
+    if args.endpoint != 'identify':
+        raise SystemExit("--image is required for /detect and /encode")
+    rng = np.random.default_rng(args.seed)
+    payloads = []
+    for _ in range(args.requests):
+        encodings = rng.normal(0.0, 0.1, (args.faces, ENCODING_SIZE)).round(5)
+        payloads.append(json.dumps({'encodings': encodings.tolist()}).encode('utf-8'))
+    return payloads, 'application/json'
+
+
+async def run(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    payloads, content_type = make_payloads(args)
+    requests = [build_request(host, f"/{args.endpoint}", body, content_type) for body in payloads]
+    latencies, errors = [], {}
+
+    start = time.perf_counter()
+    deadline = start + args.duration if args.duration else float('inf')
+    await asyncio.gather(*[client(host, port, requests, deadline, latencies, errors)
+                           for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    report = {
+        'endpoint': f"/{args.endpoint}",
+        'concurrency': args.concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'qps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(float(np.percentile(latencies_ms, 50)), 3),
+            'p90': round(float(np.percentile(latencies_ms, 90)), 3),
+            'p99': round(float(np.percentile(latencies_ms, 99)), 3),
+            'max': round(float(latencies_ms.max()), 3),
+        },
+        'server': (await fetch_health(host, port)).get('batching'),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure latency and QPS of the recognition service")
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help="Service address")
+    parser.add_argument('--endpoint', choices=['detect', 'encode', 'identify'], default='identify')
+    parser.add_argument('--image', help="Image posted with every request (default: random encodings)")
+    parser.add_argument('--faces', type=int, default=1, help="Encodings per /identify request")
+    parser.add_argument('-c', '--concurrency', type=int, default=32, help="Concurrent connections")
+    parser.add_argument('-n', '--requests', type=int, default=5000, help="Total requests")
+    parser.add_argument('--duration', type=float, help="Stop after this many seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
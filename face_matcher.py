@@ -0,0 +1,353 @@
+import copy
+import threading
+from collections import namedtuple
+from itertools import count
+import numpy as np
+from face_gallery import ENCODING_SIZE, load_encodings, read_delta, read_header
+from face_index import create_index, load_or_build_index, merge_top_k
+
+# Same cut-off the app has always used for face_recognition.face_distance
+MATCH_THRESHOLD = 0.55
+
+# Gallery categories, criminals are always checked first
+CRIMINAL = 0
+NON_CRIMINAL = 1
+CATEGORY_LABELS = {CRIMINAL: "Criminal", NON_CRIMINAL: "Not Criminal"}
+
+# category is None when the face is unknown
+Match = namedtuple('Match', ['category', 'index', 'distance', 'name', 'data'])
+
+# Top-k neighbours for a batch of K probes, every field is a K x k array
+SearchResult = namedtuple('SearchResult', ['rows', 'distances', 'categories'])
+
+# Every gallery (and every change to one) gets a new version, caches of
+# match results compare it to know when to drop their entries
+_versions = count(1)
+
+# A contiguous block of gallery rows [start, stop) from a single source file
+Segment = namedtuple('Segment', ['category', 'start', 'stop', 'names', 'data'])
+
+# Serializes writers of a shared _RowBuffer, readers never take it
+_extend_lock = threading.Lock()
+
+
+class _RowBuffer:
+    # Capacity-growing storage shared by successive gallery snapshots. Rows
+    # below `used` are never written again, so every snapshot keeps reading
+    # its own prefix while newer snapshots append behind it. Encodings and
+    # norms are only stored from first_row on (see FaceGallery resident).
+    def __init__(self, capacity, first_row=0):
+        self.first_row = first_row
+        self.encodings = np.empty((capacity - first_row, ENCODING_SIZE), dtype=np.float32)
+        self.categories = np.empty(capacity, dtype=np.int8)
+        self.sq_norms = np.empty(capacity - first_row, dtype=np.float32)
+        self.used = 0
+
+    def copy(self, rows, capacity):
+        buffer = _RowBuffer(capacity, self.first_row)
+        buffer.encodings[:rows - self.first_row] = self.encodings[:rows - self.first_row]
+        buffer.categories[:rows] = self.categories[:rows]
+        buffer.sq_norms[:rows - self.first_row] = self.sq_norms[:rows - self.first_row]
+        buffer.used = rows
+        return buffer
+
+
+class FaceGallery:
+    """Criminal and non-criminal encodings stacked into one float32 matrix.
+
+    With resident=False the encodings given here are not copied into the
+    matrix: they stay wherever the sources keep them (usually the
+    memory-mapped compiled gallery) and must be searched through an index,
+    e.g. a quantized one that reads only its re-ranking candidates from them.
+    """
+
+    def __init__(self, sources, threshold=MATCH_THRESHOLD, resident=True):
+        # sources: iterable of (category, encodings, names, data)
+        sources = [(category, np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE), names, data)
+                   for category, encodings, names, data in sources]
+        total = sum(len(encodings) for _, encodings, _, _ in sources)
+
+        self.threshold = threshold
+        self.resident = resident
+        self.version = next(_versions)
+        self._buffer = _RowBuffer(total, 0 if resident else total)
+        self.segments = []
+
+        # (start, stop, encodings) of the rows that are not copied
+        self._base_sources = []
+        start = 0
+        for category, encodings, names, data in sources:
+            stop = start + len(encodings)
+            if resident:
+                self._buffer.encodings[start:stop] = encodings
+            elif stop > start:
+                self._base_sources.append((start, stop, encodings))
+            self._buffer.categories[start:stop] = category
+            self.segments.append(Segment(category, start, stop, names, data))
+            start = stop
+
+        if resident:
+            # ||g||^2 is fixed per row, so a query only needs the g.p products
+            self._buffer.sq_norms[:total] = np.einsum('ij,ij->i', self._buffer.encodings, self._buffer.encodings)
+        self._buffer.used = total
+        self._set_rows(total)
+        # Optional per-category search index (see face_index.py), category ->
+        # (index, offset) where index ids are gallery rows minus offset.
+        # Without one, queries are answered by the exact scan below. Indexes
+        # cover the rows given here; rows added later by extend() are
+        # scanned exactly.
+        self.indexes = {}
+        self.base_rows = total
+        # (file id, byte offset) read so far from each category's delta file,
+        # and the column holding the encoding in its rows (see from_files)
+        self.delta_offsets = {}
+        self.encoding_columns = {}
+
+    def _set_rows(self, total):
+        # encodings and sq_norms start at row _first_row, 0 unless the
+        # gallery is not resident
+        self._first_row = self._buffer.first_row
+        self.encodings = self._buffer.encodings[:total - self._first_row]
+        self.categories = self._buffer.categories[:total]
+        self.sq_norms = self._buffer.sq_norms[:total - self._first_row]
+        self._segment_starts = np.array([segment.start for segment in self.segments], dtype=np.int64)
+
+    @classmethod
+    def from_files(cls, criminal_file, non_criminal_file, threshold=MATCH_THRESHOLD,
+                   index_kind=None, resident=True, **index_params):
+        if not resident and index_kind is None:
+            raise ValueError("A gallery that is not resident needs an index")
+        gallery = cls([(CRIMINAL,) + tuple(load_encodings(criminal_file)),
+                       (NON_CRIMINAL,) + tuple(load_encodings(non_criminal_file))],
+                      threshold, resident)
+        if index_kind is not None:
+            # Each index is persisted next to the gallery file it covers
+            for category, path in ((CRIMINAL, criminal_file), (NON_CRIMINAL, non_criminal_file)):
+                offset, encodings = gallery.category_rows(category)
+                gallery.attach_index(category, load_or_build_index(path, index_kind, encodings, **index_params), offset)
+        gallery.encoding_columns = {CRIMINAL: read_header(criminal_file)[1],
+                                    NON_CRIMINAL: read_header(non_criminal_file)[1]}
+        # Faces enrolled since the files were written (see face_enroll.py)
+        return gallery.apply_deltas({CRIMINAL: criminal_file, NON_CRIMINAL: non_criminal_file})
+
+    def apply_deltas(self, files):
+        # Snapshot with the delta rows of files ({category: gallery file})
+        # appended since the offsets this snapshot has already read
+        gallery = self
+        for category, path in files.items():
+            encoding_column = self.encoding_columns.get(category)
+            if encoding_column is None:
+                encoding_column = read_header(path)[1]
+            file_id, offset = self.delta_offsets.get(category, (None, 0))
+            encodings, names, data, offset, file_id = read_delta(path, offset, encoding_column, file_id)
+            if len(encodings):
+                gallery = gallery.extend(category, encodings, names, data)
+            gallery.delta_offsets = {**gallery.delta_offsets, category: (file_id, offset)}
+        return gallery
+
+    def extend(self, category, encodings, names, data):
+        # New snapshot with rows appended to a category. This snapshot stays
+        # valid and unchanged, matching already running on it is not paused;
+        # the row buffer is shared and only copied when it has to grow or an
+        # older snapshot is extended.
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        start, stop = len(self), len(self) + len(encodings)
+        with _extend_lock:
+            buffer = self._buffer
+            if buffer.used != start or len(buffer.categories) < stop:
+                buffer = buffer.copy(start, max(stop, 2 * len(buffer.categories)))
+            buffer.encodings[start - buffer.first_row:stop - buffer.first_row] = encodings
+            buffer.categories[start:stop] = category
+            buffer.sq_norms[start - buffer.first_row:stop - buffer.first_row] = np.einsum('ij,ij->i', encodings, encodings)
+            buffer.used = stop
+
+        snapshot = copy.copy(self)
+        snapshot._buffer = buffer
+        snapshot.indexes = dict(self.indexes)
+        snapshot.version = next(_versions)
+        last = self.segments[-1] if self.segments else None
+        if last is not None and last.category == category and last.start >= self.base_rows:
+            # Keep enrolled rows in one segment per run instead of one per call
+            merged = Segment(category, last.start, stop, list(last.names) + list(names), list(last.data) + list(data))
+            snapshot.segments = self.segments[:-1] + [merged]
+        else:
+            snapshot.segments = self.segments + [Segment(category, start, stop, list(names), list(data))]
+        snapshot._set_rows(stop)
+        return snapshot
+
+    def __len__(self):
+        return self.categories.shape[0]
+
+    def rows(self, start, stop):
+        # Encodings of rows [start, stop), read from the sources for the rows
+        # a non-resident gallery did not copy
+        if self.resident or start >= self.base_rows:
+            return self.encodings[start - self._first_row:stop - self._first_row]
+        parts = [encodings[max(start, lo) - lo:min(stop, hi) - lo]
+                 for lo, hi, encodings in self._base_sources if lo < stop and hi > start]
+        if stop > self.base_rows:
+            parts.append(self.encodings[self.base_rows - self._first_row:stop - self._first_row])
+        if not parts:
+            return self.encodings[:0]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def category_rows(self, category):
+        # (first row, encodings) of the first contiguous run of a category's rows
+        segments = [segment for segment in self.segments if segment.category == category]
+        if not segments:
+            return 0, self.encodings[:0]
+        stop = segments[0].stop
+        for segment in segments[1:]:
+            if segment.start != stop:
+                break
+            stop = segment.stop
+        return segments[0].start, self.rows(segments[0].start, stop)
+
+    def attach_index(self, category, index, offset=0):
+        self.indexes[category] = (index, offset)
+        self.version = next(_versions)
+
+    def build_indexes(self, kind, **params):
+        for category in CATEGORY_LABELS:
+            offset, encodings = self.category_rows(category)
+            index = create_index(kind, **params)
+            if len(encodings):
+                index.train(encodings)
+                index.add(encodings)
+            self.attach_index(category, index, offset)
+
+    def count(self, category):
+        return sum(segment.stop - segment.start for segment in self.segments
+                   if segment.category == category)
+
+    def distances(self, face_encoding):
+        # Euclidean distance to every stored face, the same values as
+        # face_recognition.face_distance but from a single GEMV:
+        # ||g - p||^2 = ||g||^2 - 2 g.p + ||p||^2
+        if not self.resident:
+            raise ValueError("Gallery is not resident, search it through an index")
+        probe = np.asarray(face_encoding, dtype=np.float32)
+        return self._distance_block(probe[None, :], np.array([probe @ probe]), 0, len(self))[0]
+
+    def _distance_block(self, probes, probe_sq_norms, start, stop):
+        # K x (stop - start) distances between probes and gallery rows [start, stop)
+        first = self._first_row
+        sq_dist = probes @ self.encodings[start - first:stop - first].T
+        sq_dist *= -2.0
+        sq_dist += self.sq_norms[start - first:stop - first]
+        sq_dist += probe_sq_norms[:, None]
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        return np.sqrt(sq_dist, out=sq_dist)
+
+    def _scan(self, probes, k=0, chunk_size=None, first_row=0):
+        # Walk the gallery rows from first_row on in chunks (all rows at once
+        # without chunk_size), keeping the running top-k rows and the best row
+        # of each category
+        if not self.resident and first_row < self.base_rows:
+            raise ValueError("Gallery is not resident, search it through an index")
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        num_probes, total = len(probes), len(self)
+        k = min(k, total - first_row)
+        probe_sq_norms = np.einsum('ij,ij->i', probes, probes)
+        probe_ids = np.arange(num_probes)
+
+        best_rows = np.full((num_probes, len(CATEGORY_LABELS)), -1, dtype=np.int64)
+        best_dists = np.full((num_probes, len(CATEGORY_LABELS)), np.inf, dtype=np.float32)
+        top_rows = np.empty((num_probes, 0), dtype=np.int64)
+        top_dists = np.empty((num_probes, 0), dtype=np.float32)
+
+        step = chunk_size or max(total - first_row, 1)
+        for start in range(first_row, total, step):
+            stop = min(start + step, total)
+            block = self._distance_block(probes, probe_sq_norms, start, stop)
+
+            for segment in self.segments:
+                lo, hi = max(segment.start, start), min(segment.stop, stop)
+                if lo >= hi:
+                    continue
+                cols = np.argmin(block[:, lo - start:hi - start], axis=1)
+                dists = block[probe_ids, lo - start + cols]
+                better = dists < best_dists[:, segment.category]
+                best_dists[better, segment.category] = dists[better]
+                best_rows[better, segment.category] = lo + cols[better]
+
+            if k:
+                # Keep only k candidates from this chunk, then merge with the running top-k
+                kk = min(k, stop - start)
+                cols = np.argpartition(block, kk - 1, axis=1)[:, :kk]
+                top_rows = np.concatenate([top_rows, cols + start], axis=1)
+                top_dists = np.concatenate([top_dists, np.take_along_axis(block, cols, axis=1)], axis=1)
+                if top_rows.shape[1] > k:
+                    keep = np.argpartition(top_dists, k - 1, axis=1)[:, :k]
+                    top_rows = np.take_along_axis(top_rows, keep, axis=1)
+                    top_dists = np.take_along_axis(top_dists, keep, axis=1)
+
+        order = np.argsort(top_dists, axis=1, kind='stable')
+        top_rows = np.take_along_axis(top_rows, order, axis=1)
+        top_dists = np.take_along_axis(top_dists, order, axis=1)
+        return SearchResult(top_rows, top_dists, self.categories[top_rows]), best_rows, best_dists
+
+    def _index_scan(self, probes, k=0):
+        # Same contract as _scan, answered by the attached per-category indexes
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        best_rows = np.full((len(probes), len(CATEGORY_LABELS)), -1, dtype=np.int64)
+        best_dists = np.full((len(probes), len(CATEGORY_LABELS)), np.inf, dtype=np.float32)
+        top_rows = np.empty((len(probes), 0), dtype=np.int64)
+        top_dists = np.empty((len(probes), 0), dtype=np.float32)
+
+        for category, (index, offset) in self.indexes.items():
+            dists, ids = index.search(probes, max(k, 1))
+            rows = np.where(ids >= 0, ids + offset, -1)
+            best_rows[:, category] = rows[:, 0]
+            best_dists[:, category] = dists[:, 0]
+            if k:
+                top_dists, top_rows = merge_top_k(top_dists, top_rows, dists, rows, k)
+
+        if len(self) > self.base_rows:
+            # Enrolled rows are not in the indexes, scan them exactly
+            tail, tail_rows, tail_dists = self._scan(probes, k, first_row=self.base_rows)
+            better = tail_dists < best_dists
+            best_rows[better] = tail_rows[better]
+            best_dists[better] = tail_dists[better]
+            if k:
+                top_dists, top_rows = merge_top_k(top_dists, top_rows, tail.distances, tail.rows, k)
+
+        k = min(k, len(self))
+        top_rows, top_dists = top_rows[:, :k], top_dists[:, :k]
+        categories = np.where(top_rows >= 0, self.categories[top_rows], -1)
+        return SearchResult(top_rows, top_dists, categories), best_rows, best_dists
+
+    def search(self, probes, k=1, chunk_size=None):
+        # Top-k nearest gallery rows for every probe in a K x 128 matrix.
+        # chunk_size bounds the distance block to K x chunk_size floats.
+        if self.indexes:
+            result, _, _ = self._index_scan(probes, k)
+        else:
+            result, _, _ = self._scan(probes, k, chunk_size)
+        return result
+
+    def segment_of(self, row):
+        return self.segments[int(np.searchsorted(self._segment_starts, row, side='right')) - 1]
+
+    def describe(self, row, distance):
+        segment = self.segment_of(row)
+        index = row - segment.start
+        return Match(segment.category, index, distance, segment.names[index], segment.data[index])
+
+    def match(self, face_encoding):
+        return self.match_batch([face_encoding])[0]
+
+    def match_batch(self, probes, chunk_size=None):
+        # One Match per probe, all faces of an image in one K x N pass
+        if self.indexes:
+            _, best_rows, best_dists = self._index_scan(probes)
+        else:
+            _, best_rows, best_dists = self._scan(probes, 0, chunk_size)
+        return [self.decide(rows, dists) for rows, dists in zip(best_rows, best_dists)]
+
+    def decide(self, best_rows, best_dists):
+        # Criminal first, then non-criminal, both against the same threshold
+        for category in (CRIMINAL, NON_CRIMINAL):
+            if best_dists[category] < self.threshold:
+                return self.describe(int(best_rows[category]), float(best_dists[category]))
+        return Match(None, -1, np.inf, None, None)
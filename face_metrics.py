@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the stage duration histogram buckets
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the faces-per-image histogram
+FACE_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Prometheus label name of each labelled counter
+LABEL_NAMES = {'matches': 'outcome', 'requests': 'route', 'errors': 'route'}
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """Per-stage timings, counters and gauges of the recognizer.
+
+    Disabled (the default) every call returns after one attribute check and
+    span() hands back a shared no-op context manager, so instrumented code
+    costs next to nothing until a CLI flag or the app turns it on.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = {}     # stage -> Histogram of seconds
+        self.counters = {}   # (name, label) -> count
+        self.gauges = {}     # name -> value
+        self.faces_per_image = Histogram(FACE_BUCKETS)
+        self.started = time.time()
+
+    def span(self, stage):
+        # with METRICS.span('detect'): ...
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage)
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(STAGE_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe_timings(self, timings):
+        # Stage timings as collected in the pipeline's `timings` dicts
+        if not self.enabled:
+            return
+        for stage, seconds in timings.items():
+            if stage != 'total':
+                self.observe(stage, seconds)
+
+    def count(self, name, label=None, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value):
+        if self.enabled:
+            self.gauges[name] = value
+
+    def record_image(self, faces):
+        # One processed image with this many faces
+        if not self.enabled:
+            return
+        self.count('images')
+        self.count('faces', value=faces)
+        with self.lock:
+            self.faces_per_image.observe(faces)
+
+    def record_matches(self, matches):
+        if not self.enabled:
+            return
+        for match in matches:
+            outcome = 'unknown' if match.category is None else ('criminal', 'non_criminal')[match.category]
+            self.count('matches', outcome)
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.gauges.clear()
+            self.faces_per_image = Histogram(FACE_BUCKETS)
+            self.started = time.time()
+
+    def snapshot(self):
+        # Plain dict for JSON dumps, stage timings in milliseconds
+        with self.lock:
+            stages = {stage: {
+                'count': histogram.count,
+                'mean_ms': round(histogram.sum / histogram.count * 1000, 3) if histogram.count else 0.0,
+                'p50_ms': round(histogram.quantile(0.5) * 1000, 3),
+                'p99_ms': round(histogram.quantile(0.99) * 1000, 3),
+                'buckets': {str(bound): total for bound, total in histogram.cumulative()},
+            } for stage, histogram in self.stages.items()}
+            counters = {}
+            for (name, label), value in self.counters.items():
+                counters[name if label is None else f"{name}.{label}"] = value
+            return {
+                'time': time.time(),
+                'uptime_s': round(time.time() - self.started, 1),
+                'stages': stages,
+                'counters': counters,
+                'gauges': dict(self.gauges),
+                'faces_per_image': {str(bound): total for bound, total in self.faces_per_image.cumulative()},
+            }
+
+    def render_prometheus(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            lines.append("# TYPE face_stage_seconds histogram")
+            for stage, histogram in sorted(self.stages.items()):
+                _histogram_lines(lines, 'face_stage_seconds', histogram, f'stage="{stage}",')
+            lines.append("# TYPE face_faces_per_image histogram")
+            _histogram_lines(lines, 'face_faces_per_image', self.faces_per_image, '')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE face_{name}_total counter")
+                for (counter, label), value in sorted(self.counters.items(), key=lambda item: str(item[0])):
+                    if counter == name:
+                        labels = f'{{{LABEL_NAMES.get(name, "label")}="{label}"}}' if label is not None else ""
+                        lines.append(f"face_{name}_total{labels} {value}")
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE face_{name} gauge")
+                lines.append(f"face_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(lines, metric, histogram, labels):
+    for bound, total in histogram.cumulative():
+        le = "+Inf" if bound == float('inf') else repr(bound)
+        lines.append(f'{metric}_bucket{{{labels}le="{le}"}} {total}')
+    labels = "{" + labels.rstrip(',') + "}" if labels else ""
+    lines.append(f"{metric}_sum{labels} {histogram.sum}")
+    lines.append(f"{metric}_count{labels} {histogram.count}")
+
+
+# Process-wide registry the pipeline modules report to
+METRICS = Metrics()
+
+
+def write_json(metrics, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode='w', encoding='utf-8') as file:
+        json.dump(metrics.snapshot(), file, indent=2)
+    os.replace(tmp_path, path)
+
+
+class JsonDumper:
+    """Writes a metrics snapshot to a file every `interval` seconds."""
+
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-dump", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+    def dump(self):
+        try:
+            write_json(self.metrics, self.path)
+        except OSError as e:
+            print(f"Error writing metrics {self.path}: {e}")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.dump()
+
+
+def serve_prometheus(metrics, port, host='127.0.0.1'):
+    # GET /metrics on a daemon thread, returns the server
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this port (/metrics)")
+    parser.add_argument('--metrics-json', help="Dump metrics as JSON to this file")
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help="Seconds between JSON dumps")
+
+
+def start_from_args(args, metrics=METRICS):
+    # Enable the registry and start the exporters requested on the command
+    # line; returns a stop() callable that writes the final JSON dump
+    if args.metrics_port is None and not args.metrics_json:
+        return lambda: None
+    metrics.enabled = True
+    server = serve_prometheus(metrics, args.metrics_port) if args.metrics_port is not None else None
+    dumper = JsonDumper(metrics, args.metrics_json, args.metrics_interval).start() if args.metrics_json else None
+    if server is not None:
+        print(f"Metrics on http://127.0.0.1:{server.server_address[1]}/metrics", file=sys.stderr)
+
+    def stop():
+        if dumper is not None:
+            dumper.stop()
+        if server is not None:
+            server.shutdown()
+    return stop
@@ -0,0 +1,179 @@
+import os
+import time
+from collections import namedtuple, deque
+import cv2
+import numpy as np
+import face_recognition
+from face_matcher import CRIMINAL, CATEGORY_LABELS
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# HOG detection runs on a copy whose longest side is at most this many
+# pixels; boxes are mapped back so encoding still sees full resolution
+DETECTION_MAX_SIDE = 1600
+
+# Detection/encoding result for one image. locations are face_recognition
+# (top, right, bottom, left) boxes, timings are seconds per stage.
+ImageFaces = namedtuple('ImageFaces', ['path', 'locations', 'encodings', 'timings', 'error'])
+
+# Row positions of the details shown for a match, as laid out in the CSVs
+MATCH_FIELDS = (('status', 2),)
+CRIMINAL_FIELDS = (('status', 2), ('age', 3), ('crime', 4), ('last_crime_date', 6),
+                   ('possibility_of_committing_crime', 7), ('case_number', 8))
+
+
+def _to_rgb(img, timings):
+    if img is None:
+        return None
+    start = time.perf_counter()
+    # The decoded buffer is ours, swap the channels in place instead of
+    # allocating a second full-resolution image
+    img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+    if timings is not None:
+        timings['convert'] = time.perf_counter() - start
+    return img_rgb
+
+
+def read_image_rgb(image_path, timings=None):
+    # With timings, imread goes to 'decode' and the BGR->RGB swap to 'convert'
+    start = time.perf_counter()
+    img = cv2.imread(image_path)
+    if timings is not None:
+        timings['decode'] = time.perf_counter() - start
+    return _to_rgb(img, timings)
+
+
+def decode_image_rgb(data, timings=None):
+    # RGB array from encoded (JPEG/PNG) bytes, or None
+    start = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if timings is not None:
+        timings['decode'] = time.perf_counter() - start
+    return _to_rgb(img, timings)
+
+
+def fit_image(img_rgb, max_width, max_height):
+    # Downscaled copy that fits max_width x max_height, or img_rgb itself
+    # (no copy) when it already fits
+    height, width = img_rgb.shape[:2]
+    scale = min(max_width / width, max_height / height)
+    if scale >= 1.0:
+        return img_rgb
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return cv2.resize(img_rgb, size, interpolation=cv2.INTER_AREA)
+
+
+def _scale_box(location, scale_y, scale_x, height, width):
+    top, right, bottom, left = location
+    return (max(0, int(round(top / scale_y))), min(width, int(round(right / scale_x))),
+            min(height, int(round(bottom / scale_y))), max(0, int(round(left / scale_x))))
+
+
+def detect_faces(img_rgb, max_side=DETECTION_MAX_SIDE, retry=True, timings=None):
+    # face_locations on a downscaled copy, boxes in full-resolution pixels.
+    # With retry, an empty result is re-run at twice the scale until faces
+    # are found or the full resolution has been tried.
+    if timings is None:
+        timings = {}
+    timings.setdefault('resize', 0.0)
+    timings.setdefault('detect', 0.0)
+    height, width = img_rgb.shape[:2]
+    scale = min(1.0, max_side / max(height, width)) if max_side else 1.0
+    while True:
+        start = time.perf_counter()
+        if scale < 1.0:
+            size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+            img_small = cv2.resize(img_rgb, size, interpolation=cv2.INTER_AREA)
+        else:
+            img_small = img_rgb
+        timings['resize'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        face_locations = face_recognition.face_locations(img_small)
+        timings['detect'] += time.perf_counter() - start
+
+        if face_locations or scale >= 1.0 or not retry:
+            # Per-axis factors of the actual resized shape, not the nominal scale
+            scale_y, scale_x = img_small.shape[0] / height, img_small.shape[1] / width
+            return [_scale_box(location, scale_y, scale_x, height, width) for location in face_locations]
+        scale = min(1.0, scale * 2)
+
+
+def detect_and_encode(img_rgb, max_side=DETECTION_MAX_SIDE, retry=True, timings=None):
+    if timings is None:
+        timings = {}
+    face_locations = detect_faces(img_rgb, max_side, retry, timings)
+    start = time.perf_counter()
+    face_encodings = face_recognition.face_encodings(img_rgb, face_locations)
+    timings['encode'] = time.perf_counter() - start
+    return face_locations, face_encodings
+
+
+def analyze_image(image_path, max_side=DETECTION_MAX_SIDE, retry=True):
+    # Decode, resize, detect and encode one image, timing every stage
+    timings = {}
+    img_rgb = read_image_rgb(image_path, timings)
+    if img_rgb is None:
+        return ImageFaces(image_path, [], [], timings, "Unable to read image")
+
+    face_locations, face_encodings = detect_and_encode(img_rgb, max_side, retry, timings)
+    return ImageFaces(image_path, face_locations, face_encodings, timings, None)
+
+
+def analyze_image_data(data, max_side=DETECTION_MAX_SIDE, retry=True, encode=True):
+    # analyze_image for an image received as bytes; without encode only
+    # the face boxes are returned
+    timings = {}
+    img_rgb = decode_image_rgb(data, timings)
+    if img_rgb is None:
+        return ImageFaces(None, [], [], timings, "Unable to decode image")
+
+    if encode:
+        face_locations, face_encodings = detect_and_encode(img_rgb, max_side, retry, timings)
+    else:
+        face_locations, face_encodings = detect_faces(img_rgb, max_side, retry, timings), []
+    return ImageFaces(None, face_locations, face_encodings, timings, None)
+
+
+def safe_analyze_image(image_path, max_side=DETECTION_MAX_SIDE, retry=True):
+    try:
+        return analyze_image(image_path, max_side, retry)
+    except Exception as e:
+        return ImageFaces(image_path, [], [], {}, str(e))
+
+
+def match_to_dict(match):
+    # Plain dict with the same details the app shows for a match
+    if match.category is None:
+        return {'name': None, 'category': "Unknown", 'distance': None}
+    record = {'name': match.name, 'category': CATEGORY_LABELS[match.category],
+              'distance': round(float(match.distance), 6)}
+    fields = CRIMINAL_FIELDS if match.category == CRIMINAL else MATCH_FIELDS
+    for key, column in fields:
+        record[key] = match.data[column] if column < len(match.data) else ""
+    return record
+
+
+def iter_image_paths(inputs):
+    # Files are taken as given, directories are walked for image files
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, filename)
+        else:
+            yield path
+
+
+def ordered_map(executor, fn, items, window):
+    # Like executor.map, but never more than `window` items are in flight, so
+    # a huge input list does not pile up as pending futures / results
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,140 @@
+import os
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from face_config import add_gallery_arguments, resolve_from_args
+from face_gallery import ENCODING_SIZE, load_encodings, load_gallery, save_gallery
+from face_index import Float16Index, Int8Index
+from face_matcher import MATCH_THRESHOLD, CRIMINAL, NON_CRIMINAL, FaceGallery
+
+# Python object overhead of one float64 encoding in the legacy lists
+# (ndarray header), on top of its 128 * 8 bytes of data
+LEGACY_ARRAY_OVERHEAD = 112
+
+
+def synthetic_gallery(directory, size, seed=0):
+    # Criminal and non-criminal compiled galleries of random encodings,
+    # loaded memory-mapped like the real ones
+    rng = np.random.default_rng(seed)
+    sources = []
+    for category, name in ((CRIMINAL, 'Criminal_faces'), (NON_CRIMINAL, 'Non-Criminal_faces')):
+        prefix = os.path.join(directory, name)
+        count = size // 2 if category == CRIMINAL else size - size // 2
+        encodings = rng.normal(0.0, 0.1, (count, ENCODING_SIZE)).astype(np.float32)
+        names = [f"{name} {i}" for i in range(count)]
+        save_gallery(prefix, encodings, ['Name', 'encoding'], [names, [""] * count])
+        sources.append((category,) + tuple(load_gallery(prefix).as_legacy()))
+    return sources
+
+
+def make_probes(sources, count, unknown=0.25, seed=1):
+    # Gallery faces with noise scaled so the distances straddle the threshold,
+    # where rounding can flip a decision, plus random unknown faces
+    rng = np.random.default_rng(seed)
+    encodings = np.concatenate([np.asarray(encodings, dtype=np.float32) for _, encodings, _, _ in sources])
+    known = count - int(count * unknown)
+    probes = encodings[rng.integers(len(encodings), size=known)]
+    scale = rng.uniform(0.5, 1.5, (known, 1)) * MATCH_THRESHOLD / np.sqrt(ENCODING_SIZE)
+    probes = probes + rng.normal(0.0, 1.0, probes.shape) * scale
+    strangers = rng.normal(encodings.mean(axis=0), encodings.std(axis=0), (count - known, ENCODING_SIZE))
+    return np.concatenate([probes, strangers]).astype(np.float32)
+
+
+def reference_decisions(sources, probes, threshold=MATCH_THRESHOLD, chunk_size=4096):
+    # (category, row in category) per probe as the original app decides it:
+    # float64 face_distance, criminals first; (None, -1) for unknown faces
+    probes = probes.astype(np.float64)
+    probe_sq_norms = np.einsum('ij,ij->i', probes, probes)
+    probe_ids = np.arange(len(probes))
+    decisions = [(None, -1)] * len(probes)
+    for category, encodings, _, _ in sorted(sources, key=lambda source: source[0]):
+        best_dists = np.full(len(probes), np.inf)
+        best_rows = np.full(len(probes), -1)
+        for start in range(0, len(encodings), chunk_size):
+            chunk = np.asarray(encodings[start:start + chunk_size], dtype=np.float64)
+            sq_dist = np.einsum('ij,ij->i', chunk, chunk) - 2 * probes @ chunk.T + probe_sq_norms[:, None]
+            dists = np.sqrt(np.maximum(sq_dist, 0.0))
+            cols = np.argmin(dists, axis=1)
+            dists = dists[probe_ids, cols]
+            better = dists < best_dists
+            best_dists[better] = dists[better]
+            best_rows[better] = start + cols[better]
+        for i in range(len(probes)):
+            if decisions[i][0] is None and best_dists[i] < threshold:
+                decisions[i] = (category, int(best_rows[i]))
+    return decisions
+
+
+def build(sources, kind, rerank):
+    # (gallery, bytes allocated building it); memory-mapped rows are not
+    # allocations, so only what the variant actually holds in RAM is counted
+    tracemalloc.start()
+    if kind == 'float32':
+        gallery = FaceGallery(sources)
+    else:
+        gallery = FaceGallery(sources, resident=False)
+        gallery.build_indexes(kind, rerank=rerank)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return gallery, allocated
+
+
+def evaluate(gallery, probes, reference, batch=64):
+    # (agreement, category agreement, queries/s) of the gallery's decisions
+    start = time.perf_counter()
+    matches = []
+    for first in range(0, len(probes), batch):
+        matches.extend(gallery.match_batch(probes[first:first + batch]))
+    qps = len(probes) / (time.perf_counter() - start)
+    same = same_category = 0
+    for match, (category, row) in zip(matches, reference):
+        same_category += match.category == category
+        same += match.category == category and (category is None or match.index == row)
+    return same / len(probes), same_category / len(probes), qps
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare float16/int8 galleries with exact re-ranking against the float64 decisions")
+    add_gallery_arguments(parser)
+    parser.add_argument('--synthetic', type=int, metavar='N', help="Use N random faces instead of the gallery files")
+    parser.add_argument('--kinds', nargs='+', default=['float32', Float16Index.kind, Int8Index.kind],
+                        choices=['float32', Float16Index.kind, Int8Index.kind])
+    parser.add_argument('--rerank', type=int, nargs='+', default=[32],
+                        help="Candidates re-ranked with exact distances (1 = no re-ranking)")
+    parser.add_argument('--probes', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.synthetic:
+            sources = synthetic_gallery(workdir, args.synthetic)
+        else:
+            location = resolve_from_args(args, scan_home=False)
+            if location is None:
+                parser.error("Gallery files not found, use --gallery-dir or --criminal/--non-criminal or --synthetic")
+            sources = [(CRIMINAL,) + tuple(load_encodings(location.criminal)),
+                       (NON_CRIMINAL,) + tuple(load_encodings(location.non_criminal))]
+        total = sum(len(encodings) for _, encodings, _, _ in sources)
+        probes = make_probes(sources, args.probes)
+        reference = reference_decisions(sources, probes)
+        known = sum(category is not None for category, _ in reference)
+        print(f"{total} faces, {len(probes)} probes ({known} matched by the float64 reference)")
+        legacy = total * (ENCODING_SIZE * 8 + LEGACY_ARRAY_OVERHEAD)
+        print(f"{'variant':<18} {'memory':>10} {'vs float64':>10} {'agreement':>10} {'category':>9} {'queries/s':>10}")
+        print(f"{'float64 lists':<18} {legacy / 2 ** 20:>8.1f}MB {1:>10.2f} {1:>10.4f} {1:>9.4f} {'-':>10}")
+
+        for kind in args.kinds:
+            for rerank in args.rerank if kind != 'float32' else [None]:
+                gallery, allocated = build(sources, kind, rerank)
+                agreement, category, qps = evaluate(gallery, probes, reference)
+                label = kind if rerank is None else f"{kind} rerank={rerank}"
+                print(f"{label:<18} {allocated / 2 ** 20:>8.1f}MB {allocated / legacy:>10.2f} "
+                      f"{agreement:>10.4f} {category:>9.4f} {qps:>10.0f}")
+                del gallery
+        del sources
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+from functools import partial
+from urllib.parse import parse_qsl, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from face_config import add_gallery_arguments, resolve_from_args
+from face_enroll import CATEGORY_NAMES, GalleryReloader, build_row, check_faces
+from face_gallery import ENCODING_SIZE, append_delta, read_header
+from face_index import INDEX_TYPES
+from face_metrics import METRICS, PROMETHEUS_CONTENT_TYPE, add_metrics_arguments, start_from_args
+from face_pipeline import DETECTION_MAX_SIDE, match_to_dict
+from face_workers import ENGINES, EncodingPool, analyze_data_in_worker
+
+# Local recognition service, plain HTTP/1.1 with keep-alive:
+#   POST /detect    image bytes -> face boxes
+#   POST /encode    image bytes -> face boxes and encodings
+#   POST /identify  image bytes, or JSON {"encodings": [[128 floats], ...]} -> matches
+#   POST /enroll?category=criminal&name=...&Status=...  image bytes -> enrolled row
+#   GET  /health    gallery size and micro-batching statistics
+#   GET  /metrics   per-stage timings and counters, Prometheus text format
+MAX_BODY_SIZE = 32 * 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader):
+    # (method, path, query, headers, body), or None when the client closed the connection
+    line = await reader.readline()
+    if not line:
+        return None
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise HTTPError(400, "Malformed request line")
+    method, target, _ = parts
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length < 0:
+        raise HTTPError(400, "Invalid Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413, f"Body larger than {MAX_BODY_SIZE} bytes")
+    body = await reader.readexactly(length) if length else b''
+    url = urlsplit(target)
+    return method.upper(), url.path, dict(parse_qsl(url.query)), headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    # payload is JSON-encoded, except text which is sent as Prometheus metrics
+    if isinstance(payload, str):
+        body, content_type = payload.encode('utf-8'), PROMETHEUS_CONTENT_TYPE
+    else:
+        body, content_type = json.dumps(payload).encode('utf-8'), "application/json"
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+
+
+class MicroBatcher:
+    """Coalesces concurrent identify calls into one match_batch.
+
+    The first queued request opens a batch, which closes after `window`
+    seconds or once `max_batch` probes are collected. Matching runs on a
+    single thread so the event loop keeps accepting requests, and the
+    next batch fills up while the previous one is being matched.
+    """
+
+    def __init__(self, gallery, window=0.002, max_batch=256):
+        self.gallery = gallery
+        self.window = window
+        self.max_batch = max_batch
+        self.executor = ThreadPoolExecutor(1)
+        self.queue = None
+        self.task = None
+        self.batches = 0
+        self.probes = 0
+        self.largest = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def identify(self, encodings):
+        # List of Match for a K x 128 float32 block
+        if not len(encodings):
+            return []
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((encodings, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = loop.time() + self.window
+        while size < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0 and self.queue.empty():
+                break
+            try:
+                item = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch, size
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, size = await self._collect()
+            # Every future of the batch gets its matches or the error, a bad
+            # batch must not stop the loop the other requests wait on
+            try:
+                probes = np.concatenate([encodings for encodings, _ in batch])
+                start = time.perf_counter()
+                matches = await loop.run_in_executor(self.executor, self.gallery.match_batch, probes)
+                METRICS.observe('match', time.perf_counter() - start)
+
+                self.batches += 1
+                self.probes += size
+                self.largest = max(self.largest, size)
+                offset = 0
+                for encodings, future in batch:
+                    # A client that disconnected leaves a cancelled future behind
+                    if not future.done():
+                        future.set_result(matches[offset:offset + len(encodings)])
+                    offset += len(encodings)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def stats(self):
+        return {
+            'window_ms': self.window * 1000,
+            'max_batch': self.max_batch,
+            'batches': self.batches,
+            'probes': self.probes,
+            'mean_batch': round(self.probes / self.batches, 2) if self.batches else 0.0,
+            'largest_batch': self.largest,
+        }
+
+
+class RecognitionService:
+    """HTTP front end over one shared gallery, worker pool and batcher."""
+
+    def __init__(self, reloader, pool, batcher, max_side=DETECTION_MAX_SIDE, retry=True):
+        self.reloader = reloader
+        self.gallery = reloader.gallery
+        # Enrollments and delta files written by face_enroll.py swap in a new
+        # gallery snapshot, requests already being matched keep the old one
+        reloader.subscribe(self.set_gallery)
+        self.pool = pool
+        self.batcher = batcher
+        self.max_side = max_side
+        self.retry = retry
+        self.requests = 0
+        self.started = time.monotonic()
+        self.routes = {
+            ('POST', '/detect'): self.detect,
+            ('POST', '/encode'): self.encode,
+            ('POST', '/identify'): self.identify,
+            ('POST', '/enroll'): self.enroll,
+            ('GET', '/health'): self.health,
+            ('GET', '/metrics'): self.metrics,
+        }
+
+    def set_gallery(self, gallery):
+        self.gallery = gallery
+        self.batcher.gallery = gallery
+
+    async def analyze(self, body, encode):
+        # Decode/detect/encode in the worker pool, never on the event loop
+        if not body:
+            raise HTTPError(400, "Expected an image in the request body")
+        loop = asyncio.get_running_loop()
+        faces = await loop.run_in_executor(self.pool.executor, partial(
+            analyze_data_in_worker, body, max_side=self.max_side, retry=self.retry, encode=encode))
+        METRICS.observe_timings(faces.timings)
+        if faces.error:
+            raise HTTPError(400, faces.error)
+        METRICS.record_image(len(faces.locations))
+        return faces
+
+    @staticmethod
+    def _timings(faces):
+        return {stage: round(seconds * 1000, 3) for stage, seconds in faces.timings.items()}
+
+    async def detect(self, query, headers, body):
+        faces = await self.analyze(body, encode=False)
+        return {'faces': [{'box': list(location)} for location in faces.locations],
+                'timings_ms': self._timings(faces)}
+
+    async def encode(self, query, headers, body):
+        faces = await self.analyze(body, encode=True)
+        return {'faces': [{'box': list(location), 'encoding': encoding.tolist()}
+                          for location, encoding in zip(faces.locations, faces.encodings)],
+                'timings_ms': self._timings(faces)}
+
+    async def identify(self, query, headers, body):
+        if headers.get('content-type', '').startswith('application/json'):
+            try:
+                encodings = np.asarray(json.loads(body)['encodings'], dtype=np.float32)
+            except (ValueError, KeyError, TypeError) as e:
+                raise HTTPError(400, f"Expected {{\"encodings\": [[...], ...]}}: {e}")
+            if not encodings.size:
+                return {'matches': []}
+            if encodings.ndim != 2 or encodings.shape[1] != ENCODING_SIZE or not np.isfinite(encodings).all():
+                raise HTTPError(400, f"Encodings must be finite {ENCODING_SIZE}-vectors")
+            matches = await self.batcher.identify(encodings)
+            METRICS.record_matches(matches)
+            return {'matches': [match_to_dict(match) for match in matches]}
+
+        faces = await self.analyze(body, encode=True)
+        matches = await self.batcher.identify(faces.encodings)
+        METRICS.record_matches(matches)
+        return {'faces': [{'box': list(location), 'match': match_to_dict(match)}
+                          for location, match in zip(faces.locations, matches)],
+                'timings_ms': self._timings(faces)}
+
+    async def enroll(self, query, headers, body):
+        query = dict(query)
+        category = CATEGORY_NAMES.get(query.pop('category', ''))
+        name = query.pop('name', '')
+        if category is None or not name:
+            raise HTTPError(400, f"Expected ?category={'|'.join(sorted(CATEGORY_NAMES))}&name=...")
+        faces = await self.analyze(body, encode=True)
+        error = check_faces(faces)
+        if error:
+            raise HTTPError(400, error)
+
+        gallery_file = self.reloader.files[category]
+        header, encoding_column = read_header(gallery_file)
+        row = build_row(header, encoding_column, name, faces.encodings[0], query)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, append_delta, gallery_file, [row])
+        # Visible to the very next request, not only after the next poll
+        gallery = await loop.run_in_executor(None, self.reloader.poll)
+        return {'name': name, 'box': list(faces.locations[0]), 'faces': len(gallery)}
+
+    async def metrics(self, query, headers, body):
+        return METRICS.render_prometheus()
+
+    async def health(self, query, headers, body):
+        return {'status': "ok", 'faces': len(self.gallery), 'gallery_version': self.gallery.version,
+                'requests': self.requests, 'uptime_s': round(time.monotonic() - self.started, 1),
+                'reloads': self.reloader.reloads, 'enrolled': self.reloader.appended,
+                'batching': self.batcher.stats()}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HTTPError as e:
+                    write_response(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, query, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self.requests += 1
+
+                handler = self.routes.get((method, path))
+                if handler is not None:
+                    try:
+                        status, payload = 200, await handler(query, headers, body)
+                    except HTTPError as e:
+                        status, payload = e.status, {'error': str(e)}
+                    except Exception as e:
+                        status, payload = 500, {'error': str(e)}
+                elif any(route_path == path for _, route_path in self.routes):
+                    status, payload = 405, {'error': f"{method} not allowed on {path}"}
+                else:
+                    status, payload = 404, {'error': f"No such endpoint {path}"}
+
+                METRICS.count('requests', path)
+                if status >= 400:
+                    METRICS.count('errors', path)
+                write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(service, host, port):
+    service.batcher.start()
+    server = await asyncio.start_server(service.handle_connection, host, port)
+    print(f"Listening on http://{host}:{port}", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.batcher.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve face detection and recognition over HTTP")
+    add_gallery_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on")
+    parser.add_argument('--port', type=int, default=8080, help="Port to listen on")
+    parser.add_argument('--index', choices=sorted(INDEX_TYPES), help="Search the gallery through an index")
+    parser.add_argument('--on-disk', action='store_true',
+                        help="Leave compiled gallery encodings on disk, only the index is kept in memory "
+                             "(use with --index int8/float16)")
+    parser.add_argument('--watch', type=float, default=1.0,
+                        help="Check the gallery files for enrollments every N seconds (0 = off)")
+    parser.add_argument('--batch-window-ms', type=float, default=2.0,
+                        help="How long an identify batch waits for more requests")
+    parser.add_argument('--max-batch', type=int, default=256, help="Probes matched in one batch at most")
+    parser.add_argument('--detect-max-side', type=int, default=DETECTION_MAX_SIDE,
+                        help="Detect on a copy no larger than this (0 = full resolution)")
+    parser.add_argument('--no-retry', action='store_true',
+                        help="Do not retry at higher resolution when no face is found")
+    parser.add_argument('--workers', type=int, help="Detection/encoding workers (default: one per core)")
+    parser.add_argument('--engine', choices=ENGINES, default='process', help="Run workers as processes or threads")
+    parser.add_argument('--no-metrics', action='store_true', help="Do not collect stage timings for /metrics")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    if args.on_disk and not args.index:
+        parser.error("--on-disk needs an --index")
+
+    METRICS.enabled = not args.no_metrics
+    stop_metrics = start_from_args(args)
+    start = time.perf_counter()
+    location = resolve_from_args(args, scan_home=False)
+    if location is None:
+        parser.error("Gallery files not found, use --gallery-dir or --criminal/--non-criminal")
+    reloader = GalleryReloader(location.criminal, location.non_criminal, args.watch, index_kind=args.index,
+                               resident=not args.on_disk)
+    gallery = reloader.gallery
+    print(f"Gallery: {len(gallery)} faces from {location.source} loaded in {time.perf_counter() - start:.2f}s",
+          file=sys.stderr)
+
+    batcher = MicroBatcher(gallery, args.batch_window_ms / 1000, args.max_batch)
+    with EncodingPool(args.workers, engine=args.engine) as pool:
+        print(f"Workers: {pool.workers} ({args.engine})", file=sys.stderr)
+        service = RecognitionService(reloader, pool, batcher, args.detect_max_side, not args.no_retry)
+        if args.watch:
+            reloader.start()
+        try:
+            asyncio.run(serve(service, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            reloader.stop()
+            stop_metrics()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+import multiprocessing
+import numpy as np
+from face_config import add_gallery_arguments, resolve_from_args
+from face_gallery import ENCODING_SIZE, load_encodings
+from face_index import INDEX_TYPES
+from face_matcher import (MATCH_THRESHOLD, CATEGORY_LABELS, CRIMINAL, NON_CRIMINAL, FaceGallery, Match,
+                          SearchResult, _versions)
+
+# Wire format, both directions: 4-byte big-endian header length, a JSON
+# header, then header['payload'] bytes of raw little-endian arrays.
+#   match request:  {'op': 'match', 'count': K, 'k': k} + K x 128 float32 probes
+#   match response: {'count': K, 'k': k, 'identities': ...} + K x 2 x k float32
+#                   distances + K x 2 x k int64 rows, per category, best first
+#   info response:  {'rows': [criminal rows, non-criminal rows], 'offsets': [first rows], ...}
+# No pickle, so a shard never runs code sent by a peer.
+_LENGTH = struct.Struct('!I')
+MAX_HEADER = 1 << 24
+DEFAULT_PORT = 9170
+
+
+def send_frame(sock, header, *arrays):
+    payload = b''.join(np.ascontiguousarray(array).tobytes() for array in arrays)
+    data = json.dumps(dict(header, payload=len(payload))).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(data)) + data + payload)
+
+
+def _recv_exactly(sock, size):
+    buffer = bytearray(size)
+    view, received = memoryview(buffer), 0
+    while received < size:
+        got = sock.recv_into(view[received:])
+        if not got:
+            raise ConnectionError("Connection closed")
+        received += got
+    return buffer
+
+
+def recv_frame(sock):
+    # (header, payload bytes)
+    size, = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    if size > MAX_HEADER:
+        raise ValueError(f"Frame header of {size} bytes")
+    header = json.loads(_recv_exactly(sock, size).decode('utf-8'))
+    return header, _recv_exactly(sock, header.get('payload', 0))
+
+
+def shard_range(total, shard, shards):
+    # Rows [start, stop) of a category file served by one shard
+    return total * shard // shards, total * (shard + 1) // shards
+
+
+class GalleryShard:
+    """One contiguous slice of each category file, searched per category.
+
+    Only the compiled (or CSV) rows are served; compact enrolled faces into
+    the gallery (face_enroll.py --compact) before sharding it.
+    """
+
+    def __init__(self, criminal_file, non_criminal_file, shard=0, shards=1, threshold=MATCH_THRESHOLD,
+                 index_kind=None, resident=True, **index_params):
+        self.shard, self.shards = shard, shards
+        self.threshold = threshold
+        # category -> (FaceGallery of the slice, first row of the slice in the file)
+        self.galleries = {}
+        for category, path in ((CRIMINAL, criminal_file), (NON_CRIMINAL, non_criminal_file)):
+            encodings, names, data = load_encodings(path)
+            start, stop = shard_range(len(names), shard, shards)
+            gallery = FaceGallery([(category, encodings[start:stop], names[start:stop], data[start:stop])],
+                                  threshold, resident)
+            if index_kind is not None:
+                gallery.build_indexes(index_kind, **index_params)
+            self.galleries[category] = (gallery, start)
+
+    def info(self):
+        return {'shard': self.shard, 'shards': self.shards,
+                'rows': [len(self.galleries[category][0]) for category in sorted(CATEGORY_LABELS)],
+                'offsets': [self.galleries[category][1] for category in sorted(CATEGORY_LABELS)]}
+
+    def search(self, probes, k=1):
+        # (K x 2 x k distances, K x 2 x k rows in the category files, identities),
+        # identities[i][category] is [name, data] of the best row when it is
+        # within the threshold, else None
+        distances = np.full((len(probes), len(CATEGORY_LABELS), k), np.inf, dtype=np.float32)
+        rows = np.full((len(probes), len(CATEGORY_LABELS), k), -1, dtype=np.int64)
+        identities = [[None] * len(CATEGORY_LABELS) for _ in range(len(probes))]
+        for category, (gallery, offset) in self.galleries.items():
+            if not len(gallery):
+                continue
+            result = gallery.search(probes, k)
+            found = result.rows.shape[1]
+            distances[:, category, :found] = result.distances
+            rows[:, category, :found] = np.where(result.rows >= 0, result.rows + offset, -1)
+            for i in np.flatnonzero(result.distances[:, 0] < self.threshold):
+                match = gallery.describe(int(result.rows[i, 0]), float(result.distances[i, 0]))
+                identities[i][category] = [match.name, list(match.data)]
+        return distances, rows, identities
+
+
+class _ShardHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        shard = self.server.shard
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while True:
+            try:
+                header, payload = recv_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                if header.get('op') == 'match':
+                    probes = np.frombuffer(payload, dtype='<f4').reshape(header['count'], ENCODING_SIZE)
+                    distances, rows, identities = shard.search(probes, int(header.get('k', 1)))
+                    send_frame(self.request, {'count': len(probes), 'k': distances.shape[2],
+                                              'identities': identities}, distances.astype('<f4'), rows.astype('<i8'))
+                elif header.get('op') == 'info':
+                    send_frame(self.request, shard.info())
+                else:
+                    send_frame(self.request, {'error': f"Unknown op {header.get('op')!r}"})
+            except Exception as e:
+                print(f"Error serving shard request: {e}")
+                send_frame(self.request, {'error': str(e)})
+
+
+class ShardServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, shard):
+        self.shard = shard
+        super().__init__(address, _ShardHandler)
+
+
+class ShardConnection:
+    """Persistent connection to one shard, reconnected after a failure."""
+
+    def __init__(self, address, timeout=30.0):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+
+    def send(self, header, *arrays):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        send_frame(self.sock, header, *arrays)
+
+    def receive(self):
+        header, payload = recv_frame(self.sock)
+        if 'error' in header:
+            raise RuntimeError(f"Shard {format_address(self.address)}: {header['error']}")
+        return header, payload
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def parse_address(text, default_port=DEFAULT_PORT):
+    host, _, port = text.rpartition(':')
+    return (host, int(port)) if host else (text, default_port)
+
+
+def format_address(address):
+    return f"{address[0]}:{address[1]}"
+
+
+class ShardedGallery:
+    """FaceGallery stand-in whose rows are spread over shard servers.
+
+    Every shard returns its top-k per category; merging them gives the same
+    criminal-first decision against the same threshold as one FaceGallery
+    over all rows. Match.index is the row in the category file.
+    """
+
+    def __init__(self, addresses, threshold=MATCH_THRESHOLD, timeout=30.0):
+        self.threshold = threshold
+        self.version = next(_versions)
+        self.connections = [ShardConnection(address, timeout) for address in addresses]
+        self._lock = threading.Lock()
+        self.shard_info = [header for header, _ in self._broadcast({'op': 'info'})]
+        self.rows = np.sum([info['rows'] for info in self.shard_info], axis=0)
+
+    def _broadcast(self, header, *arrays):
+        # Send to every shard first so they work in parallel, then collect
+        with self._lock:
+            try:
+                for connection in self.connections:
+                    connection.send(header, *arrays)
+                return [connection.receive() for connection in self.connections]
+            except (OSError, ValueError, RuntimeError) as e:
+                # The connections' request/response pairing is lost, start over
+                for connection in self.connections:
+                    connection.close()
+                raise ConnectionError(f"Sharded gallery request failed: {e}") from e
+
+    def __len__(self):
+        return int(self.rows.sum())
+
+    def count(self, category):
+        return int(self.rows[category])
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+    def _search(self, probes, k):
+        # Per category top-k over all shards: (K x 2 x k distances, rows, identity per row)
+        probes = np.asarray(probes, dtype='<f4').reshape(-1, ENCODING_SIZE)
+        distances, rows, identities = [], [], []
+        for header, payload in self._broadcast({'op': 'match', 'count': len(probes), 'k': k}, probes):
+            shape = (header['count'], len(CATEGORY_LABELS), header['k'])
+            size = int(np.prod(shape))
+            distances.append(np.frombuffer(payload, dtype='<f4', count=size).reshape(shape))
+            rows.append(np.frombuffer(payload, dtype='<i8', count=size, offset=size * 4).reshape(shape))
+            identities.append(header['identities'])
+        distances, rows = np.concatenate(distances, axis=2), np.concatenate(rows, axis=2)
+        order = np.argsort(distances, axis=2, kind='stable')[:, :, :k]
+        shard_of = order // k
+        return (np.take_along_axis(distances, order, axis=2), np.take_along_axis(rows, order, axis=2),
+                shard_of, identities)
+
+    def search(self, probes, k=1):
+        # Top-k over both categories; rows are rows of their category file
+        distances, rows, _, _ = self._search(probes, k)
+        categories = np.broadcast_to(np.arange(len(CATEGORY_LABELS))[None, :, None], rows.shape)
+        distances, rows, categories = (array.reshape(len(rows), -1) for array in (distances, rows, categories))
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        rows = np.take_along_axis(rows, order, axis=1)
+        categories = np.where(rows >= 0, np.take_along_axis(categories, order, axis=1), -1)
+        return SearchResult(rows, np.take_along_axis(distances, order, axis=1), categories)
+
+    def match(self, face_encoding):
+        return self.match_batch([face_encoding])[0]
+
+    def match_batch(self, probes):
+        distances, rows, shard_of, identities = self._search(probes, 1)
+        matches = []
+        for i in range(len(distances)):
+            # Criminal first, then non-criminal, both against the same threshold
+            for category in (CRIMINAL, NON_CRIMINAL):
+                if distances[i, category, 0] < self.threshold:
+                    name, data = identities[shard_of[i, category, 0]][i][category]
+                    matches.append(Match(category, int(rows[i, category, 0]), float(distances[i, category, 0]),
+                                         name, data))
+                    break
+            else:
+                matches.append(Match(None, -1, np.inf, None, None))
+        return matches
+
+
+def _run_shard(files, shard, shards, params, host, conn):
+    # Child process of LocalShards: load the slice, report the port, serve
+    try:
+        server = ShardServer((host, 0), GalleryShard(*files, shard, shards, **params))
+    except Exception as e:
+        conn.send(f"Error: {e}")
+        return
+    conn.send(server.server_address[1])
+    conn.close()
+    server.serve_forever()
+
+
+class LocalShards:
+    """Shard servers in child processes of this one, for a single machine."""
+
+    def __init__(self, criminal_file, non_criminal_file, shards, host='127.0.0.1', **params):
+        context = multiprocessing.get_context('spawn')
+        self.processes, self.addresses = [], []
+        try:
+            pipes = []
+            for shard in range(shards):
+                parent, child = context.Pipe()
+                process = context.Process(target=_run_shard, name=f"gallery-shard-{shard}", daemon=True,
+                                          args=((criminal_file, non_criminal_file), shard, shards, params, host, child))
+                process.start()
+                self.processes.append(process)
+                pipes.append(parent)
+            for shard, pipe in enumerate(pipes):
+                port = pipe.recv()
+                if isinstance(port, str):
+                    raise RuntimeError(f"Shard {shard}: {port}")
+                self.addresses.append((host, port))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def add_shard_arguments(parser):
+    parser.add_argument('--shard-addr', nargs='+', metavar='HOST:PORT',
+                        help="Match against gallery shards served by face_shard.py serve")
+    parser.add_argument('--local-shards', type=int, metavar='N',
+                        help="Split the gallery over N shard processes on this machine")
+
+
+def check(gallery, reference, probes, batch):
+    # (agreement with the single-process decisions, sharded queries/s, single queries/s)
+    timings = []
+    decisions = []
+    for target in (gallery, reference):
+        start = time.perf_counter()
+        matches = []
+        for first in range(0, len(probes), batch):
+            matches.extend(target.match_batch(probes[first:first + batch]))
+        timings.append(len(probes) / (time.perf_counter() - start))
+        decisions.append([(match.category, match.index, match.name) for match in matches])
+    agreement = np.mean([a == b for a, b in zip(*decisions)])
+    return agreement, timings[0], timings[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve gallery shards, or check sharded against single-process matching")
+    parser.add_argument('mode', choices=['serve', 'check'])
+    add_gallery_arguments(parser)
+    parser.add_argument('--shard', default='0/1', help="serve: which slice to serve, as INDEX/COUNT")
+    parser.add_argument('--host', default='127.0.0.1', help="serve: address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="serve: port to listen on")
+    parser.add_argument('--index', choices=sorted(INDEX_TYPES), help="Search each shard through an index")
+    parser.add_argument('--on-disk', action='store_true', help="Keep encodings on disk (with --index int8/float16)")
+    add_shard_arguments(parser)
+    parser.add_argument('--probes', type=int, default=1000, help="check: probes to compare")
+    parser.add_argument('--batch', type=int, default=64, help="check: probes per request")
+    args = parser.parse_args()
+
+    location = resolve_from_args(args, scan_home=False)
+    if location is None:
+        parser.error("Gallery files not found, use --gallery-dir or --criminal/--non-criminal")
+    if args.on_disk and not args.index:
+        parser.error("--on-disk needs an --index")
+    params = {'index_kind': args.index, 'resident': not args.on_disk}
+
+    if args.mode == 'serve':
+        shard, _, shards = args.shard.partition('/')
+        shard, shards = int(shard), int(shards or 1)
+        if not 0 <= shard < shards:
+            parser.error(f"--shard {args.shard} is out of range")
+        start = time.perf_counter()
+        server = ShardServer((args.host, args.port), GalleryShard(location.criminal, location.non_criminal,
+                                                                   shard, shards, **params))
+        info = server.shard.info()
+        print(f"Shard {shard}/{shards}: {sum(info['rows'])} faces loaded in {time.perf_counter() - start:.2f}s, "
+              f"listening on {format_address(server.server_address)}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    local = None
+    if args.shard_addr:
+        addresses = [parse_address(address) for address in args.shard_addr]
+    else:
+        local = LocalShards(location.criminal, location.non_criminal, args.local_shards or 2, **params)
+        addresses = local.addresses
+    try:
+        gallery = ShardedGallery(addresses)
+        # Shards serve the gallery files without their enrolled deltas
+        reference = FaceGallery([(CRIMINAL,) + tuple(load_encodings(location.criminal)),
+                                 (NON_CRIMINAL,) + tuple(load_encodings(location.non_criminal))])
+        print(f"{len(gallery)} faces on {len(addresses)} shards, {len(reference)} in the single-process gallery")
+        rng = np.random.default_rng(0)
+        known = reference.rows(0, len(reference))[rng.integers(len(reference), size=args.probes)]
+        probes = known + rng.normal(0.0, 0.05, known.shape).astype(np.float32)
+        agreement, sharded_qps, single_qps = check(gallery, reference, probes, args.batch)
+        print(f"Decisions agree on {agreement:.2%} of {len(probes)} probes; "
+              f"sharded {sharded_qps:.0f} queries/s, single process {single_qps:.0f} queries/s")
+        gallery.close()
+    finally:
+        if local is not None:
+            local.close()
+    sys.exit(0 if agreement == 1.0 else 1)
+
+
+if __name__ == "__main__":
+    main()
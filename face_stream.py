@@ -0,0 +1,362 @@
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import namedtuple, deque
+import cv2
+import numpy as np
+import face_recognition
+from face_config import add_gallery_arguments, resolve_from_args
+from face_cache import DEFAULT_RADIUS, IdentityCache
+from face_enroll import GalleryReloader
+from face_metrics import METRICS, add_metrics_arguments, start_from_args
+from face_pipeline import DETECTION_MAX_SIDE, detect_faces, match_to_dict
+
+# One decoded frame; captured_at is time.perf_counter() when it was read
+Frame = namedtuple('Frame', ['index', 'captured_at', 'image'])
+
+
+def open_capture(source):
+    # Device index ("0"), video file or stream URL (rtsp://, http://)
+    if str(source).isdigit():
+        return cv2.VideoCapture(int(source))
+    return cv2.VideoCapture(source)
+
+
+def is_live_source(source):
+    return str(source).isdigit() or '://' in str(source)
+
+
+class FrameGrabber:
+    """Reads frames on a background thread and hands over only the latest one.
+
+    In realtime mode a frame that was not picked up before the next one
+    arrives is dropped (and counted) instead of queueing up behind a slow
+    consumer. Otherwise the reader waits, so every frame of a file is seen.
+    Recorded files can be paced at their native frame rate to behave like
+    a live camera.
+    """
+
+    def __init__(self, capture, realtime=True, pace_fps=None):
+        self.capture = capture
+        self.realtime = realtime
+        self.pace_fps = pace_fps
+        self.frames_read = 0
+        self.dropped = 0
+        self.finished = False
+        self._latest = None
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        started = time.perf_counter()
+        while not self._stopped:
+            ok, image = self.capture.read()
+            if not ok:
+                break
+            if self.pace_fps:
+                # Do not read a recorded file faster than it was filmed
+                delay = started + self.frames_read / self.pace_fps - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            frame = Frame(self.frames_read, time.perf_counter(), image)
+            self.frames_read += 1
+            with self._condition:
+                if not self.realtime:
+                    while self._latest is not None and not self._stopped:
+                        self._condition.wait()
+                elif self._latest is not None:
+                    self.dropped += 1
+                self._latest = frame
+                self._condition.notify_all()
+        with self._condition:
+            self.finished = True
+            self._condition.notify_all()
+
+    def read(self, timeout=1.0):
+        # Latest unread frame, None once the source is exhausted
+        with self._condition:
+            while self._latest is None and not self.finished:
+                self._condition.wait(timeout)
+            frame, self._latest = self._latest, None
+            self._condition.notify_all()
+            return frame
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout=2.0)
+        self.capture.release()
+
+
+def box_iou(a, b):
+    # IoU of two (top, right, bottom, left) boxes
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - inter
+    return inter / union if union > 0 else 0.0
+
+
+class Track:
+    def __init__(self, track_id, box, frame_index):
+        self.id = track_id
+        self.box = tuple(box)
+        self.velocity = np.zeros(4)
+        self.last_frame = frame_index
+        self.iou = 1.0
+        self.missed = 0
+        self.match = None
+        self.encoded_frame = None
+
+    def predict(self, frame_index):
+        # Constant-velocity guess of the box between detections
+        steps = frame_index - self.last_frame
+        return tuple(int(round(v)) for v in np.asarray(self.box) + self.velocity * steps)
+
+    def update(self, box, frame_index, iou):
+        steps = max(1, frame_index - self.last_frame)
+        self.velocity = (np.asarray(box) - np.asarray(self.box)) / steps
+        self.box = tuple(box)
+        self.last_frame = frame_index
+        self.iou = iou
+        self.missed = 0
+
+
+class FaceTracker:
+    """Greedy IoU association of detections to tracks."""
+
+    def __init__(self, min_iou=0.3, max_missed=2):
+        self.min_iou = min_iou
+        self.max_missed = max_missed
+        self.tracks = []
+        self._next_id = 1
+
+    def update(self, boxes, frame_index):
+        # Returns the new tracks created for unmatched detections
+        predicted = [track.predict(frame_index) for track in self.tracks]
+        pairs = sorted(((box_iou(p, box), t, d) for t, p in enumerate(predicted) for d, box in enumerate(boxes)),
+                       reverse=True)
+        used_tracks, used_boxes = set(), set()
+        for iou, t, d in pairs:
+            if iou < self.min_iou:
+                break
+            if t in used_tracks or d in used_boxes:
+                continue
+            self.tracks[t].update(boxes[d], frame_index, iou)
+            used_tracks.add(t)
+            used_boxes.add(d)
+
+        for t, track in enumerate(self.tracks):
+            if t not in used_tracks:
+                track.missed += 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+
+        new_tracks = []
+        for d, box in enumerate(boxes):
+            if d not in used_boxes:
+                track = Track(self._next_id, box, frame_index)
+                self._next_id += 1
+                new_tracks.append(track)
+        self.tracks.extend(new_tracks)
+        return new_tracks
+
+
+class StreamStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.frames_processed = 0
+        self.detections = 0
+        self.encodings = 0
+        # Recent frames only, so a long-running stream keeps constant memory
+        self.latencies = deque(maxlen=10000)
+
+    def summary(self, grabber, cache=None):
+        elapsed = time.perf_counter() - self.started
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'frames_read': grabber.frames_read,
+            'frames_processed': self.frames_processed,
+            'frames_dropped': grabber.dropped,
+            'fps': round(self.frames_processed / elapsed, 2) if elapsed else 0.0,
+            'detections': self.detections,
+            'encodings': self.encodings,
+            'latency_ms': {
+                'mean': round(float(latencies.mean()), 2),
+                'p50': round(float(np.percentile(latencies, 50)), 2),
+                'p95': round(float(np.percentile(latencies, 95)), 2),
+                'max': round(float(latencies.max()), 2),
+            },
+            'cache': cache.stats() if cache is not None else None,
+        }
+
+
+class StreamRecognizer:
+    """Detect every Nth frame, track in between, encode only new or uncertain tracks."""
+
+    def __init__(self, gallery, detect_every=5, max_side=DETECTION_MAX_SIDE, uncertain_margin=0.05,
+                 strong_iou=0.5, cache=None):
+        self.gallery = gallery
+        self.detect_every = max(1, detect_every)
+        self.max_side = max_side
+        self.uncertain_margin = uncertain_margin
+        self.strong_iou = strong_iou
+        # Track ids resolve to a cached identity until its TTL runs out,
+        # encodings of lost-and-found faces skip the gallery scan
+        self.cache = cache if cache is not None else IdentityCache(ttl=10.0)
+        self.tracker = FaceTracker()
+        self.stats = StreamStats()
+
+    def is_uncertain(self, match):
+        # Unknown or close to the threshold
+        if match.category is None:
+            return True
+        return abs(match.distance - self.gallery.threshold) < self.uncertain_margin
+
+    def needs_encoding(self, track, is_new):
+        # New, loosely associated, expired in the cache, or uncertain
+        if is_new or track.iou < self.strong_iou:
+            return True
+        match = self.cache.lookup_track(track.id)
+        return match is None or self.is_uncertain(match)
+
+    def process(self, frame):
+        # Count processed frames rather than frame.index so dropped frames
+        # do not skip detections
+        self.stats.frames_processed += 1
+        if (self.stats.frames_processed - 1) % self.detect_every == 0:
+            timings = {}
+            with METRICS.span('convert'):
+                img_rgb = cv2.cvtColor(frame.image, cv2.COLOR_BGR2RGB)
+            boxes = detect_faces(img_rgb, self.max_side, retry=False, timings=timings)
+            METRICS.observe_timings(timings)
+            METRICS.record_image(len(boxes))
+            self.stats.detections += 1
+            new_tracks = self.tracker.update(boxes, frame.index)
+
+            pending = [track for track in self.tracker.tracks
+                       if track.last_frame == frame.index and self.needs_encoding(track, track in new_tracks)]
+            if pending:
+                with METRICS.span('encode'):
+                    encodings = face_recognition.face_encodings(img_rgb, [track.box for track in pending])
+                self.stats.encodings += len(encodings)
+                with METRICS.span('match'):
+                    matches = self.cache.match_batch(self.gallery, encodings)
+                METRICS.record_matches(matches)
+                for track, match in zip(pending, matches):
+                    track.match = match
+                    track.encoded_frame = frame.index
+                    if not self.is_uncertain(match):
+                        self.cache.store_track(track.id, match)
+
+        self.stats.latencies.append(time.perf_counter() - frame.captured_at)
+        return [{'track': track.id,
+                 'box': list(track.predict(frame.index)),
+                 'match': match_to_dict(track.match) if track.match is not None else None}
+                for track in self.tracker.tracks]
+
+
+def draw_tracks(image, tracks):
+    for track in tracks:
+        top, right, bottom, left = track['box']
+        match = track['match']
+        label = f"#{track['track']} {match['name'] or 'Unknown'}" if match else f"#{track['track']}"
+        color = (0, 0, 255) if match and match['category'] == "Criminal" else (0, 200, 0)
+        cv2.rectangle(image, (left, top), (right, bottom), color, 2)
+        cv2.putText(image, label, (left, max(0, top - 6)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recognize faces in a video file, stream URL or camera")
+    parser.add_argument('source', help="Video file, stream URL (rtsp://...) or camera index")
+    add_gallery_arguments(parser)
+    parser.add_argument('--detect-every', type=int, default=5, help="Run detection on every Nth frame")
+    parser.add_argument('--detect-max-side', type=int, default=DETECTION_MAX_SIDE)
+    parser.add_argument('--cache-size', type=int, default=1024, help="Identity cache entries, a face within "
+                             f"{DEFAULT_RADIUS} of a cached one reuses its decision")
+    parser.add_argument('--cache-ttl', type=float, default=10.0, help="Seconds a track keeps its identity")
+    parser.add_argument('--realtime', action='store_true',
+                        help="Pace files at their frame rate and drop frames when behind (always on for live sources)")
+    parser.add_argument('--max-frames', type=int, help="Stop after this many processed frames")
+    parser.add_argument('-o', '--output', help="Write per-frame tracks as JSONL")
+    parser.add_argument('--summary-json',
+                        help="Write the final stream summary (fps, dropped frames, latency, cache) as JSON; "
+                             "stage metrics go to --metrics-json")
+    parser.add_argument('--summary-every', type=float, default=5.0,
+                        help="Print the stream summary every N seconds (0 = off)")
+    parser.add_argument('--watch', type=float, default=5.0,
+                        help="Check the gallery files for enrollments every N seconds (0 = off)")
+    add_metrics_arguments(parser)
+    parser.add_argument('--show', action='store_true', help="Display the annotated stream")
+    args = parser.parse_args()
+
+    location = resolve_from_args(args, scan_home=False)
+    if location is None:
+        parser.error("Gallery files not found, use --gallery-dir or --criminal/--non-criminal")
+    cache = IdentityCache(args.cache_size, args.cache_ttl)
+    stop_metrics = start_from_args(args)
+    reloader = GalleryReloader(location.criminal, location.non_criminal, args.watch)
+    recognizer = StreamRecognizer(reloader.gallery, args.detect_every, args.detect_max_side, cache=cache)
+    # Faces enrolled while the stream runs are matched from the next detection on
+    reloader.subscribe(lambda gallery: setattr(recognizer, 'gallery', gallery))
+    if args.watch:
+        reloader.start()
+
+    capture = open_capture(args.source)
+    if not capture.isOpened():
+        parser.error(f"Unable to open {args.source}")
+    live = is_live_source(args.source)
+    realtime = live or args.realtime
+    pace_fps = capture.get(cv2.CAP_PROP_FPS) if args.realtime and not live else None
+    grabber = FrameGrabber(capture, realtime, pace_fps or None).start()
+
+    output = open(args.output, mode='w') if args.output else None
+    last_report = time.perf_counter()
+    try:
+        while True:
+            frame = grabber.read()
+            if frame is None:
+                break
+            tracks = recognizer.process(frame)
+            if output:
+                output.write(json.dumps({'frame': frame.index, 'tracks': tracks}) + "\n")
+            if args.show:
+                draw_tracks(frame.image, tracks)
+                cv2.imshow("Face Recognition Stream", frame.image)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+            if args.summary_every and time.perf_counter() - last_report >= args.summary_every:
+                print(json.dumps(recognizer.stats.summary(grabber, recognizer.cache)), file=sys.stderr)
+                last_report = time.perf_counter()
+            if args.max_frames and recognizer.stats.frames_processed >= args.max_frames:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        grabber.stop()
+        reloader.stop()
+        stop_metrics()
+        if output:
+            output.close()
+        if args.show:
+            cv2.destroyAllWindows()
+
+    summary = recognizer.stats.summary(grabber, recognizer.cache)
+    print(json.dumps(summary, indent=2))
+    if args.summary_json:
+        with open(args.summary_json, mode='w') as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
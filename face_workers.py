@@ -0,0 +1,68 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+import numpy as np
+from face_gallery import ENCODING_SIZE
+from face_pipeline import DETECTION_MAX_SIDE, ImageFaces, analyze_image_data, ordered_map, safe_analyze_image
+
+ENGINES = ('process', 'thread')
+
+
+def _init_worker():
+    # One process per core already, keep OpenCV from spawning its own threads
+    cv2.setNumThreads(1)
+
+
+def analyze_in_worker(image_path, max_side=DETECTION_MAX_SIDE, retry=True):
+    # face_recognition (and its dlib models) was loaded once when this module
+    # was imported in the worker; ship encodings back as one float32 block
+    return _pack(safe_analyze_image(image_path, max_side, retry))
+
+
+def analyze_data_in_worker(data, max_side=DETECTION_MAX_SIDE, retry=True, encode=True):
+    # Same for an image received as bytes (the recognition service)
+    try:
+        faces = analyze_image_data(data, max_side, retry, encode)
+    except Exception as e:
+        faces = ImageFaces(None, [], [], {}, str(e))
+    return _pack(faces)
+
+
+def _pack(faces):
+    encodings = np.asarray(faces.encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    return ImageFaces(faces.path, [tuple(location) for location in faces.locations],
+                      encodings, faces.timings, faces.error)
+
+
+class EncodingPool:
+    """Detection/encoding workers fed through a bounded, order-preserving queue."""
+
+    def __init__(self, workers=None, max_pending=None, engine='process'):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+        self.workers = workers or os.cpu_count() or 1
+        # Backpressure: never more than max_pending images submitted but not
+        # yet consumed, whatever the size of the input
+        self.max_pending = max(max_pending or 2 * self.workers, self.workers)
+        if engine == 'process':
+            # spawn: workers start clean and load the models themselves instead
+            # of inheriting the parent's gallery and threads through fork
+            self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_worker)
+        else:
+            self.executor = ThreadPoolExecutor(self.workers)
+
+    def map(self, items, fn=analyze_in_worker):
+        # Results come back in input order
+        return ordered_map(self.executor, fn, items, self.max_pending)
+
+    def close(self, cancel=False):
+        # Waits for the workers to exit; cancel drops queued work first
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(cancel=exc_type is not None)
@@ -1,11 +1,12 @@
 import os
-import cv2
 import numpy as np
 import tkinter as tk
 from tkinter import filedialog, Label, Button, StringVar, OptionMenu, Toplevel, Text, Canvas, Frame, Scrollbar, DISABLED, NORMAL, font
 from PIL import Image, ImageTk, ImageOps
 from itertools import count
 import time
+from currency_templates import VerificationPolicy
+from currency_verify import AUTO, CurrencyVerifier
 
 # Initialize dataset path
 dataset_base_path = ""
@@ -189,74 +190,34 @@ def select_dataset_folder():
         animate_label()
 
 # Currency types and numbers
-currency_types = ["EGP", "USD"]
+currency_types = ["EGP", "USD", AUTO]
 currency_numbers = ["1", "5", "10", "20", "50", "100", "200"]
 
-# Feature matching function
-def match_features(image, feature_folder, feature_list):
-    """Use SIFT (if available) or ORB for feature matching."""
-    try:
-        sift = cv2.SIFT_create()  # Use SIFT (better than ORB)
-    except:
-        sift = cv2.ORB_create(nfeatures=1500)  # ORB as backup
-
-    kp1, des1 = sift.detectAndCompute(image, None)
-    if des1 is None:
-        return 0, len(feature_list)  # No features detected in input image
-
-    matched_features = 0
-    total_features = len(feature_list)
-
-    for feature_img_name in feature_list:
-        feature_img_path = os.path.join(feature_folder, feature_img_name)
-        feature_img = cv2.imread(feature_img_path, cv2.IMREAD_GRAYSCALE)
-
-        if feature_img is None:
-            continue
-
-        kp2, des2 = sift.detectAndCompute(feature_img, None)
-        if des2 is None:
-            continue
-
-        # Use BFMatcher with knnMatch
-        bf = cv2.BFMatcher()
-        matches = bf.knnMatch(des1, des2, k=2)
-
-        # Lowe's Ratio Test
-        good_matches = [m for m, n in matches if m.distance < 0.7 * n.distance]
-
-        if len(good_matches) > 5:  # Threshold: At least 5 matching keypoints
-            matched_features += 1
-
-    return matched_features, total_features
-
-# Currency feature search
+# Matching threads (CURRENCY_MATCH_WORKERS, one per core by default) and
+# templates per side that make a note real (CURRENCY_MIN_FOUND, all by default)
+match_workers = int(os.environ.get("CURRENCY_MATCH_WORKERS", "0")) or None
+min_found = int(os.environ.get("CURRENCY_MIN_FOUND", "0")) or None
+
+# Verifier for the selected dataset folder, created by the first check
+verifier = None
+
+def current_verifier():
+    global verifier
+    if verifier is None or verifier.dataset_root != dataset_base_path:
+        # Template features and history carry over to the new folder
+        previous = verifier
+        verifier = CurrencyVerifier(dataset_base_path, previous.store if previous else None, match_workers,
+                                    previous.policy if previous else VerificationPolicy(min_found))
+        if previous is not None:
+            previous.close()
+    return verifier
+
+# Currency feature search, AUTO identifies the currency and denomination first
 def search_for_currency_features(front_image_path, back_image_path, selected_currency, selected_number):
-    front_folder = os.path.join(dataset_base_path, selected_currency, selected_number, "front")
-    back_folder = os.path.join(dataset_base_path, selected_currency, selected_number, "back")
-
-    if not os.path.exists(front_folder) or not os.path.exists(back_folder):
-        return f"❌ FAKE Currency ({selected_currency} {selected_number}) - Feature folders missing!"
-
-    front_img = cv2.imread(front_image_path, cv2.IMREAD_GRAYSCALE)
-    back_img = cv2.imread(back_image_path, cv2.IMREAD_GRAYSCALE)
-
-    if front_img is None or back_img is None:
-        return "❌ Error: Unable to read images."
-
-    front_features = os.listdir(front_folder)
-    back_features = os.listdir(back_folder)
-
-    if not front_features or not back_features:
-        return f"❌ FAKE Currency ({selected_currency} {selected_number}) - Features missing!"
-
-    front_matched, total_front = match_features(front_img, front_folder, front_features)
-    back_matched, total_back = match_features(back_img, back_folder, back_features)
-
-    if front_matched < total_front or back_matched < total_back:
-        return f"❌ FAKE Currency ({selected_currency} {selected_number}) - {front_matched}/{total_front} front, {back_matched}/{total_back} back."
-
-    return f"✅ REAL Currency ({selected_currency} {selected_number}) - All features detected."
+    current = current_verifier()
+    verdict = current.verify(front_image_path, back_image_path, selected_currency, selected_number)
+    current.save()
+    return verdict.message
 
 # GUI Functions
 def upload_front_image():
@@ -410,7 +371,8 @@ def show_user_guide():
     1- Click "Select Currency Data Folder" to choose the dataset.
     2- Click "Upload Front Image" to select an image of the front side.
     3- Click "Upload Back Image" to select an image of the back side.
-    4- Select the currency type from the dropdown list.
+    4- Select the currency type from the dropdown list (Auto identifies it).
+       With Auto the currency number is ignored.
     5- Select the currency number from the dropdown list.
     6- Click "Check Real/Fake" to analyze the currency.
     
@@ -438,124 +400,134 @@ def show_user_guide():
     
     fade_in()
 
-# Create Main GUI
-root = tk.Tk()
-root.title("Currency Feature Search")
-root.geometry("1200x700")
-root.configure(bg=bg_color)
-
-# Set window to fade in on startup
-root.attributes('-alpha', 0)
-
-# Custom fonts
-title_font = font.Font(family="Arial", size=18, weight="bold")
-label_font = font.Font(family="Arial", size=12)
-button_font = font.Font(family="Arial", size=12, weight="bold")
-
-# Main container
-main_frame = Frame(root, bg=bg_color)
-main_frame.pack(fill='both', expand=True, padx=20, pady=20)
-
-# Left panel (image display)
-left_frame = Frame(main_frame, bg=panel_color, bd=2, relief='solid')
-left_frame.pack(side='left', fill='both', expand=True, padx=(0, 20), pady=10)
-
-# Front image panel
-front_frame = Frame(left_frame, bg=panel_color)
-front_frame.pack(fill='both', expand=True, pady=(0, 10))
-Label(front_frame, text="Front Image", font=label_font, bg=panel_color, fg=text_color).pack()
-front_panel = Label(front_frame, bg=panel_color)
-front_panel.pack()
-
-# Back image panel
-back_frame = Frame(left_frame, bg=panel_color)
-back_frame.pack(fill='both', expand=True, pady=(10, 0))
-Label(back_frame, text="Back Image", font=label_font, bg=panel_color, fg=text_color).pack()
-back_panel = Label(back_frame, bg=panel_color)
-back_panel.pack()
-
-# Right panel (controls)
-right_frame = Frame(main_frame, bg=panel_color, bd=2, relief='solid', width=400)
-right_frame.pack(side='right', fill='y', padx=(0, 0), pady=10)
-right_frame.pack_propagate(False)
-
-# Title
-Label(right_frame, text="Currency Recognition", font=title_font, 
-      bg=panel_color, fg=text_color).pack(pady=(20, 10))
-
-# Folder selection
-folder_btn = Button(right_frame, text="Select Dataset Folder", command=select_dataset_folder,
-       font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
-folder_btn.pack(fill='x', pady=5)
-folder_label = Label(right_frame, text="No folder selected", font=label_font, 
-                     bg=panel_color, fg=text_color)
-folder_label.pack()
-
-# Upload buttons
-front_btn = Button(right_frame, text="Upload Front Image", command=upload_front_image,
-       font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
-front_btn.pack(fill='x', pady=5)
-back_btn = Button(right_frame, text="Upload Back Image", command=upload_back_image,
-       font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
-back_btn.pack(fill='x', pady=5)
-
-# Currency selection
-Label(right_frame, text="Currency Type:", font=label_font, 
-      bg=panel_color, fg=text_color).pack(pady=(10, 0))
-currency_var = StringVar(root)
-currency_var.set(currency_types[0])
-OptionMenu(right_frame, currency_var, *currency_types).pack(fill='x')
-
-Label(right_frame, text="Currency Number:", font=label_font, 
-      bg=panel_color, fg=text_color).pack(pady=(10, 0))
-currency_number_var = StringVar(root)
-currency_number_var.set(currency_numbers[0])
-OptionMenu(right_frame, currency_number_var, *currency_numbers).pack(fill='x')
-
-# Separator
-separator = Frame(right_frame, height=2, bg=separator_color)
-separator.pack(fill='x', pady=20)
-
-# Classify button
-classify_button = Button(right_frame, text="Check Real/Fake", command=classify_image, 
-                         state="disabled", font=button_font, bg=button_color, 
-                         fg="white", activebackground=highlight_color)
-classify_button.pack(fill='x', pady=5)
-
-# Result label
-result_label = Label(right_frame, text="", font=label_font, 
-                     bg=panel_color, fg=text_color, wraplength=380)
-result_label.pack(pady=10)
-
-# User Guide button
-guide_btn = Button(right_frame, text="User Guide", command=show_user_guide,
-       font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
-guide_btn.pack(fill='x', pady=5)
-
 # Initialize global variables
 front_image_path = ""
 back_image_path = ""
 
-# Add subtle pulsing animation to buttons
-pulse_button(folder_btn, button_color, "#000819")
-pulse_button(front_btn, button_color, "#000819")
-pulse_button(back_btn, button_color, "#000819")
-pulse_button(guide_btn, button_color, "#000819")
+def main():
+    global root, title_font, label_font, button_font, front_panel, back_panel, folder_label, folder_btn
+    global front_btn, back_btn, currency_var, currency_number_var, classify_button, result_label, guide_btn
+
+    # Create Main GUI
+    root = tk.Tk()
+    root.title("Currency Feature Search")
+    root.geometry("1200x700")
+    root.configure(bg=bg_color)
+
+    # Set window to fade in on startup
+    root.attributes('-alpha', 0)
+
+    # Custom fonts
+    title_font = font.Font(family="Arial", size=18, weight="bold")
+    label_font = font.Font(family="Arial", size=12)
+    button_font = font.Font(family="Arial", size=12, weight="bold")
+
+    # Main container
+    main_frame = Frame(root, bg=bg_color)
+    main_frame.pack(fill='both', expand=True, padx=20, pady=20)
+
+    # Left panel (image display)
+    left_frame = Frame(main_frame, bg=panel_color, bd=2, relief='solid')
+    left_frame.pack(side='left', fill='both', expand=True, padx=(0, 20), pady=10)
+
+    # Front image panel
+    front_frame = Frame(left_frame, bg=panel_color)
+    front_frame.pack(fill='both', expand=True, pady=(0, 10))
+    Label(front_frame, text="Front Image", font=label_font, bg=panel_color, fg=text_color).pack()
+    front_panel = Label(front_frame, bg=panel_color)
+    front_panel.pack()
+
+    # Back image panel
+    back_frame = Frame(left_frame, bg=panel_color)
+    back_frame.pack(fill='both', expand=True, pady=(10, 0))
+    Label(back_frame, text="Back Image", font=label_font, bg=panel_color, fg=text_color).pack()
+    back_panel = Label(back_frame, bg=panel_color)
+    back_panel.pack()
+
+    # Right panel (controls)
+    right_frame = Frame(main_frame, bg=panel_color, bd=2, relief='solid', width=400)
+    right_frame.pack(side='right', fill='y', padx=(0, 0), pady=10)
+    right_frame.pack_propagate(False)
+
+    # Title
+    Label(right_frame, text="Currency Recognition", font=title_font, 
+          bg=panel_color, fg=text_color).pack(pady=(20, 10))
+
+    # Folder selection
+    folder_btn = Button(right_frame, text="Select Dataset Folder", command=select_dataset_folder,
+           font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
+    folder_btn.pack(fill='x', pady=5)
+    folder_label = Label(right_frame, text="No folder selected", font=label_font, 
+                         bg=panel_color, fg=text_color)
+    folder_label.pack()
+
+    # Upload buttons
+    front_btn = Button(right_frame, text="Upload Front Image", command=upload_front_image,
+           font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
+    front_btn.pack(fill='x', pady=5)
+    back_btn = Button(right_frame, text="Upload Back Image", command=upload_back_image,
+           font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
+    back_btn.pack(fill='x', pady=5)
+
+    # Currency selection
+    Label(right_frame, text="Currency Type:", font=label_font, 
+          bg=panel_color, fg=text_color).pack(pady=(10, 0))
+    currency_var = StringVar(root)
+    currency_var.set(currency_types[0])
+    OptionMenu(right_frame, currency_var, *currency_types).pack(fill='x')
+
+    Label(right_frame, text="Currency Number:", font=label_font, 
+          bg=panel_color, fg=text_color).pack(pady=(10, 0))
+    currency_number_var = StringVar(root)
+    currency_number_var.set(currency_numbers[0])
+    OptionMenu(right_frame, currency_number_var, *currency_numbers).pack(fill='x')
+
+    # Separator
+    separator = Frame(right_frame, height=2, bg=separator_color)
+    separator.pack(fill='x', pady=20)
+
+    # Classify button
+    classify_button = Button(right_frame, text="Check Real/Fake", command=classify_image, 
+                             state="disabled", font=button_font, bg=button_color, 
+                             fg="white", activebackground=highlight_color)
+    classify_button.pack(fill='x', pady=5)
+
+    # Result label
+    result_label = Label(right_frame, text="", font=label_font, 
+                         bg=panel_color, fg=text_color, wraplength=380)
+    result_label.pack(pady=10)
+
+    # User Guide button
+    guide_btn = Button(right_frame, text="User Guide", command=show_user_guide,
+           font=button_font, bg=button_color, fg="white", activebackground=highlight_color)
+    guide_btn.pack(fill='x', pady=5)
+
+    # Add subtle pulsing animation to buttons
+    pulse_button(folder_btn, button_color, "#000819")
+    pulse_button(front_btn, button_color, "#000819")
+    pulse_button(back_btn, button_color, "#000819")
+    pulse_button(guide_btn, button_color, "#000819")
+
+    # Fade in the main window
+    def fade_in_main(i=0):
+        if i <= 100 and root.winfo_exists():
+            alpha = i/100
+            root.attributes('-alpha', alpha)
+            root.update()
+            root.after(15, lambda: fade_in_main(i+5))
+
+    fade_in_main()
 
-# Fade in the main window
-def fade_in_main(i=0):
-    if i <= 100 and root.winfo_exists():
-        alpha = i/100
-        root.attributes('-alpha', alpha)
-        root.update()
-        root.after(15, lambda: fade_in_main(i+5))
+    # Clean up animations when window closes
+    def on_closing():
+        if verifier is not None:
+            verifier.close()
+        root.destroy()
 
-fade_in_main()
+    root.protocol("WM_DELETE_WINDOW", on_closing)
 
-# Clean up animations when window closes
-def on_closing():
-    root.destroy()
+    root.mainloop()
 
-root.protocol("WM_DELETE_WINDOW", on_closing)
 
-root.mainloop()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
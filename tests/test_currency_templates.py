@@ -0,0 +1,125 @@
+import os
+import cv2
+import numpy as np
+import pytest
+from currency_templates import MatchEngine, TemplateStore, VerificationPolicy
+
+
+def textured_image(seed, size=(480, 640)):
+    # Random shapes on noise, plenty of keypoints for SIFT/ORB
+    rng = np.random.default_rng(seed)
+    image = (rng.random(size) * 60).astype(np.uint8)
+    for _ in range(80):
+        x, y = int(rng.integers(size[1])), int(rng.integers(size[0]))
+        color = int(rng.integers(80, 256))
+        if rng.random() < 0.5:
+            cv2.circle(image, (x, y), int(rng.integers(5, 40)), color, -1)
+        else:
+            cv2.rectangle(image, (x, y), (x + int(rng.integers(5, 60)), y + int(rng.integers(5, 60))), color, -1)
+    return cv2.GaussianBlur(image, (3, 3), 0)
+
+
+def crop(image, x, y, width=200, height=160):
+    return image[y:y + height, x:x + width]
+
+
+def write_image(path, image):
+    cv2.imwrite(str(path), image)
+    return str(path)
+
+
+def test_template_store_reuses_until_mtime_changes(tmp_path):
+    path = write_image(tmp_path / "template.png", textured_image(0, (200, 200)))
+    cache_path = str(tmp_path / "templates.npz")
+    store = TemplateStore(cache_path)
+
+    first = store.get(path)
+    assert first.descriptors is not None and store.extracted == 1
+    assert store.get(path) is first and store.extracted == 1
+    store.save()
+
+    # A new store is served from the cache file
+    reloaded = TemplateStore(cache_path)
+    assert reloaded.cached(path) is not None
+    np.testing.assert_array_equal(reloaded.get(path).descriptors, first.descriptors)
+    assert reloaded.extracted == 0
+
+    # Touching the template invalidates it in memory and in the cache file
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert store.cached(path) is None
+    store.get(path)
+    assert store.extracted == 2
+    assert TemplateStore(cache_path).cached(path) is None
+
+
+def test_template_store_reextracts_changed_content(tmp_path):
+    path = write_image(tmp_path / "template.png", textured_image(0, (200, 200)))
+    store = TemplateStore(None)
+    before = store.get(path)
+    stat = os.stat(path)
+    write_image(path, textured_image(1, (200, 200)))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    after = store.get(path)
+    assert store.extracted == 2
+    assert before.descriptors.shape != after.descriptors.shape or \
+        not np.array_equal(before.descriptors, after.descriptors)
+
+
+@pytest.fixture(scope='module')
+def note(tmp_path_factory):
+    # Front and back of a note, three crops of each as templates, and a
+    # template of plain noise that neither side contains
+    folder = tmp_path_factory.mktemp("note")
+    front, back = textured_image(1), textured_image(2)
+    noise = (np.random.default_rng(3).random((160, 200)) * 255).astype(np.uint8)
+    templates = {}
+    for side, image in (('front', front), ('back', back)):
+        templates[side] = [write_image(folder / f"{side}_{i}.png", crop(image, 40 + 150 * i, 60 + 100 * i))
+                           for i in range(3)]
+    missing = write_image(folder / "missing.png", cv2.GaussianBlur(noise, (5, 5), 0))
+    # Probe descriptors are extracted once for all the tests
+    store = TemplateStore(None)
+    probes = [(image, store.extract(image)[1]) for image in (front, back)]
+    return probes[0], probes[1], templates, missing
+
+
+@pytest.fixture(scope='module')
+def engine():
+    with MatchEngine(TemplateStore(None), workers=4) as engine:
+        yield engine
+
+
+@pytest.mark.parametrize('missing_side', [None, 0, 1])
+@pytest.mark.parametrize('min_found', [None, 2, 3])
+def test_early_exit_gives_the_full_verdict(note, engine, missing_side, min_found):
+    (front, front_descriptors), (back, back_descriptors), templates, missing = note
+    sides = [[front, list(templates['front']), front_descriptors],
+             [back, list(templates['back']), back_descriptors]]
+    if missing_side is not None:
+        sides[missing_side][1][1] = missing
+
+    full = engine.verify(sides, VerificationPolicy(min_found, early_exit=False, stats_path=None))
+    early = engine.verify(sides, VerificationPolicy(min_found, early_exit=True, stats_path=None))
+
+    # Every template is found except the missing one; only "all of them"
+    # (min_found None or 3) fails on a missing template
+    assert full.real == (missing_side is None or min_found == 2)
+    assert early.real == full.real
+    assert [side.checked for side in full.sides] == [3, 3]
+    for early_side, full_side in zip(early.sides, full.sides):
+        assert early_side.matched <= full_side.matched
+        assert early_side.checked - early_side.matched <= full_side.checked - full_side.matched
+
+
+def test_early_exit_stops_on_a_known_miss(note):
+    (front, front_descriptors), (back, back_descriptors), templates, missing = note
+    policy = VerificationPolicy(early_exit=True, stats_path=None)
+    # A template that always missed before is tried first, and with one
+    # thread nothing else runs once it has missed again
+    policy.stats = {os.path.abspath(missing): [10, 10]}
+    with MatchEngine(TemplateStore(None), workers=1) as engine:
+        verification = engine.verify([(front, templates['front'][:2] + [missing], front_descriptors),
+                                      (back, templates['back'], back_descriptors)], policy)
+    assert verification.real is False
+    assert [side.checked for side in verification.sides] == [1, 0]
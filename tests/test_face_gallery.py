@@ -0,0 +1,50 @@
+import csv
+import numpy as np
+from face_gallery import ENCODING_SIZE, compile_gallery, load_gallery, read_csv_gallery
+
+
+def write_gallery_csv(path, rows):
+    with open(path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['Name', 'encoding', 'Status'])
+        writer.writerows(rows)
+
+
+def encoding_text(encoding):
+    return ",".join(repr(float(x)) for x in encoding)
+
+
+def test_compile_and_load_round_trip(tmp_path):
+    encodings = np.random.default_rng(0).normal(0, 0.1, (5, ENCODING_SIZE)).astype(np.float32)
+    csv_path = str(tmp_path / "Criminal_faces.csv")
+    write_gallery_csv(csv_path, [[f"person {i}", encoding_text(e), "wanted"] for i, e in enumerate(encodings)])
+
+    errors = []
+    prefix = compile_gallery(csv_path, chunk_rows=2, errors=errors)
+    gallery = load_gallery(prefix)
+
+    assert errors == []
+    np.testing.assert_array_equal(gallery.encodings, encodings)
+    assert gallery.header == ['Name', 'encoding', 'Status']
+    assert gallery.names == [f"person {i}" for i in range(5)]
+    assert gallery.rows[3] == ["person 3", "", "wanted"]
+
+
+def test_malformed_rows_are_reported_with_their_line(tmp_path):
+    encodings = np.random.default_rng(1).normal(0, 0.1, (3, ENCODING_SIZE)).astype(np.float32)
+    csv_path = str(tmp_path / "faces.csv")
+    write_gallery_csv(csv_path, [
+        ["good 0", encoding_text(encodings[0]), "x"],        # line 2
+        ["short", encoding_text(encodings[1][:10]), "x"],    # line 3
+        ["good 1", encoding_text(encodings[1]), "x"],        # line 4
+        ["no encoding"],                                     # line 5
+        ["good 2", encoding_text(encodings[2]), "x"],        # line 6
+    ])
+
+    for load in (lambda errors: read_csv_gallery(csv_path, chunk_rows=2, errors=errors),
+                 lambda errors: load_gallery(compile_gallery(csv_path, chunk_rows=2, errors=errors))):
+        errors = []
+        gallery = load(errors)
+        assert [line for line, _ in sorted(errors)] == [3, 5]
+        assert gallery.names == ["good 0", "good 1", "good 2"]
+        np.testing.assert_array_equal(gallery.encodings, encodings)
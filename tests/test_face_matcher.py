@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from face_gallery import ENCODING_SIZE
+from face_matcher import CRIMINAL, NON_CRIMINAL, MATCH_THRESHOLD, FaceGallery
+
+
+def make_gallery(resident=True):
+    rng = np.random.default_rng(0)
+    encodings = rng.normal(0.0, 0.1, (300, ENCODING_SIZE)).astype(np.float32)
+    names = [f"person {i}" for i in range(len(encodings))]
+    data = [[name, "", "Unknown"] for name in names]
+    sources = [(CRIMINAL, encodings[:100], names[:100], data[:100]),
+               (NON_CRIMINAL, encodings[100:], names[100:], data[100:])]
+    return FaceGallery(sources, resident=resident), encodings, names
+
+
+def make_probes(encodings):
+    # Noisy copies of gallery faces (known) and fresh random faces (unknown)
+    rng = np.random.default_rng(1)
+    known = encodings[rng.integers(len(encodings), size=40)]
+    known = known + rng.normal(0.0, 0.02, known.shape).astype(np.float32)
+    unknown = rng.normal(0.0, 0.1, (10, ENCODING_SIZE)).astype(np.float32)
+    return np.concatenate([known, unknown])
+
+
+def brute_force(encodings, names, categories, probes, k):
+    # What face_recognition.face_distance plus the criminal-first rule gives
+    expected_names, expected_top = [], []
+    for probe in probes:
+        dists = np.linalg.norm(encodings - probe, axis=1)
+        name = None
+        for category in (CRIMINAL, NON_CRIMINAL):
+            rows = np.flatnonzero(categories == category)
+            best = rows[np.argmin(dists[rows])]
+            if dists[best] < MATCH_THRESHOLD:
+                name = names[best]
+                break
+        expected_names.append(name)
+        expected_top.append(np.argsort(dists, kind='stable')[:k])
+    return expected_names, np.array(expected_top)
+
+
+@pytest.fixture
+def reference():
+    gallery, encodings, names = make_gallery()
+    probes = make_probes(encodings)
+    categories = np.array([CRIMINAL] * 100 + [NON_CRIMINAL] * 200)
+    return gallery, encodings, names, probes, brute_force(encodings, names, categories, probes, 3)
+
+
+@pytest.mark.parametrize('chunk_size', [None, 7])
+def test_exact_search_matches_brute_force(reference, chunk_size):
+    gallery, encodings, names, probes, (expected_names, expected_top) = reference
+    matches = gallery.match_batch(probes, chunk_size)
+    assert [match.name for match in matches] == expected_names
+    assert sum(name is not None for name in expected_names) == 40
+    np.testing.assert_array_equal(gallery.search(probes, 3, chunk_size).rows, expected_top)
+
+
+@pytest.mark.parametrize('kind, params', [('flat', {}), ('ivf', {'nlist': 4, 'nprobe': 4}),
+                                          ('int8', {}), ('float16', {})])
+def test_indexed_search_matches_brute_force(reference, kind, params):
+    gallery, encodings, names, probes, (expected_names, expected_top) = reference
+    gallery.build_indexes(kind, **params)
+    assert [match.name for match in gallery.match_batch(probes)] == expected_names
+    np.testing.assert_array_equal(gallery.search(probes, 3).rows[:, 0], expected_top[:, 0])
+
+
+def test_enrolled_rows_are_searched_with_an_index(reference):
+    gallery, encodings, names, probes, _ = reference
+    gallery.build_indexes('int8')
+    enrolled = np.random.default_rng(2).normal(0.0, 0.1, (1, ENCODING_SIZE)).astype(np.float32)
+    gallery = gallery.extend(CRIMINAL, enrolled, ["new face"], [["new face", "", "Unknown"]])
+    match = gallery.match(enrolled[0] + 0.001)
+    assert (match.category, match.name) == (CRIMINAL, "new face")
+
+
+def test_empty_category_with_an_index():
+    _, encodings, names = make_gallery()
+    gallery = FaceGallery([(CRIMINAL, encodings[:0], [], []),
+                           (NON_CRIMINAL, encodings, names, [[name] for name in names])])
+    for kind in ('ivf', 'int8'):
+        gallery.build_indexes(kind)
+        assert gallery.match(encodings[5]).name == "person 5"